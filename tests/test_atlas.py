@@ -0,0 +1,98 @@
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+from wiz_codex_atlas import write_atlas, import_atlas, ScenarioAtlas
+from wiz_codex_mapstore import list_floor_maps, record_capture, floor_filename
+
+
+def _floor_image(seed):
+    img = Image.new("RGB", (40, 30), (seed * 20 % 256, 10, 10))
+    img.putpixel((3, 4), (255, 255, 255))
+    return img
+
+
+def _atlas(path, scenario="scn", res="1080p", floors=(1, 2)):
+    write_atlas(str(path), [(f, res, _floor_image(f), "zlib") for f in floors], scenario, (0, 0, 40, 30))
+    return str(path)
+
+
+def test_round_trip(tmp_path):
+    src = _atlas(tmp_path / "a.wzatlas")
+    atlas = ScenarioAtlas(src)
+    try:
+        assert sorted(atlas.floors) == [1, 2]
+        assert atlas.image(2, "RGB").convert("RGB").tobytes() == _floor_image(2).tobytes()
+    finally:
+        atlas.close()
+
+
+def test_import_creates_unique_folder(tmp_path):
+    root = tmp_path / "map_images"
+    root.mkdir()
+    (root / "scn").mkdir()
+    folder, count = import_atlas(_atlas(tmp_path / "a.wzatlas"), str(root))
+    assert count == 2
+    assert os.path.basename(folder) == "scn (2)"
+    assert sorted(list_floor_maps(folder)) == [1, 2]
+
+
+@pytest.mark.parametrize("scenario", ["../escaped", "..", "a/b", "a\\b", "x" * 40, "con:", ""])
+def test_import_rejects_bad_scenario_name(tmp_path, scenario):
+    root = tmp_path / "map_images"
+    root.mkdir()
+    src = _atlas(tmp_path / "a.wzatlas", scenario=scenario)
+    # 名前が空ならファイル名（"a"）が使われる → 正常に取り込める
+    if scenario == "":
+        import_atlas(src, str(root))
+        return
+    with pytest.raises(ValueError):
+        import_atlas(src, str(root))
+    assert os.listdir(root) == []
+    assert not (tmp_path / "escaped").exists()
+
+
+@pytest.mark.parametrize("res", ["..\\..\\x", "../x", "1080p/../..", "full"])
+def test_import_rejects_bad_res(tmp_path, res):
+    root = tmp_path / "map_images"
+    root.mkdir()
+    with pytest.raises(ValueError):
+        import_atlas(_atlas(tmp_path / "a.wzatlas", res=res), str(root))
+    assert os.listdir(root) == []
+
+
+def test_import_checks_known_resolutions(tmp_path):
+    root = tmp_path / "map_images"
+    root.mkdir()
+    src = _atlas(tmp_path / "a.wzatlas", res="999p")
+    with pytest.raises(ValueError):
+        import_atlas(src, str(root), res_keys=("720p", "1080p"))
+    folder, _ = import_atlas(src, str(root), res_keys=None)
+    assert os.path.exists(os.path.join(folder, floor_filename(1, "999p")))
+
+
+def test_index_is_safe_across_threads(tmp_path):
+    folder = tmp_path / "scn"
+    folder.mkdir()
+    for f in range(1, 6):
+        _floor_image(f).save(folder / floor_filename(f, "1080p"))
+    errors = []
+
+    def reader():
+        try:
+            for _ in range(200):
+                list_floor_maps(str(folder))
+        except Exception as e:   # pragma: no cover - 失敗時の報告用
+            errors.append(e)
+
+    t = threading.Thread(target=reader)
+    t.start()
+    for i in range(50):
+        path = folder / floor_filename(10 + i, "1080p")
+        _floor_image(i).save(path)
+        record_capture(str(folder), 10 + i, str(path))
+    t.join()
+    assert not errors
+    assert len(list_floor_maps(str(folder))) == 55
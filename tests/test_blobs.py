@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+
+from PIL import Image
+
+import wiz_codex_mapstore
+from wiz_codex_mapstore import (
+    BlobStore, CaptureWriter, CaptureJob, ScenarioIndex, pixel_digest, floor_filename, record_capture, FULL_KIND, GRID_KIND,
+)
+from wiz_codex_atlas import AtlasLoader, write_atlas, atlas_dir, ATLAS_EXT
+
+
+def _no_hardlinks(monkeypatch):
+    def refuse(src, dst):
+        raise OSError("hard links not supported")
+    monkeypatch.setattr(wiz_codex_mapstore.os, "link", refuse)
+
+
+def _image(color):
+    return Image.new("RGB", (24, 16), color)
+
+
+def _capture(writer, path, image, folder):
+    assert writer.submit(image, path, floor=1, folder=folder)
+    for _ in range(500):
+        jobs = writer.drain()
+        if jobs:
+            assert jobs[0].ok, jobs[0].error
+            return jobs[0]
+        time.sleep(0.01)
+    raise AssertionError("保存が終わらない")
+
+
+def test_link_keeps_shared_mtime(tmp_path):
+    blobs = BlobStore(str(tmp_path / "blobs"))
+    writer = CaptureWriter(blobs=blobs)
+    a, b = tmp_path / "a", tmp_path / "b"
+    a.mkdir()
+    b.mkdir()
+    try:
+        pa = str(a / floor_filename(1, "1080p"))
+        _capture(writer, pa, _image((1, 2, 3)), str(a))
+        before = os.stat(pa).st_mtime_ns
+        time.sleep(0.02)
+        pb = str(b / floor_filename(1, "1080p"))
+        job = _capture(writer, pb, _image((1, 2, 3)), str(b))
+    finally:
+        writer.close()
+    assert os.path.samefile(pa, pb)
+    assert os.stat(pa).st_mtime_ns == before       # 他シナリオのキャッシュキーは変わらない
+    assert job.entry["saved_ns"] > before
+
+
+def test_linked_crop_is_newer_than_master(tmp_path):
+    blobs = BlobStore(str(tmp_path / "blobs"))
+    writer = CaptureWriter(blobs=blobs)
+    a, b = tmp_path / "a", tmp_path / "b"
+    a.mkdir()
+    b.mkdir()
+    try:
+        _capture(writer, str(a / floor_filename(1, "1080p")), _image((5, 5, 5)), str(a))
+        time.sleep(0.02)
+        full = str(b / floor_filename(1, FULL_KIND))
+        _image((9, 9, 9)).save(full)
+        time.sleep(0.02)
+        crop = str(b / floor_filename(1, "1080p"))
+        job = _capture(writer, crop, _image((5, 5, 5)), str(b))   # a の古い blob へのリンク
+    finally:
+        writer.close()
+    assert os.stat(crop).st_mtime_ns < os.stat(full).st_mtime_ns
+    index = ScenarioIndex(str(b))
+    index.record(1, full)
+    index.record(1, crop, job.entry)
+    assert index.source(1, "1080p") == (crop, "1080p")
+    # 索引を作り直しても saved_ns は引き継がれる
+    index.rescan()
+    assert index.source(1, "1080p") == (crop, "1080p")
+
+
+def test_collect_removes_unreferenced_blobs(tmp_path):
+    blobs = BlobStore(str(tmp_path / "blobs"))
+    keep, drop = _image((1, 1, 1)), _image((2, 2, 2))
+    dk, dd = pixel_digest(keep), pixel_digest(drop)
+    for img, d in ((keep, dk), (drop, dd)):
+        blobs.put(img, d, lambda im, fp: im.save(fp, format="PNG"))
+    linked = str(tmp_path / floor_filename(1, "1080p"))
+    blobs.link(dk, linked)
+    stray = blobs.path_for(dd) + ".tmp"
+    open(stray, "wb").close()
+
+    assert blobs.collect() == 2
+    assert blobs.has(dk) and not blobs.has(dd)
+    assert not os.path.exists(stray)
+    os.remove(linked)
+    assert blobs.collect() == 1
+    assert not blobs.has(dk)
+
+
+def test_collect_keeps_blobs_when_links_fall_back_to_copies(tmp_path, monkeypatch):
+    _no_hardlinks(monkeypatch)
+    blobs = BlobStore(str(tmp_path / "blobs"))
+    img = _image((3, 3, 3))
+    d = pixel_digest(img)
+    blobs.put(img, d, lambda im, fp: im.save(fp, format="PNG"))
+    blobs.link(d, str(tmp_path / floor_filename(1, "1080p")))
+    assert blobs.copies == 1
+    assert blobs.collect() == 0 and blobs.has(d)
+    # 次回起動（新しいインスタンス）でも消さない
+    assert BlobStore(str(tmp_path / "blobs")).collect() == 0 and blobs.has(d)
+
+
+def test_copies_still_skip_unchanged_captures(tmp_path, monkeypatch):
+    _no_hardlinks(monkeypatch)
+    writer = CaptureWriter(blobs=BlobStore(str(tmp_path / "blobs")))
+    folder = tmp_path / "a"
+    folder.mkdir()
+    path = str(folder / floor_filename(1, "1080p"))
+    try:
+        job = _capture(writer, path, _image((4, 4, 4)), str(folder))
+        record_capture(str(folder), 1, path, job.entry)
+        again = _capture(writer, path, _image((4, 4, 4)), str(folder))
+        changed = _capture(writer, path, _image((5, 4, 4)), str(folder))
+    finally:
+        writer.close()
+    assert not job.skipped and again.skipped and not changed.skipped
+
+
+def test_atlas_is_stale_after_relinking_an_older_blob(tmp_path):
+    blobs = BlobStore(str(tmp_path / "blobs"))
+    writer = CaptureWriter(blobs=blobs)
+    a, b = tmp_path / "a", tmp_path / "b"
+    a.mkdir()
+    b.mkdir()
+    old, exported = _image((7, 7, 7)), _image((8, 8, 8))
+    pb = str(b / floor_filename(1, "1080p"))
+    try:
+        _capture(writer, str(a / floor_filename(1, "1080p")), old, str(a))      # 古い blob
+        job = _capture(writer, pb, exported, str(b))
+        record_capture(str(b), 1, pb, job.entry)
+        time.sleep(0.02)
+        os.makedirs(atlas_dir(str(b)))
+        write_atlas(os.path.join(atlas_dir(str(b)), f"atlas.{time.time_ns()}{ATLAS_EXT}"),
+                    [(1, "1080p", exported, "raw")], "b")
+        time.sleep(0.02)
+        job = _capture(writer, pb, old, str(b))        # 古い blob へのリンク → mtime は atlas より古い
+        record_capture(str(b), 1, pb, job.entry)
+    finally:
+        writer.close()
+    loader = AtlasLoader()
+    img = loader.load(pb, None, "RGB")
+    assert loader.stale == 1
+    assert img.convert("RGB").tobytes() == old.tobytes()
+
+
+def test_capture_group_counts_once_and_displaces_migrations(tmp_path):
+    folder = str(tmp_path)
+    writer = CaptureWriter(max_pending=1, blobs=BlobStore(str(tmp_path / "blobs")))
+    gate = threading.Event()
+
+    def hold(image):
+        gate.wait(5)
+        return image
+
+    busy = os.path.join(folder, floor_filename(9, "1920x1080"))
+    assert writer.submit(_image((1, 1, 1)), busy, floor=9, folder=folder, prepare=hold)
+    for _ in range(500):
+        if not writer._pending:
+            break
+        time.sleep(0.01)            # 書き込みスレッドが着手して gate で止まるまで待つ
+
+    migrate = os.path.join(folder, floor_filename(2, "1920x1080"))
+    assert writer.submit(_image((2, 2, 2)), migrate, floor=2, folder=folder, kind="migrate")
+    paths = [os.path.join(folder, floor_filename(1, key)) for key in (FULL_KIND, GRID_KIND, "1920x1080")]
+    group = [CaptureJob(_image((3, 3, 3)), p, floor=1, folder=folder) for p in paths]
+    assert writer.submit_group(group)                   # 3ファイルでも1件・移行を押し出して受け付ける
+    other = [CaptureJob(_image((4, 4, 4)), os.path.join(folder, floor_filename(3, "1920x1080")), floor=3, folder=folder)]
+    assert not writer.submit_group(other)               # キャプチャ同士は押し出さない
+
+    gate.set()
+    done = []
+    for _ in range(500):
+        done += writer.drain()
+        if len(done) == 4:
+            break
+        time.sleep(0.01)
+    writer.close()
+    assert [job.path for job in done] == [busy] + paths
+    assert all(job.ok for job in done)
+    assert not os.path.exists(migrate)
@@ -0,0 +1,64 @@
+from PIL import Image
+
+from wiz_codex_capture import CaptureBackend, SyntheticCaptureBackend, StableFrameGrabber
+
+REGION = (0, 0, 64, 64)
+
+
+class _ScriptedBackend(CaptureBackend):
+    """取得のたびに frames の次の1枚を返す（最後の1枚は出し続ける）"""
+
+    def __init__(self, frames):
+        super().__init__()
+        self.script = list(frames)
+        self.calls = 0
+
+    def _grab(self, region):
+        img = self.script[min(self.calls, len(self.script) - 1)]
+        self.calls += 1
+        return img.copy()
+
+
+def _solid(color):
+    return Image.new("RGB", REGION[2:], color)
+
+
+def _grabber(backend, **kw):
+    kw.setdefault("interval_ms", 1)
+    kw.setdefault("timeout_ms", 2000)
+    return StableFrameGrabber(backend, step=2, **kw)
+
+
+def test_old_screen_is_not_taken_as_stable():
+    old, new = _solid((0, 0, 0)), _solid((200, 200, 200))
+    # 遷移直後の3枚はまだ前の画面 → その後描き変わる
+    backend = _ScriptedBackend([old, old, old, new])
+    image, info = _grabber(backend, min_wait_ms=1000).grab_stable(REGION)
+    assert info["stable"] and info["changed"]
+    assert image.tobytes() == new.tobytes()
+    assert info["frames"] >= 4 + 2 - 1
+
+
+def test_already_drawn_screen_settles_after_min_wait():
+    backend = _ScriptedBackend([_solid((9, 9, 9))])
+    image, info = _grabber(backend, min_wait_ms=30).grab_stable(REGION)
+    assert info["stable"] and not info["changed"]
+    assert info["wait_ms"] >= 30
+    assert info["wait_ms"] < 1000
+
+
+def test_synthetic_settle_commits_final_frame():
+    backend = SyntheticCaptureBackend(settle_after=5)
+    image, info = _grabber(backend, min_wait_ms=1000).grab_stable((0, 0, 256, 256))
+    assert info["stable"] and info["changed"]
+    assert info["frames"] >= 5 + 2
+
+
+def test_timeout_falls_back_to_last_frame():
+    frames = [_solid((i * 40 % 256, 0, 0)) for i in range(1000)]
+    backend = _ScriptedBackend(frames)
+    grabber = _grabber(backend, timeout_ms=40)
+    image, info = grabber.grab_stable(REGION)
+    assert not info["stable"]
+    assert image is backend.last_image()
+    assert grabber.stats()["timeouts"] == 1
@@ -0,0 +1,65 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from wiz_codex_codec import (
+    StorageCodec, CODEC_PNG, CODEC_WEBP, CODEC_RAW, CODEC_EXT, LEVEL_RANGE, WZI_FORMAT, webp_available,
+)
+
+
+def _image(mode):
+    rng = np.random.default_rng(1)
+    bands = len(mode)
+    a = rng.integers(0, 256, size=(37, 53, bands), dtype=np.uint8)
+    return Image.fromarray(a[..., 0] if bands == 1 else a, mode)
+
+
+def _round_trip(codec, img):
+    buf = io.BytesIO()
+    codec(img, buf)
+    buf.seek(0)
+    with Image.open(buf) as out:
+        out.load()
+        return out
+
+
+CODECS = [CODEC_PNG, CODEC_RAW] + ([CODEC_WEBP] if webp_available() else [])
+
+
+@pytest.mark.parametrize("name", CODECS)
+def test_lossless_round_trip(name):
+    lo, hi = LEVEL_RANGE[name]
+    img = _image("RGB")
+    for level in sorted({lo, hi}):
+        out = _round_trip(StorageCodec(name, level), img)
+        assert out.size == img.size
+        assert out.convert("RGB").tobytes() == img.tobytes(), (name, level)
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+@pytest.mark.parametrize("level", [0, 6])
+def test_wzi_modes(mode, level):
+    img = _image(mode)
+    out = _round_trip(StorageCodec(CODEC_RAW, level), img)
+    assert out.format == WZI_FORMAT
+    assert out.mode == mode
+    assert out.tobytes() == img.tobytes()
+
+
+def test_wzi_file_opens_by_content(tmp_path):
+    img = _image("RGB")
+    path = tmp_path / ("floor" + CODEC_EXT[CODEC_RAW])
+    with open(path, "wb") as fp:
+        StorageCodec(CODEC_RAW)(img, fp)
+    with Image.open(path) as out:
+        assert out.format == WZI_FORMAT
+        assert out.crop((5, 5, 20, 20)).tobytes() == img.crop((5, 5, 20, 20)).tobytes()
+
+
+def test_bad_settings_fall_back():
+    assert StorageCodec("bogus").name == CODEC_PNG
+    assert StorageCodec(CODEC_PNG, 99).level == LEVEL_RANGE[CODEC_PNG][1]
+    assert StorageCodec(CODEC_RAW, "x").level == StorageCodec(CODEC_RAW).level
+    assert StorageCodec.from_settings({"storage_codec": "RAW", "storage_level": 0}).ext == CODEC_EXT[CODEC_RAW]
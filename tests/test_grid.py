@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from wiz_codex_grid import (
+    GridGeometry, CANON_CELL_PX, CANON_MIN_CELL, CANON_MAX_CELL, CANON_SIZE, is_canonical_grid,
+    cells_path, save_cells, MAP_CELLS,
+)
+from wiz_codex_mapcache import decode_crop
+from wiz_codex_mapstore import ScenarioIndex, floor_filename, GRID_KIND
+
+# 1080p 相当: セル 24px・セル (0,0) の中心が (300, 560)。Crop はセル -1.375〜20.375（実際のプロファイルと同じ範囲）
+CELL = 24
+ORIGIN = (300, 560)
+CROP = (255, 83, 777, 605)
+
+
+def _geometry():
+    return GridGeometry(CROP, CELL, *ORIGIN)
+
+
+def _cell_centre_on_screen(g, i, j):
+    return g.corner_x + (i + 0.5) * CELL, g.corner_y - (j + 0.5) * CELL
+
+
+def test_origin_is_centre_of_cell_zero():
+    g = _geometry()
+    assert (g.corner_x, g.corner_y) == (ORIGIN[0] - CELL / 2, ORIGIN[1] + CELL / 2)
+    assert g.screen_to_cell(*ORIGIN) == (0.5, 0.5)
+    assert g.screen_to_cell(ORIGIN[0] + 3 * CELL, ORIGIN[1] - 5 * CELL) == (3.5, 5.5)
+
+
+def test_canonical_grid_covers_boundary_cells():
+    assert CANON_SIZE == (CANON_MAX_CELL - CANON_MIN_CELL) * CANON_CELL_PX
+    # 東端・北端の外周壁（セル 20 の西辺・南辺）がグリッド内に入る
+    assert CANON_MAX_CELL >= MAP_CELLS + 1
+    assert is_canonical_grid((CANON_SIZE, CANON_SIZE))
+    assert not is_canonical_grid((704, 704))
+
+
+def test_normalize_places_cell_centres():
+    g = _geometry()
+    img = Image.new("RGB", (CROP[2] - CROP[0], CROP[3] - CROP[1]))
+    d = ImageDraw.Draw(img)
+    cells = [(0, 0), (7, 3), (19, 19)]
+    for i, j in cells:
+        x, y = _cell_centre_on_screen(g, i, j)
+        x, y = x - CROP[0], y - CROP[1]
+        d.rectangle([x - 4, y - 4, x + 4, y + 4], fill=(255, 255, 255))
+    grid = np.asarray(g.normalize(img))
+    assert grid.shape == (CANON_SIZE, CANON_SIZE, 3)
+    for i, j in cells:
+        cx = int((i + 0.5 - CANON_MIN_CELL) * CANON_CELL_PX)
+        cy = int((CANON_MAX_CELL - j - 0.5) * CANON_CELL_PX)
+        assert grid[cy, cx].min() > 200, (i, j)
+
+
+def test_display_crop_round_trip(tmp_path):
+    g = _geometry()
+    rng = np.random.default_rng(0)
+    # セル単位の模様（再標本化の補間で縁が滲んでも中心は一致する）
+    blocks = rng.integers(0, 256, size=(CROP[3] - CROP[1], CROP[2] - CROP[0], 3), dtype=np.uint8)
+    blocks = blocks[::CELL, ::CELL]
+    img = Image.fromarray(np.repeat(np.repeat(blocks, CELL, 0), CELL, 1)[:CROP[3] - CROP[1], :CROP[2] - CROP[0]])
+    path = str(tmp_path / "grid.png")
+    g.normalize(img).save(path)
+    back = np.asarray(decode_crop(path, g.display_crop(), "RGB"), dtype=np.int32)
+    src = np.asarray(img, dtype=np.int32)
+    assert back.shape == src.shape
+    inner = (slice(CELL, -CELL), slice(CELL, -CELL))
+    assert np.median(np.abs(back[inner] - src[inner])) <= 2
+
+
+def test_index_drops_grids_written_before_the_fix(tmp_path):
+    folder = str(tmp_path)
+    old = os.path.join(folder, floor_filename(1, GRID_KIND))
+    Image.new("RGB", (704, 704)).save(old)
+    save_cells(cells_path(folder, 1), np.zeros((MAP_CELLS + 1, MAP_CELLS + 1), np.uint8))
+    new = os.path.join(folder, floor_filename(2, GRID_KIND))
+    Image.new("RGB", (CANON_SIZE, CANON_SIZE)).save(new)
+
+    index = ScenarioIndex(folder).rescan()
+    assert index.entry(1, GRID_KIND) is None
+    assert not os.path.exists(old)
+    assert not os.path.exists(cells_path(folder, 1))
+    assert index.entry(2, GRID_KIND) is not None
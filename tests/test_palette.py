@@ -0,0 +1,89 @@
+import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from wiz_codex_mapcache import SharedPalette, PaletteStore, RawPixelCache, PALETTE_COLORS
+from wiz_codex_atlas import AtlasLoader, write_atlas, atlas_dir, ATLAS_EXT
+from wiz_codex_mapstore import floor_filename
+
+
+def _image(colors, size=(16, 8)):
+    """colors を順に敷き詰めた RGB 画像"""
+    w, h = size
+    a = np.array([colors[i % len(colors)] for i in range(w * h)], dtype=np.uint8).reshape(h, w, 3)
+    return Image.fromarray(a)
+
+
+def test_round_trip_keeps_near_colors_apart():
+    img = _image([(10, 10, 10), (11, 10, 10), (10, 11, 10), (10, 10, 11), (255, 255, 255)])
+    out = SharedPalette().to_indexed(img)
+    assert out.mode == "P"
+    assert out.convert("RGB").tobytes() == img.tobytes()
+
+
+def test_indices_stay_stable_across_floors():
+    pal = SharedPalette()
+    a = _image([(0, 0, 0), (200, 10, 10)])
+    b = _image([(5, 5, 5), (200, 10, 10), (0, 0, 0), (1, 0, 0)])
+    ia = pal.to_indexed(a)
+    ib = pal.to_indexed(b)
+    assert ib.convert("RGB").tobytes() == b.tobytes()
+    # 後から色が増えても先に変換したフロアの番号は変わらない
+    assert pal.to_indexed(a).tobytes() == ia.tobytes()
+    assert ia.convert("RGB").tobytes() == a.tobytes()
+
+
+def test_too_many_colors_falls_back():
+    pal = SharedPalette()
+    colors = [(i, i // 2, 255 - i) for i in range(256)] + [(1, 2, 3)]
+    assert pal.to_indexed(_image(colors, size=(257, 1))) is None
+    assert len(pal.colors) == 0
+    assert PALETTE_COLORS == 256
+
+
+def test_store_passes_non_rgb_modes_through():
+    rgba = Image.new("RGBA", (4, 4), (10, 20, 30, 128))
+    calls = []
+
+    def loader(path, crop, mode):
+        calls.append(mode)
+        return rgba if mode == "RGBA" else rgba.convert("RGB")
+
+    store = PaletteStore(loader)
+    assert store.load("/tmp/x/map_1f_720p.png", None, "RGBA") is rgba
+    out = store.load("/tmp/x/map_1f_720p.png", None, "RGB")
+    assert out.mode == "P"
+    assert out.convert("RGB").tobytes() == rgba.convert("RGB").tobytes()
+    assert calls == ["RGBA", "RGB"]
+
+
+def _mapapp_chain():
+    """MapApp と同じ順（raw_cache → atlas → palette）で loader を組む"""
+    return PaletteStore(AtlasLoader(RawPixelCache().load).load)
+
+
+def _floor(tmp_path):
+    img = _image([(10, 10, 10), (11, 10, 10), (200, 30, 30)], size=(40, 24))
+    path = str(tmp_path / floor_filename(1, "1080p"))
+    img.save(path)
+    return img, path
+
+
+@pytest.mark.parametrize("with_atlas", [False, True])
+def test_mapapp_loader_chain_is_indexed(tmp_path, with_atlas):
+    img, path = _floor(tmp_path)
+    if with_atlas:
+        os.makedirs(atlas_dir(str(tmp_path)), exist_ok=True)
+        write_atlas(os.path.join(atlas_dir(str(tmp_path)), f"atlas.{time.time_ns()}{ATLAS_EXT}"),
+                    [(1, "1080p", img, "raw")], "scn")
+    store = _mapapp_chain()
+    for _ in range(2):   # 2回目は .rawcache（mmap）から
+        out = store.load(path, None, "RGB")
+        assert out.mode == "P"
+        assert out.convert("RGB").tobytes() == img.tobytes()
+    st = store.stats()[str(tmp_path)]
+    assert st["indexed"] == 1 and st["saved_bytes"] > 0
+    assert store.loader.__self__.hits == (2 if with_atlas else 0)
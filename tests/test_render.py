@@ -0,0 +1,55 @@
+import time
+
+from wiz_codex_render import FrameScheduler
+
+
+class _Root:
+    """after() を記録するだけの Tk ルートの代わり（_frame は手で呼ぶ）"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def after(self, ms, fn):
+        self.jobs.append((ms, fn))
+        return len(self.jobs)
+
+    def after_cancel(self, job):
+        pass
+
+
+def _scheduler(names, hidden=(), budget_ms=0, calls=None):
+    sched = FrameScheduler(_Root(), interval_ms=50, budget_ms=budget_ms)
+    sched._next_due = time.perf_counter()
+    calls = [] if calls is None else calls
+    for name in names:
+        visible = (lambda: False) if name in hidden else None
+        sched.register(name, lambda name=name: calls.append(name), visible=visible)
+    return sched, calls
+
+
+def _frames(sched, count):
+    for _ in range(count):
+        sched._next_due = time.perf_counter()
+        sched._frame()
+
+
+def test_rotation_reaches_every_callback_past_hidden_ones():
+    # 予算 0 → 1フレーム1件。非表示の A を飛ばしても B に張り付かず C・D まで回る
+    sched, calls = _scheduler("ABCD", hidden="A")
+    _frames(sched, 6)
+    assert calls == ["B", "C", "D", "B", "C", "D"]
+
+
+def test_deferred_counts_only_visible_callbacks_left_unrun():
+    sched, calls = _scheduler("ABCD", hidden="C")
+    _frames(sched, 1)
+    assert calls == ["A"]
+    assert sched.deferred_calls == 2       # B・D（非表示の C は数えない）
+
+
+def test_generous_budget_runs_all_in_order():
+    sched, calls = _scheduler("ABC", budget_ms=1000)
+    _frames(sched, 2)
+    assert calls == ["A", "B", "C", "A", "B", "C"]
+    assert sched.deferred_calls == 0
+    assert sched.stats()["frames"] == 2
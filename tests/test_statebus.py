@@ -0,0 +1,83 @@
+import os
+import time
+
+import wiz_codex_statebus as statebus
+from wiz_codex_statebus import PublisherLock, run_state_publisher
+
+
+class _NeverPolled:
+    menu_base = hp_base = 0
+
+    def poll(self):
+        raise AssertionError("ロックを取れない publisher がゲームを読んだ")
+
+
+def test_second_lock_is_refused(tmp_path):
+    path = str(tmp_path / "bus.lock")
+    first, second = PublisherLock(path), PublisherLock(path)
+    assert first.acquire()
+    try:
+        assert not second.acquire()
+        assert second.held_elsewhere()
+    finally:
+        first.release()
+    assert second.acquire()
+    second.release()
+    assert not PublisherLock(path).held_elsewhere()
+
+
+def test_publisher_without_lock_exits_without_writing(tmp_path, monkeypatch):
+    path = str(tmp_path / "bus.lock")
+    monkeypatch.setattr(statebus, "LOCK_PATH", path)
+
+    def no_writer(*a, **kw):
+        raise AssertionError("ロックを取れない publisher が state bus を開いた")
+
+    monkeypatch.setattr(statebus, "StateBusWriter", no_writer)
+    holder = PublisherLock(path)
+    assert holder.acquire()
+    try:
+        assert run_state_publisher(rate_hz=20.0, source=_NeverPolled()) is None
+    finally:
+        holder.release()
+
+
+def _stale_bus(name):
+    writer = statebus.StateBusWriter(name)
+    zeros6 = (0,) * 6
+    writer.publish(time.time() - 10 * statebus.STALE_SEC, statebus.FLAG_MENU_VALID, 0x1000, 0,
+                   (0,) * 7, zeros6, zeros6, (0,) * 54)
+    return writer
+
+
+def test_stale_bus_respawns_publisher(tmp_path, monkeypatch):
+    monkeypatch.setattr(statebus, "LOCK_PATH", str(tmp_path / "bus.lock"))
+    name = f"wzsb_test_{os.getpid()}"
+    writer = _stale_bus(name)
+    spawned = []
+    try:
+        reader = statebus.StateBusReader(name, respawn=lambda: spawned.append(1))
+        assert reader.read() is None
+        assert spawned == [1]
+        assert reader.shm is None          # 次の publisher のリングへ繋ぎ直せるよう手放している
+        assert reader.read() is None
+        assert spawned == [1]              # RESPAWN_SEC 以内は再起動しない
+    finally:
+        writer.close()
+
+
+def test_stale_bus_does_not_respawn_while_publisher_holds_lock(tmp_path, monkeypatch):
+    path = str(tmp_path / "bus.lock")
+    monkeypatch.setattr(statebus, "LOCK_PATH", path)
+    name = f"wzsb_test_lock_{os.getpid()}"
+    writer = _stale_bus(name)
+    holder = PublisherLock(path)
+    assert holder.acquire()
+    spawned = []
+    try:
+        reader = statebus.StateBusReader(name, respawn=lambda: spawned.append(1))
+        assert reader.read() is None
+        assert spawned == []
+    finally:
+        holder.release()
+        writer.close()
@@ -0,0 +1,121 @@
+import json
+import time
+import socket
+from types import SimpleNamespace
+
+from wiz_codex_statepush import StatePushServer, _Client
+
+
+def _snap(i):
+    return SimpleNamespace(menu_valid=True, hp_valid=False, menu_state=1, dir=i % 4, x=i % 20, y=i // 20 % 20,
+                           floor=1 + i // 400, dungeon_id=0, timestamp=float(i))
+
+
+class _Source:
+    def __init__(self):
+        self.i = 0
+
+    def __call__(self):
+        self.i += 1
+        return _snap(self.i)
+
+
+class _PartialSock:
+    """1回の send で最大 chunk バイトしか受け付けない・blocked の間は何も受け付けないソケットの代わり"""
+
+    def __init__(self, chunk=7):
+        self.chunk = chunk
+        self.blocked = False
+        self.data = bytearray()
+
+    def send(self, buf):
+        if self.blocked:
+            raise BlockingIOError
+        n = min(self.chunk, len(buf))
+        self.data += bytes(buf[:n])
+        return n
+
+
+def _replay(lines):
+    """受信した行から状態を組み立て直す（全行が完全な JSON であることも確認する）"""
+    state, seqs = None, []
+    for line in lines:
+        msg = json.loads(line)
+        seqs.append(msg["seq"])
+        if msg["type"] == "full":
+            state = dict(msg["state"])
+        else:
+            assert state is not None, "full より先に delta が届いた"
+            for k, v in msg["changes"].items():
+                if v is None:
+                    state.pop(k, None)
+                else:
+                    state[k] = v
+    return state, seqs
+
+
+def _drain(server, c):
+    """短い send は「送信バッファが一杯」扱いで _flush が止まるので、空になるまで繰り返す"""
+    for _ in range(100000):
+        if not c.out:
+            return
+        server._flush(c)
+    raise AssertionError("送信待ちが空にならない")
+
+
+def _server(max_pending):
+    server = StatePushServer(source=_Source(), max_pending=max_pending)
+    sock = _PartialSock()
+    c = _Client(sock, ("stand-in", 0))
+    server.clients[sock] = c
+    return server, sock, c
+
+
+def test_partial_sends_never_split_frames_under_backpressure():
+    server, sock, c = _server(max_pending=200)
+    for i in range(300):
+        sock.blocked = (i // 10) % 3 != 0    # 詰まったり流れたりを繰り返す
+        server.publish_once()
+    assert c.dropped > 0
+    sock.blocked = False
+    _drain(server, c)
+    assert not c.out and c.pending == 0
+    lines = sock.data.decode("utf-8").splitlines()
+    state, seqs = _replay(lines)
+    assert state == server.last_state
+    assert seqs == sorted(seqs)
+
+
+def test_first_message_is_full_and_resync_is_immediate():
+    server, sock, c = _server(max_pending=60)
+    server.publish_once()
+    _drain(server, c)
+    first = json.loads(sock.data.decode("utf-8").splitlines()[0])
+    assert first["type"] == "full"
+
+    sock.blocked = True
+    for _ in range(20):
+        server.publish_once()
+    assert c.dropped > 0
+    # 再同期用の full は次の状態変化を待たずに積まれている
+    assert json.loads(c.out[-1])["type"] == "full"
+    assert json.loads(c.out[-1])["seq"] == server.seq
+    assert c.pending == sum(len(f) for f in c.out) - c.sent
+
+
+def test_local_client_receives_consistent_stream():
+    server = StatePushServer(source=_Source(), port=0, rate_hz=200).start()
+    try:
+        with socket.create_connection(server.address, timeout=2.0) as s:
+            buf = b""
+            deadline = time.monotonic() + 1.0
+            while time.monotonic() < deadline and buf.count(b"\n") < 20:
+                buf += s.recv(65536)
+        lines = buf.split(b"\n")[:-1]
+        assert len(lines) >= 20
+        assert json.loads(lines[0])["type"] == "full"
+        state, seqs = _replay(lines)
+        assert state["menu_valid"] is True
+        assert seqs == sorted(seqs)
+    finally:
+        server.stop()
@@ -0,0 +1,408 @@
+# ──────────────────────────────────────────────
+# 📦 Wiz Codex: Scenario atlas
+#
+# 1シナリオ分の切り抜き済みフロア画像を1ファイル（*.wzatlas）にまとめる。
+# 共有はこのファイルを1つ渡すだけ・表示時はフロア切り替えでファイルを開かない（mmap をスライス）。
+#
+# 📦 形式（リトルエンディアン）:
+#   ヘッダ   "<4sHHII"  magic "WZA1", version, フロア数, 索引JSONの長さ, データ開始位置
+#   索引     UTF-8 JSON {"scenario", "created", "floors": [{floor, res, crop, width, height,
+#                         codec, offset, length}, ...]}   … offset はデータ開始位置からの相対
+#   データ   フロアごとの画素（16byte 境界に揃える）
+#     codec "raw"  … RGBA 生画素（Image.frombuffer でそのまま共有・コピーなし）
+#     codec "zlib" … zlib 圧縮した RGB 生画素
+#     codec "png"  … PNG
+#   "auto" は zlib で縮む（RAW_RATIO 倍以上）フロアだけ zlib、それ以外は raw にする
+#
+# ✅ シナリオフォルダ内の atlas（.atlas/atlas.{time_ns}.wzatlas）:
+# - export_atlas() はここに新しい世代を書き、古い世代を消す（mmap 中で消せなければ次回）
+#   → 表示中の atlas を上書きしないので、Windows でも書き出しが止まらない
+# - AtlasLoader は decode_crop と同じ呼び出し方の loader。PNG より新しい atlas に
+#   そのフロアがあれば mmap から返す（確認は PNG と .atlas フォルダの stat・メモリ上の索引だけ）
+# - PNG のほうが新しい（atlas 作成後にキャプチャした）フロアは従来どおり下位の loader で読む。
+#   PNG の新しさは mtime と索引の saved_ns の新しい方（blob へのリンクは mtime が古いままのため）
+#
+# ✅ import_atlas(): atlas の各フロアを map_{floor}f_{res}.png に展開し、atlas 自体も .atlas/ に置く
+#   （索引・タイル・キャプチャ比較など PNG 前提の処理はそのまま動く）
+#   シナリオ名・res は外部入力として検査し、シナリオルートの外には書かない
+# ──────────────────────────────────────────────
+
+import io
+import os
+import json
+import mmap
+import time
+import zlib
+import shutil
+import struct
+import threading
+
+from PIL import Image
+
+from wiz_codex_mapcache import decode_crop
+from wiz_codex_mapstore import (
+    list_floor_maps, floor_source, floor_filename, parse_floor_filename, FULL_KIND, GRID_KIND,
+    is_res_key, is_valid_scenario_name, get_scenario_index, saved_ns,
+)
+
+ATLAS_MAGIC = b"WZA1"
+ATLAS_VERSION = 1
+ATLAS_EXT = ".wzatlas"
+ATLAS_DIRNAME = ".atlas"
+ALIGN = 16
+
+CODEC_RAW = "raw"
+CODEC_ZLIB = "zlib"
+CODEC_PNG = "png"
+CODEC_AUTO = "auto"
+CODECS = (CODEC_AUTO, CODEC_ZLIB, CODEC_RAW, CODEC_PNG)
+ZLIB_LEVEL = 6
+RAW_RATIO = 2.0     # auto: zlib でこの倍率以上縮まなければ raw（展開不要）で持つ
+
+_HEADER = struct.Struct("<4sHHII")
+
+
+def _pad(n):
+    return -n % ALIGN
+
+
+def _encode_floor(img, codec):
+    """Returns: (codec, bytes)"""
+    if codec == CODEC_PNG:
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="PNG")
+        return CODEC_PNG, buf.getvalue()
+    if codec == CODEC_RAW:
+        return CODEC_RAW, img.convert("RGBA").tobytes()
+    rgb = img.convert("RGB").tobytes()
+    data = zlib.compress(rgb, ZLIB_LEVEL)
+    if codec == CODEC_AUTO and len(data) * RAW_RATIO > len(rgb):
+        return CODEC_RAW, img.convert("RGBA").tobytes()
+    return CODEC_ZLIB, data
+
+
+def write_atlas(path, floors, scenario="", crop=None):
+    """
+    floors: [(floor, res_key, image, codec), ...] を atlas ファイル path に書く（一時ファイル → os.replace）。
+    crop: 切り抜きに使った範囲（full からの読み込み要求と照合する）
+    Returns: {"floors", "bytes", "raw_bytes", "codecs"}
+    """
+    entries, payloads = [], []
+    offset = raw_bytes = 0
+    codecs = {}
+    for floor, res_key, img, codec in floors:
+        used, data = _encode_floor(img, codec)
+        entries.append({
+            "floor": int(floor), "res": res_key, "crop": list(crop) if crop is not None else None,
+            "width": img.size[0], "height": img.size[1],
+            "codec": used, "offset": offset, "length": len(data),
+        })
+        payloads.append(data)
+        offset += len(data) + _pad(len(data))
+        raw_bytes += img.size[0] * img.size[1] * 3
+        codecs[used] = codecs.get(used, 0) + 1
+
+    meta = json.dumps({"scenario": scenario, "created": time.time(), "floors": entries},
+                      ensure_ascii=False).encode("utf-8")
+    data_start = _HEADER.size + len(meta)
+    data_start += _pad(data_start)
+
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION, len(entries), len(meta), data_start))
+            f.write(meta)
+            f.write(b"\0" * (data_start - _HEADER.size - len(meta)))
+            for data in payloads:
+                f.write(data)
+                f.write(b"\0" * _pad(len(data)))
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    return {"floors": len(entries), "bytes": os.path.getsize(path), "raw_bytes": raw_bytes, "codecs": codecs}
+
+
+class ScenarioAtlas:
+    """atlas ファイルを mmap で開き、フロアごとにスライスして画像にする（どのスレッドから呼んでもよい）"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, count, meta_len, data_start = _HEADER.unpack_from(self._mm, 0)
+            if magic != ATLAS_MAGIC or version != ATLAS_VERSION:
+                raise ValueError("not a scenario atlas")
+            meta = json.loads(bytes(self._mm[_HEADER.size:_HEADER.size + meta_len]).decode("utf-8"))
+            self.scenario = meta.get("scenario", "")
+            self.floors = {int(e["floor"]): e for e in meta["floors"]}
+            self._data_start = data_start
+            if len(self.floors) != count:
+                raise ValueError("floor count mismatch")
+            for e in self.floors.values():
+                if data_start + e["offset"] + e["length"] > len(self._mm):
+                    raise ValueError(f"floor {e['floor']} out of range")
+        except Exception:
+            self._mm.close()
+            raise
+
+    def entry(self, floor):
+        return self.floors.get(floor)
+
+    def image(self, floor, mode="RGB"):
+        """
+        フロアの画像を返す。raw は mmap を共有した RGBA（mode が RGB でも RGBA のまま）、
+        それ以外は展開して mode に変換したもの。
+        """
+        e = self.floors[floor]
+        start = self._data_start + e["offset"]
+        view = memoryview(self._mm)[start:start + e["length"]]
+        size = (e["width"], e["height"])
+        if e["codec"] == CODEC_RAW:
+            # mmap の参照は画像が持つ → キャッシュから捨てられた時点で解放される
+            img = Image.frombuffer("RGBA", size, view, "raw", "RGBA", 0, 1)
+            return img if mode in ("RGB", "RGBA") else img.convert(mode)
+        if e["codec"] == CODEC_ZLIB:
+            img = Image.frombytes("RGB", size, zlib.decompress(view))
+        elif e["codec"] == CODEC_PNG:
+            with Image.open(io.BytesIO(view)) as src:
+                img = src.convert("RGB")
+        else:
+            raise ValueError(f"unknown codec: {e['codec']}")
+        return img if mode == "RGB" else img.convert(mode)
+
+    def close(self):
+        try:
+            self._mm.close()
+        except BufferError:
+            pass   # 共有中の画像が残っている → 最後の参照が消えた時点で解放される
+
+
+# ──────────────────────────────
+# シナリオフォルダ内の atlas
+def atlas_dir(folder):
+    return os.path.join(folder, ATLAS_DIRNAME)
+
+
+def _generations(folder):
+    """[(time_ns, path), ...]（新しい順）"""
+    d = atlas_dir(folder)
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return []
+    out = []
+    for name in names:
+        parts = name.split(".")
+        if len(parts) == 3 and parts[0] == "atlas" and "." + parts[2] == ATLAS_EXT and parts[1].isdigit():
+            out.append((int(parts[1]), os.path.join(d, name)))
+    return sorted(out, reverse=True)
+
+
+def latest_atlas_path(folder):
+    gens = _generations(folder)
+    return gens[0][1] if gens else None
+
+
+def _new_generation_path(folder):
+    d = atlas_dir(folder)
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, f"atlas.{time.time_ns()}{ATLAS_EXT}")
+
+
+def _sweep_generations(folder, keep):
+    for _, path in _generations(folder):
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass   # mmap 中（Windows）→ 次回
+
+
+def export_atlas(folder, res_key, crop, dest=None, codec=CODEC_AUTO, scenario=None, geometry=None):
+    """
+    シナリオフォルダの全フロアを res_key の切り抜き済み画像で atlas にまとめる。
+    - フォルダ内 .atlas/ に新しい世代として書く（表示用）。dest があればそこへもコピー（共有用）
+    - crop: res_key の切り抜き範囲（画面全体のファイルしか無いフロアはこれで切り抜く）
+    - geometry: res_key の GridGeometry（正規化グリッドしか無いフロアはこれで再標本化する）
+    Returns: (書き出したファイル（dest があれば dest）, write_atlas の集計)
+    """
+    floors = []
+    for floor in list_floor_maps(folder):
+        path, kind = floor_source(folder, floor, res_key)
+        if path is None:
+            continue
+        if kind == GRID_KIND:
+            if geometry is None:
+                continue   # 正規化グリッドしか無い → 再標本化範囲が分からないので含めない
+            src_crop = geometry.display_crop()
+        else:
+            src_crop = crop if kind == FULL_KIND else None
+        floors.append((floor, res_key, decode_crop(path, src_crop, "RGB"), codec))
+    if not floors:
+        raise ValueError("no floor maps to export")
+
+    out = _new_generation_path(folder)
+    stats = write_atlas(out, floors, scenario if scenario is not None else os.path.basename(folder), crop)
+    _sweep_generations(folder, out)
+    if dest:
+        shutil.copyfile(out, dest)
+    return dest or out, stats
+
+
+def _inside(root, path):
+    """path（実体）が root（実体）の直下か"""
+    return os.path.dirname(os.path.realpath(path)) == os.path.realpath(root)
+
+
+def _unique_folder(root, name):
+    folder = os.path.join(root, name)
+    n = 2
+    while os.path.exists(folder):
+        folder = os.path.join(root, f"{name} ({n})")
+        n += 1
+    return folder
+
+
+def import_atlas(src, scenario_root, name=None, max_name_length=16, res_keys=None):
+    """
+    atlas ファイルから新しいシナリオフォルダを作る（同名があれば " (2)" 等を付ける）。
+    atlas の中身は外から来たものとして扱う:
+    - シナリオ名はシナリオ追加と同じ条件（長さ・禁止文字）で検査し、scenario_root の直下以外は拒否
+    - 各フロアの res は解像度キーの形（res_keys があればその中のどれか）、floor は 0 以上の整数に限る
+    不正なら ValueError（作りかけのフォルダは消す）。
+    Returns: (作成したフォルダ, 展開したフロア数)
+    """
+    atlas = ScenarioAtlas(src)
+    folder = None
+    try:
+        name = (name or atlas.scenario or os.path.splitext(os.path.basename(src))[0] or "").strip()
+        if not is_valid_scenario_name(name, max_name_length):
+            raise ValueError(f"invalid scenario name in atlas: {name!r}")
+        plan = []
+        for floor in sorted(atlas.floors):
+            res = atlas.entry(floor).get("res")
+            if not isinstance(floor, int) or floor < 0:
+                raise ValueError(f"invalid floor in atlas: {floor!r}")
+            if not is_res_key(res) or (res_keys is not None and res not in res_keys):
+                raise ValueError(f"invalid resolution in atlas: {res!r}")
+            plan.append((floor, floor_filename(floor, res)))
+        folder = _unique_folder(scenario_root, name)
+        if not _inside(scenario_root, folder):
+            raise ValueError(f"scenario folder escapes {scenario_root}: {folder}")
+        os.makedirs(folder)
+        for floor, filename in plan:
+            dest = os.path.join(folder, filename)
+            if not _inside(folder, dest):
+                raise ValueError(f"floor file escapes {folder}: {dest}")
+            tmp = dest + ".tmp"
+            atlas.image(floor, "RGB").convert("RGB").save(tmp, format="PNG")
+            os.replace(tmp, dest)
+        count = len(plan)
+    except Exception:
+        if folder is not None and os.path.isdir(folder) and _inside(scenario_root, folder):
+            shutil.rmtree(folder, ignore_errors=True)
+        raise
+    finally:
+        atlas.close()
+    # PNG を書き終えてから置く（atlas のほうが新しい → 表示は atlas から）
+    shutil.copyfile(src, _new_generation_path(folder))
+    return folder, count
+
+
+class AtlasLoader:
+    """
+    decode_crop と同じ呼び出し方（loader）。PNG より新しいフォルダ内 atlas にそのフロアがあれば
+    mmap から返し、無ければ下位の loader に任せる。
+    """
+    MODES = ("RGB", "RGBA")
+
+    def __init__(self, loader=decode_crop):
+        self.loader = loader
+        self._atlases = {}   # folder → (.atlas の mtime_ns, ScenarioAtlas | None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.opened = 0
+
+    def load(self, path, crop, mode="RGB"):
+        if mode in self.MODES:
+            img = self._from_atlas(path, crop, mode)
+            if img is not None:
+                self.hits += 1
+                return img
+        self.misses += 1
+        return self.loader(path, crop, mode)
+
+    def _from_atlas(self, path, crop, mode):
+        folder, name = os.path.split(path)
+        parsed = parse_floor_filename(name)
+        if parsed is None:
+            return None
+        floor, kind = parsed
+        atlas = self._atlas_for(folder)
+        e = atlas.entry(floor) if atlas is not None else None
+        if e is None:
+            return None
+        if kind == FULL_KIND:
+            if crop is None or e["crop"] != [int(v) for v in crop]:
+                return None
+        elif crop is not None or e["res"] != kind:
+            return None
+        try:
+            if self._placed_ns(folder, floor, kind, path) > atlas.mtime_ns:
+                self.stale += 1
+                return None
+            return atlas.image(floor, mode)
+        except Exception as e:
+            print(f"[atlas] 読み込み失敗: {name} → {e}")
+            return None
+
+    @staticmethod
+    def _placed_ns(folder, floor, kind, path):
+        """
+        フロア画像がこのフォルダに置かれた時刻。blob へのリンクは mtime が blob 作成時のままなので、
+        索引の saved_ns も見る（ScenarioIndex.source() と同じ基準）
+        """
+        mtime_ns = os.stat(path).st_mtime_ns
+        e = get_scenario_index(folder).entry(floor, kind)
+        if e is None or e.get("file") != os.path.basename(path):
+            return mtime_ns
+        return max(mtime_ns, saved_ns(e))
+
+    def _atlas_for(self, folder):
+        try:
+            mtime_ns = os.stat(atlas_dir(folder)).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        with self._lock:
+            memo = self._atlases.get(folder)
+            if memo is not None and memo[0] == mtime_ns:
+                return memo[1]
+            # 古い世代は閉じない（他のスレッドが読み込み中かもしれない）→ 参照が消えた時点で解放
+            atlas = None
+            path = latest_atlas_path(folder) if mtime_ns is not None else None
+            if path is not None:
+                try:
+                    atlas = ScenarioAtlas(path)
+                    self.opened += 1
+                except Exception as e:
+                    print(f"[atlas] 開けないため無視: {os.path.basename(path)} → {e}")
+            self._atlases[folder] = (mtime_ns, atlas)
+            return atlas
+
+    def close(self):
+        with self._lock:
+            for _, atlas in self._atlases.values():
+                if atlas is not None:
+                    atlas.close()
+            self._atlases.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "stale": self.stale, "opened": self.opened}
@@ -0,0 +1,236 @@
+# ──────────────────────────────────────────────
+# ⏱ Wiz Codex: Benchmarks
+#
+# 画面取得まわりの速度をまとめて計測するスクリプト。
+#
+#   python wiz_codex_bench.py capture [--backend synthetic] [--frames 200] [--region 0,0,800,600]
+#   python wiz_codex_bench.py stable  [--settle 4] [--runs 20] [--step 4]
+#   python wiz_codex_bench.py codec   [map_images/<scenario> ...] [--codecs png:6,png:1,webp:0,raw:1] [--runs 3]
+#
+# capture … キャプチャバックエンドごとの1フレームの遅延（平均 / p50 / p95 / 最大）とスループット（fps）
+#           --backend 省略時は、この環境で作れる全バックエンドを順に計測する
+# stable  … 合成フレーム（settle 回目の取得で描画完了）に対する StableFrameGrabber の
+#           確定までの時間・取得枚数
+# codec   … 保存形式（wiz_codex_codec）ごとのエンコード・デコード時間とファイルサイズ。
+#           引数のフォルダ / ファイルから実際のキャプチャ（map_{floor}f_*.*）を集めて使う
+#           （見つからなければ合成したマップ風の画像）。デコードはメモリ上（.wzi level 0 の mmap は含まない）
+# ──────────────────────────────────────────────
+
+import io
+import os
+import sys
+import time
+import argparse
+
+from wiz_codex_capture import (
+    BACKEND_GDI, BACKEND_PYAUTOGUI, BACKEND_SYNTHETIC,
+    get_capture_backend, SyntheticCaptureBackend, StableFrameGrabber,
+)
+from wiz_codex_codec import StorageCodec
+from wiz_codex_mapstore import parse_floor_filename
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[i]
+
+
+def summarize_ms(samples_ms, total_sec):
+    """遅延サンプル（ms）と経過時間から集計 dict を作る"""
+    s = sorted(samples_ms)
+    n = len(s)
+    return {
+        "n": n,
+        "avg_ms": sum(s) / n if n else 0.0,
+        "p50_ms": _percentile(s, 50),
+        "p95_ms": _percentile(s, 95),
+        "max_ms": s[-1] if s else 0.0,
+        "fps": n / total_sec if total_sec > 0 else 0.0,
+    }
+
+
+def format_row(name, r):
+    return (f"{name:<12} n={r['n']:<5} avg={r['avg_ms']:7.2f}ms  p50={r['p50_ms']:7.2f}ms  "
+            f"p95={r['p95_ms']:7.2f}ms  max={r['max_ms']:7.2f}ms  {r['fps']:7.1f} fps")
+
+
+# ──────────────────────────────
+def bench_capture(backend, region, frames=200, warmup=5):
+    """backend.grab(region) を frames 回呼び、遅延とスループットを返す"""
+    for _ in range(warmup):
+        backend.grab(region)
+    samples = []
+    t_start = time.perf_counter()
+    for _ in range(frames):
+        t0 = time.perf_counter()
+        backend.grab(region)
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return summarize_ms(samples, time.perf_counter() - t_start)
+
+
+def run_capture(args):
+    names = [args.backend] if args.backend else [BACKEND_SYNTHETIC, BACKEND_GDI, BACKEND_PYAUTOGUI]
+    region = tuple(int(v) for v in args.region.split(","))
+    print(f"📷 capture region={region} frames={args.frames}")
+    for name in names:
+        if name == BACKEND_GDI and not sys.platform.startswith("win"):
+            print(f"{name:<12} （Windows 専用のためスキップ）")
+            continue
+        try:
+            backend = get_capture_backend(name)
+        except Exception as e:
+            print(f"{name:<12} 作成失敗: {e}")
+            continue
+        if backend.name != name:
+            print(f"{name:<12} 利用不可（{backend.name} にフォールバックしたためスキップ）")
+            backend.close()
+            continue
+        try:
+            print(format_row(name, bench_capture(backend, region, args.frames)))
+        except Exception as e:
+            print(f"{name:<12} 計測失敗: {e}")
+        finally:
+            backend.close()
+
+
+def run_stable(args):
+    region = tuple(int(v) for v in args.region.split(","))
+    backend = SyntheticCaptureBackend(settle_after=args.settle)
+    grabber = StableFrameGrabber(backend, step=args.step)
+    waits, frames = [], []
+    t_start = time.perf_counter()
+    for _ in range(args.runs):
+        backend.reset()
+        _, info = grabber.grab_stable(region)
+        waits.append(info["wait_ms"])
+        frames.append(info["frames"])
+    r = summarize_ms(waits, time.perf_counter() - t_start)
+    print(f"🖼 stable region={region} settle={args.settle} step={args.step}")
+    print(format_row("synthetic", r) + f"  frames/avg={sum(frames) / len(frames):.1f}  {grabber.stats()}")
+    grabber.shutdown()
+
+
+def collect_map_images(paths, limit):
+    """フォルダ（再帰）・ファイルからフロア画像のパスを集める"""
+    found = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root, _, names in os.walk(p):
+                found += [os.path.join(root, n) for n in sorted(names) if parse_floor_filename(n)]
+        elif os.path.isfile(p):
+            found.append(p)
+    return found[:limit]
+
+
+def synthetic_map(size=(640, 640), cell=32, seed=0):
+    """マップ画面風の画像（黒地・探索済みの床・白い壁線）"""
+    from PIL import Image, ImageDraw
+    import random
+    rnd = random.Random(seed)
+    img = Image.new("RGB", size)
+    draw = ImageDraw.Draw(img)
+    for v in range(size[1] // cell):
+        for u in range(size[0] // cell):
+            if rnd.random() < 0.6:
+                x, y = u * cell, v * cell
+                draw.rectangle((x, y, x + cell - 1, y + cell - 1), fill=(40, 50, 80))
+                if rnd.random() < 0.3:
+                    draw.line((x, y, x, y + cell - 1), fill=(240, 240, 240), width=2)
+                if rnd.random() < 0.3:
+                    draw.line((x, y, x + cell - 1, y), fill=(240, 240, 240), width=2)
+    return img
+
+
+def bench_codec(codec, images, runs=3):
+    """
+    images を codec でエンコード・デコードする。
+    Returns: (エンコード集計, デコード集計, 合計バイト数, 全画像が元と一致したか)
+    """
+    from PIL import Image
+    enc, dec = [], []
+    nbytes, lossless = 0, True
+    t_enc = t_dec = 0.0
+    for img in images:
+        for r in range(runs):
+            buf = io.BytesIO()
+            t0 = time.perf_counter()
+            codec(img, buf)
+            t1 = time.perf_counter()
+            data = buf.getvalue()
+            with Image.open(io.BytesIO(data)) as out:
+                out.load()
+                t2 = time.perf_counter()
+                if r == 0:
+                    nbytes += len(data)
+                    lossless = lossless and out.convert(img.mode).tobytes() == img.tobytes()
+            enc.append((t1 - t0) * 1000.0)
+            dec.append((t2 - t1) * 1000.0)
+            t_enc += t1 - t0
+            t_dec += t2 - t1
+    return summarize_ms(enc, t_enc), summarize_ms(dec, t_dec), nbytes, lossless
+
+
+def run_codec(args):
+    from PIL import Image
+    paths = collect_map_images(args.paths, args.limit)
+    if paths:
+        images = []
+        for p in paths:
+            with Image.open(p) as src:
+                images.append(src.convert("RGB"))
+    else:
+        print("⚠️ マップ画像が見つからないため合成画像で計測します（実キャプチャのフォルダを引数に指定してください）")
+        images = [synthetic_map(seed=i) for i in range(4)]
+    raw = sum(len(img.tobytes()) for img in images)
+    print(f"🗜 codec images={len(images)}（無圧縮 {raw / 1048576:.1f} MB）runs={args.runs}")
+    for spec in args.codecs.split(","):
+        name, _, level = spec.strip().partition(":")
+        codec = StorageCodec(name, level or None)
+        label = repr(codec)
+        if label.split(":")[0] != name.lower():
+            print(f"{spec:<12} 利用不可のためスキップ")
+            continue
+        try:
+            r_enc, r_dec, nbytes, lossless = bench_codec(codec, images, args.runs)
+        except Exception as e:
+            print(f"{label:<12} 計測失敗: {e}")
+            continue
+        print(format_row(f"{label} enc", r_enc))
+        print(format_row(f"{label} dec", r_dec))
+        print(f"{'':<12} size={nbytes / 1024:9.1f} KB（無圧縮の {nbytes / raw:6.1%}）  "
+              f"{'lossless' if lossless else '⚠️ 元画像と不一致'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Wiz Codex benchmarks")
+    sub = parser.add_subparsers(dest="suite", required=True)
+
+    p = sub.add_parser("capture", help="キャプチャバックエンドの遅延・スループット")
+    p.add_argument("--backend", choices=[BACKEND_SYNTHETIC, BACKEND_GDI, BACKEND_PYAUTOGUI])
+    p.add_argument("--frames", type=int, default=200)
+    p.add_argument("--region", default="0,0,800,600", help="left,top,width,height")
+    p.set_defaults(func=run_capture)
+
+    p = sub.add_parser("stable", help="描画完了待ち（StableFrameGrabber）の確定時間")
+    p.add_argument("--settle", type=int, default=4, help="この回数目の取得で合成フレームが止まる")
+    p.add_argument("--runs", type=int, default=20)
+    p.add_argument("--step", type=int, default=4)
+    p.add_argument("--region", default="0,0,800,600", help="left,top,width,height")
+    p.set_defaults(func=run_stable)
+
+    p = sub.add_parser("codec", help="保存形式ごとのエンコード・デコード時間とサイズ")
+    p.add_argument("paths", nargs="*", help="キャプチャのフォルダ（再帰）またはファイル")
+    p.add_argument("--codecs", default="png:6,png:1,webp:0,webp:4,raw:0,raw:1",
+                   help="name:level をカンマ区切り（png:6 = Pillow の既定相当）")
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--limit", type=int, default=32, help="使う画像の最大枚数")
+    p.set_defaults(func=run_codec)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
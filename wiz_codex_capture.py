@@ -0,0 +1,433 @@
+# ──────────────────────────────────────────────
+# 📷 Wiz Codex: Screen capture backends
+#
+# Mapbook の画面取得を差し替え可能にする。
+# どのバックエンドも grab(region) で PIL 画像（RGB）を返す。
+#   region = (left, top, width, height)  … スクリーン座標
+#
+# ✅ バックエンド:
+# - "gdi"       … BitBlt（ctypes のみ・Windows）。DC と DIB セクションを使い回し、
+#                 同じサイズの取得ではバッファを確保し直さない
+# - "pyautogui" … 従来の pyautogui.screenshot()（取得のたびに import はしない・初回だけ）
+# - "synthetic" … テスト用の合成フレーム（Linux でも動く）。グリッド＋動くマーカーを描く
+# - "auto"      … Windows なら gdi、それ以外は synthetic
+#
+# ✅ StableFrameGrabber:
+# - マップ画面の描画完了を待ってから1枚だけ確定する
+# - 取得範囲を step 画素おきに間引いた小さな配列どうしを numpy で一括比較する
+#   （変化画素の割合が max_changed 以下 = 前フレームと同じ）
+# - 遷移直後の数フレームはまだ前の画面のことがあるので、「2枚が同じ」だけでは採用しない。
+#   最初のフレームから画面が変わったのを見届けてから、settle_frames 回続けて同じなら採用する
+#   （取り直しはしない）。変化が見えないまま min_wait_ms を過ぎた場合は、既に描き終わっていたとみなす
+# - timeout_ms までに安定しなければ最後のフレームを採用する（固定待ちと同じ結果）
+#
+# 🔧 settings.json:
+#   "capture_backend": "auto", "stable_capture": true
+#
+# 計測: python wiz_codex_bench.py capture / stable
+# ──────────────────────────────────────────────
+
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+BACKEND_AUTO = "auto"
+BACKEND_GDI = "gdi"
+BACKEND_PYAUTOGUI = "pyautogui"
+BACKEND_SYNTHETIC = "synthetic"
+BACKEND_NAMES = (BACKEND_AUTO, BACKEND_GDI, BACKEND_PYAUTOGUI, BACKEND_SYNTHETIC)
+
+
+class CaptureBackend:
+    """
+    画面取得の共通インターフェース。
+    サブクラスは _grab(region) を実装する（grab() が時間計測を行う）。
+    """
+    name = "base"
+
+    def __init__(self):
+        self.frames = 0
+        self.busy_sec = 0.0
+        self.last_ms = 0.0
+        self._last = None
+
+    def _timed(self, fn, region, *args):
+        t0 = time.perf_counter()
+        out = fn(tuple(int(v) for v in region), *args)
+        dt = time.perf_counter() - t0
+        self.frames += 1
+        self.busy_sec += dt
+        self.last_ms = dt * 1000.0
+        return out
+
+    def grab(self, region):
+        """region = (left, top, width, height) を取得して RGB 画像を返す（呼び出し側が所有してよい）"""
+        return self._timed(self._grab, region)
+
+    def grab_sample(self, region, step):
+        """
+        region を取得し、step 画素おきに間引いた uint8 配列 (h, w, 3) を返す。
+        取得したフレーム自体は last_image() で取り出せる（取り直し不要）。
+        """
+        return self._timed(self._grab_sample, region, step)
+
+    def last_image(self):
+        """直前の grab_sample() のフレーム（RGB 画像）"""
+        return self._last
+
+    def _grab(self, region):
+        raise NotImplementedError
+
+    def _grab_sample(self, region, step):
+        self._last = self._grab(region)
+        return np.asarray(self._last)[::step, ::step]
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "frames": self.frames,
+            "avg_ms": (self.busy_sec / self.frames * 1000.0) if self.frames else 0.0,
+            "last_ms": self.last_ms,
+        }
+
+
+# ──────────────────────────────
+# GDI（BitBlt）
+class GdiCaptureBackend(CaptureBackend):
+    """
+    画面DC → メモリDC（32bpp トップダウン DIB セクション）へ BitBlt し、
+    DIB のメモリを直接 PIL に渡す。DC・DIB は取得サイズが変わった時だけ作り直す。
+    """
+    name = BACKEND_GDI
+
+    SRCCOPY = 0x00CC0020
+    CAPTUREBLT = 0x40000000
+
+    def __init__(self):
+        super().__init__()
+        if not sys.platform.startswith("win"):
+            raise OSError("GDI キャプチャは Windows 専用です")
+        import ctypes
+        from ctypes import wintypes
+        self._ctypes = ctypes
+        self._user32 = ctypes.windll.user32
+        self._gdi32 = ctypes.windll.gdi32
+        self._declare(ctypes, wintypes)
+
+        class BITMAPINFOHEADER(ctypes.Structure):
+            _fields_ = [
+                ("biSize", wintypes.DWORD), ("biWidth", wintypes.LONG), ("biHeight", wintypes.LONG),
+                ("biPlanes", wintypes.WORD), ("biBitCount", wintypes.WORD), ("biCompression", wintypes.DWORD),
+                ("biSizeImage", wintypes.DWORD), ("biXPelsPerMeter", wintypes.LONG),
+                ("biYPelsPerMeter", wintypes.LONG), ("biClrUsed", wintypes.DWORD), ("biClrImportant", wintypes.DWORD),
+            ]
+
+        class BITMAPINFO(ctypes.Structure):
+            _fields_ = [("bmiHeader", BITMAPINFOHEADER), ("bmiColors", wintypes.DWORD * 3)]
+
+        self._BITMAPINFO = BITMAPINFO
+        self._lock = threading.Lock()
+        self._screen_dc = None
+        self._mem_dc = None
+        self._bitmap = None
+        self._old_obj = None
+        self._buf = None
+        self._size = None
+        self.reallocs = 0
+
+    def _declare(self, ctypes, wintypes):
+        # 64bit でハンドルが切り詰められないよう戻り値・引数の型を明示
+        u, g = self._user32, self._gdi32
+        u.GetDC.restype = wintypes.HDC
+        u.GetDC.argtypes = [wintypes.HWND]
+        u.ReleaseDC.argtypes = [wintypes.HWND, wintypes.HDC]
+        g.CreateCompatibleDC.restype = wintypes.HDC
+        g.CreateCompatibleDC.argtypes = [wintypes.HDC]
+        g.CreateDIBSection.restype = wintypes.HBITMAP
+        g.CreateDIBSection.argtypes = [wintypes.HDC, ctypes.c_void_p, wintypes.UINT,
+                                       ctypes.POINTER(ctypes.c_void_p), wintypes.HANDLE, wintypes.DWORD]
+        g.SelectObject.restype = wintypes.HGDIOBJ
+        g.SelectObject.argtypes = [wintypes.HDC, wintypes.HGDIOBJ]
+        g.BitBlt.restype = wintypes.BOOL
+        g.BitBlt.argtypes = [wintypes.HDC, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                             wintypes.HDC, ctypes.c_int, ctypes.c_int, wintypes.DWORD]
+        g.DeleteObject.argtypes = [wintypes.HGDIOBJ]
+        g.DeleteDC.argtypes = [wintypes.HDC]
+        g.GdiFlush.restype = wintypes.BOOL
+
+    def _ensure(self, width, height):
+        if self._size == (width, height):
+            return
+        self._release_bitmap()
+        ctypes = self._ctypes
+        if self._screen_dc is None:
+            self._screen_dc = self._user32.GetDC(None)
+            self._mem_dc = self._gdi32.CreateCompatibleDC(self._screen_dc)
+            if not self._screen_dc or not self._mem_dc:
+                raise OSError("GetDC / CreateCompatibleDC 失敗")
+
+        bmi = self._BITMAPINFO()
+        h = bmi.bmiHeader
+        h.biSize = ctypes.sizeof(h)
+        h.biWidth = width
+        h.biHeight = -height          # 負 = トップダウン（PIL と同じ行順）
+        h.biPlanes = 1
+        h.biBitCount = 32
+        h.biCompression = 0           # BI_RGB
+        bits = ctypes.c_void_p()
+        bitmap = self._gdi32.CreateDIBSection(self._mem_dc, ctypes.byref(bmi), 0, ctypes.byref(bits), None, 0)
+        if not bitmap or not bits.value:
+            raise OSError("CreateDIBSection 失敗")
+        self._bitmap = bitmap
+        self._old_obj = self._gdi32.SelectObject(self._mem_dc, bitmap)
+        self._buf = (ctypes.c_ubyte * (width * height * 4)).from_address(bits.value)
+        self._size = (width, height)
+        self.reallocs += 1
+
+    def _grab(self, region):
+        left, top, width, height = region
+        if width <= 0 or height <= 0:
+            raise ValueError(f"不正な取得範囲: {region}")
+        with self._lock:
+            self._ensure(width, height)
+            if not self._gdi32.BitBlt(self._mem_dc, 0, 0, width, height, self._screen_dc,
+                                      left, top, self.SRCCOPY | self.CAPTUREBLT):
+                raise OSError("BitBlt 失敗")
+            self._gdi32.GdiFlush()
+            # BGRX → RGB の変換時にコピーされる（DIB は次の取得で再利用される）
+            return Image.frombuffer("RGB", (width, height), self._buf, "raw", "BGRX", 0, 1)
+
+    def _grab_sample(self, region, step):
+        # PIL 画像は作らず DIB から直接間引く（BGRX → RGB は列の並べ替えだけ）
+        left, top, width, height = region
+        if width <= 0 or height <= 0:
+            raise ValueError(f"不正な取得範囲: {region}")
+        with self._lock:
+            self._ensure(width, height)
+            if not self._gdi32.BitBlt(self._mem_dc, 0, 0, width, height, self._screen_dc,
+                                      left, top, self.SRCCOPY | self.CAPTUREBLT):
+                raise OSError("BitBlt 失敗")
+            self._gdi32.GdiFlush()
+            frame = np.frombuffer(self._buf, dtype=np.uint8).reshape(height, width, 4)
+            return frame[::step, ::step, 2::-1].copy()
+
+    def last_image(self):
+        with self._lock:
+            if self._buf is None:
+                return None
+            width, height = self._size
+            return Image.frombuffer("RGB", (width, height), self._buf, "raw", "BGRX", 0, 1)
+
+    def _release_bitmap(self):
+        if self._bitmap is not None:
+            self._gdi32.SelectObject(self._mem_dc, self._old_obj)
+            self._gdi32.DeleteObject(self._bitmap)
+        self._bitmap = self._old_obj = self._buf = self._size = None
+
+    def close(self):
+        with self._lock:
+            self._release_bitmap()
+            if self._mem_dc:
+                self._gdi32.DeleteDC(self._mem_dc)
+            if self._screen_dc:
+                self._user32.ReleaseDC(None, self._screen_dc)
+            self._mem_dc = self._screen_dc = None
+
+    def stats(self):
+        return dict(super().stats(), reallocs=self.reallocs)
+
+
+# ──────────────────────────────
+# pyautogui（従来方式）
+class PyAutoGuiCaptureBackend(CaptureBackend):
+    name = BACKEND_PYAUTOGUI
+
+    def __init__(self):
+        super().__init__()
+        self._screenshot = None
+
+    def _grab(self, region):
+        if self._screenshot is None:
+            import pyautogui   # 重い import は初回取得まで遅らせる
+            self._screenshot = pyautogui.screenshot
+        return self._screenshot(region=region).convert("RGB")
+
+
+# ──────────────────────────────
+# 合成フレーム（テスト・ベンチマーク用）
+class SyntheticCaptureBackend(CaptureBackend):
+    """
+    仮想スクリーン（screen_size）上のグリッド模様を返す。
+    取得のたびにマーカーが1セル進むので、連続フレームの差分処理も試せる。
+    settle_after を指定すると、その回数だけ取得した後はマーカーが止まる（描画完了の模擬）。
+    背景は1回だけ描いて使い回し、取得ごとに作るのは切り出し画像だけ。
+    """
+    name = BACKEND_SYNTHETIC
+
+    def __init__(self, screen_size=(1920, 1080), cell_px=32, seed=0, settle_after=None):
+        super().__init__()
+        self.screen_size = screen_size
+        self.cell_px = cell_px
+        self.tick = seed
+        self.settle_after = settle_after
+        self._grabs = 0
+        self._base = self._draw_base(screen_size, cell_px)
+
+    def reset(self):
+        """settle_after のカウントをやり直す（次の取得から再び「描画中」）"""
+        self._grabs = 0
+
+    @staticmethod
+    def _draw_base(size, cell):
+        img = Image.new("RGB", size, (24, 24, 32))
+        d = ImageDraw.Draw(img)
+        w, h = size
+        for x in range(0, w, cell):
+            d.line([(x, 0), (x, h)], fill=(90, 90, 120))
+        for y in range(0, h, cell):
+            d.line([(0, y), (w, y)], fill=(90, 90, 120))
+        return img
+
+    def _grab(self, region):
+        left, top, width, height = region
+        img = self._base.crop((left, top, left + width, top + height))
+        cols = max(1, width // self.cell_px)
+        rows = max(1, height // self.cell_px)
+        cx = (self.tick % cols) * self.cell_px
+        cy = ((self.tick // cols) % rows) * self.cell_px
+        ImageDraw.Draw(img).rectangle([cx + 4, cy + 4, cx + self.cell_px - 4, cy + self.cell_px - 4],
+                                      fill=(220, 40, 40))
+        self._grabs += 1
+        if self.settle_after is None or self._grabs < self.settle_after:
+            self.tick += 1
+        return img
+
+
+# ──────────────────────────────
+# 描画完了待ち
+def changed_ratio(a, b, tolerance):
+    """2つの間引きフレーム (h, w, 3) で、どれかのチャンネルが tolerance を超えて変わった画素の割合"""
+    if a.shape != b.shape:
+        return 1.0
+    diff = np.abs(a.astype(np.int16) - b.astype(np.int16)).max(axis=2)
+    return np.count_nonzero(diff > tolerance) / diff.size
+
+
+class StableFrameGrabber:
+    """
+    Parameters:
+        backend:       CaptureBackend
+        step:          比較用に間引く画素間隔（4 → 1/16 の画素数）
+        tolerance:     画素値の揺れとして無視する差（圧縮ノイズ・ディザ対策）
+        max_changed:   変化画素の割合がこれ以下なら「前フレームと同じ」とみなす
+        interval_ms:   フレーム取得の間隔
+        settle_frames: 何回続けて「前フレームと同じ」なら安定とみなすか
+        min_wait_ms:   最初のフレームから変化が見えなくても、これを過ぎれば安定判定を始める
+        timeout_ms:    これを過ぎたら安定していなくても最後のフレームを採用
+    """
+    def __init__(self, backend, step=4, tolerance=8, max_changed=0.001, interval_ms=15,
+                 settle_frames=2, min_wait_ms=150, timeout_ms=1000):
+        self.backend = backend
+        self.step = step
+        self.tolerance = tolerance
+        self.max_changed = max_changed
+        self.interval = interval_ms / 1000.0
+        self.settle_frames = max(1, int(settle_frames))
+        self.min_wait = min_wait_ms / 1000.0
+        self.timeout = timeout_ms / 1000.0
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wiz_stable_grab")
+
+        self.grabs = 0
+        self.stable = 0
+        self.timeouts = 0
+
+    def grab_stable(self, region):
+        """
+        安定したフレームを1枚返す（呼び出しスレッドで待つ）。
+        Returns: (image, info)  info = {"frames", "stable", "changed", "wait_ms", "ratio"}
+          changed = 最初のフレームからの変化を見たか
+        """
+        t0 = time.perf_counter()
+        first = prev = self.backend.grab_sample(region, self.step)
+        frames, ratio, stable, changed, calm = 1, 1.0, False, False, 0
+        while time.perf_counter() - t0 < self.timeout:
+            time.sleep(self.interval)
+            cur = self.backend.grab_sample(region, self.step)
+            frames += 1
+            if not changed and changed_ratio(first, cur, self.tolerance) > self.max_changed:
+                changed = True
+            ratio = changed_ratio(prev, cur, self.tolerance)
+            calm = calm + 1 if ratio <= self.max_changed else 0
+            prev = cur
+            if calm >= self.settle_frames and (changed or time.perf_counter() - t0 >= self.min_wait):
+                stable = True
+                break
+        image = self.backend.last_image()
+        self.grabs += 1
+        if stable:
+            self.stable += 1
+        else:
+            self.timeouts += 1
+        info = {"frames": frames, "stable": stable, "changed": changed, "ratio": ratio,
+                "wait_ms": (time.perf_counter() - t0) * 1000.0}
+        return image, info
+
+    def submit(self, region, on_done):
+        """
+        grab_stable() を専用スレッドで実行し、on_done(image, info) を同じスレッドから呼ぶ。
+        Returns: 受け付けたら True
+        """
+        def work():
+            try:
+                image, info = self.grab_stable(region)
+            except Exception as e:
+                print(f"📛 安定フレーム取得失敗: {e}")
+                image, info = None, {"error": e}
+            on_done(image, info)
+        try:
+            self._pool.submit(work)
+        except RuntimeError:
+            return False  # shutdown 済み
+        return True
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {"grabs": self.grabs, "stable": self.stable, "timeouts": self.timeouts}
+
+
+# ──────────────────────────────
+_BACKENDS = {
+    BACKEND_GDI: GdiCaptureBackend,
+    BACKEND_PYAUTOGUI: PyAutoGuiCaptureBackend,
+    BACKEND_SYNTHETIC: SyntheticCaptureBackend,
+}
+
+
+def get_capture_backend(name=None):
+    """
+    名前からバックエンドを作る。None / "auto" は環境に合わせて選ぶ。
+    作成に失敗したら pyautogui にフォールバックする（合成フレームへは勝手に切り替えない）。
+    """
+    name = str(name or BACKEND_AUTO).strip().lower()
+    if name == BACKEND_AUTO:
+        name = BACKEND_GDI if sys.platform.startswith("win") else BACKEND_SYNTHETIC
+    order = [name] if name in (BACKEND_PYAUTOGUI, BACKEND_SYNTHETIC) else [name, BACKEND_PYAUTOGUI]
+    for n in order:
+        cls = _BACKENDS.get(n)
+        if cls is None:
+            print(f"⚠️ 不明なキャプチャバックエンド: {n}")
+            continue
+        try:
+            return cls()
+        except Exception as e:
+            print(f"⚠️ キャプチャバックエンド {n} を使えません: {e}")
+    raise RuntimeError("利用できるキャプチャバックエンドがありません")
@@ -0,0 +1,135 @@
+# ──────────────────────────────────────────────
+# 🗜 Wiz Codex: Storage codecs
+#
+# マップ画像の保存形式（settings.json: storage_codec / storage_level）。どれも可逆。
+#
+#   "png"  … map_{floor}f_{res}.png   PNG。level = compress_level（0〜9・既定 1 = 速度優先）
+#   "webp" … map_{floor}f_{res}.webp  可逆 WebP。level = method（0〜6・既定 0 = 速度優先）
+#   "raw"  … map_{floor}f_{res}.wzi   独自の生画素形式。level = zlib レベル（0 = 無圧縮・既定 1）
+#
+# ✅ .wzi（リトルエンディアン）:
+#   ヘッダ "<4s4sIIB3x"  magic "WZI1", mode（"RGB" 等・NUL 埋め）, width, height, level
+#   データ  画素そのまま（level 0）/ zlib 圧縮（level 1〜9）
+# - PNG のような行フィルタが無いぶん、エンコード・デコードとも軽い
+# - Pillow のプラグインとして登録するので、Image.open / image.save(format="WZI") がそのまま使える
+#   （読み込み側はこのモジュールを import しておくだけで、形式を意識しなくてよい）
+# - level 0 は Pillow が mmap で読む（デコード無し）
+#
+# ✅ StorageCodec:
+# - CaptureWriter の encoder（codec(image, fp)）としてそのまま渡せる
+# - ext は保存するファイルの拡張子。WebP が使えない Pillow では PNG にフォールバックする
+# ──────────────────────────────────────────────
+
+import zlib
+import struct
+
+from PIL import Image, ImageFile, features
+
+CODEC_PNG = "png"
+CODEC_WEBP = "webp"
+CODEC_RAW = "raw"
+CODEC_EXT = {CODEC_PNG: ".png", CODEC_WEBP: ".webp", CODEC_RAW: ".wzi"}
+DEFAULT_LEVEL = {CODEC_PNG: 1, CODEC_WEBP: 0, CODEC_RAW: 1}
+LEVEL_RANGE = {CODEC_PNG: (0, 9), CODEC_WEBP: (0, 6), CODEC_RAW: (0, 9)}
+FLOOR_EXTS = tuple(CODEC_EXT.values())
+WEBP_LOSSLESS_QUALITY = 0   # 可逆 WebP の quality は「圧縮の粘り」（0 = 最速）
+
+WZI_MAGIC = b"WZI1"
+WZI_FORMAT = "WZI"
+WZI_MODES = ("L", "RGB", "RGBA")
+_WZI_HEADER = struct.Struct("<4s4sIIB3x")
+_Tile = getattr(ImageFile, "_Tile", lambda *a: a)
+
+
+# ──────────────────────────────
+# .wzi（Pillow プラグイン）
+def _wzi_accept(prefix):
+    return prefix[:4] == WZI_MAGIC
+
+
+class WziImageFile(ImageFile.ImageFile):
+    format = WZI_FORMAT
+    format_description = "Wiz Codex raw image"
+
+    def _open(self):
+        head = self.fp.read(_WZI_HEADER.size)
+        if len(head) < _WZI_HEADER.size or not _wzi_accept(head):
+            raise SyntaxError("not a WZI file")
+        _, mode, width, height, level = _WZI_HEADER.unpack(head)
+        mode = mode.rstrip(b"\0").decode("ascii", "replace")
+        if mode not in WZI_MODES:
+            raise SyntaxError(f"unsupported WZI mode: {mode}")
+        self._mode = mode
+        self._size = (width, height)
+        self.info["level"] = level
+        codec = "raw" if level == 0 else "wzi_zlib"
+        self.tile = [_Tile(codec, (0, 0, width, height), _WZI_HEADER.size, (mode, 0, 1))]
+
+
+class WziZlibDecoder(ImageFile.PyDecoder):
+    _pulls_fd = True
+
+    def decode(self, buffer):
+        self.set_as_raw(zlib.decompress(self.fd.read()))
+        return -1, 0
+
+
+def _wzi_save(im, fp, filename):
+    if im.mode not in WZI_MODES:
+        raise OSError(f"cannot write mode {im.mode} as WZI")
+    level = int(im.encoderinfo.get("level", DEFAULT_LEVEL[CODEC_RAW]))
+    raw = im.tobytes()
+    fp.write(_WZI_HEADER.pack(WZI_MAGIC, im.mode.encode("ascii"), im.size[0], im.size[1], level))
+    fp.write(zlib.compress(raw, level) if level > 0 else raw)
+
+
+Image.register_open(WZI_FORMAT, WziImageFile, _wzi_accept)
+Image.register_save(WZI_FORMAT, _wzi_save)
+Image.register_extension(WZI_FORMAT, CODEC_EXT[CODEC_RAW])
+Image.register_decoder("wzi_zlib", WziZlibDecoder)
+
+
+# ──────────────────────────────
+def webp_available():
+    return bool(features.check("webp"))
+
+
+class StorageCodec:
+    """codec(image, fp) でエンコードする（CaptureWriter の encoder）"""
+
+    def __init__(self, name=CODEC_PNG, level=None):
+        name = str(name or CODEC_PNG).strip().lower()
+        if name not in CODEC_EXT:
+            print(f"⚠️ 不明な storage_codec: {name} → {CODEC_PNG}")
+            name = CODEC_PNG
+        if name == CODEC_WEBP and not webp_available():
+            print(f"⚠️ この Pillow は WebP に対応していません → {CODEC_PNG}")
+            name, level = CODEC_PNG, None
+        lo, hi = LEVEL_RANGE[name]
+        try:
+            level = DEFAULT_LEVEL[name] if level is None else max(lo, min(hi, int(level)))
+        except (TypeError, ValueError):
+            level = DEFAULT_LEVEL[name]
+        self.name = name
+        self.level = level
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get("storage_codec", CODEC_PNG), settings.get("storage_level"))
+
+    @property
+    def ext(self):
+        return CODEC_EXT[self.name]
+
+    def encode(self, image, fp):
+        if self.name == CODEC_PNG:
+            image.save(fp, format="PNG", compress_level=self.level)
+        elif self.name == CODEC_WEBP:
+            image.save(fp, format="WEBP", lossless=True, quality=WEBP_LOSSLESS_QUALITY, method=self.level)
+        else:
+            image.save(fp, format=WZI_FORMAT, level=self.level)
+
+    __call__ = encode
+
+    def __repr__(self):
+        return f"{self.name}:{self.level}"
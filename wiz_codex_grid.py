@@ -0,0 +1,254 @@
+# ──────────────────────────────────────────────
+# 🧭 Wiz Codex: Canonical cell grid
+#
+# 解像度に依存しない「セル座標」でマップ画像を扱うための変換。
+#
+# ✅ セル座標:
+# - 解像度プロファイルの map_origin_x/y（セル (0,0) の中心・画面座標。赤ポチの描画位置と同じ）と
+#   cell_size（1セルの画素数）で画面座標 ⇔ セル座標 (u, v) を相互変換する（v は上向き）
+#     x = corner_x + u * cell_size   （corner = セル (0,0) の左下 = origin から半セル左下）
+#     y = corner_y - v * cell_size
+#   セル (i, j) は u ∈ [i, i+1), v ∈ [j, j+1) の範囲
+#
+# ✅ 正規化グリッド（map_{floor}f_grid.png）:
+# - セル範囲 CANON_MIN_CELL 〜 CANON_MAX_CELL（全プロファイルのマップCrop を覆う）を
+#   1セル CANON_CELL_PX 画素で描いた正方形の画像。キャプチャ時にどの解像度からでもこの形に揃えて保存する
+# - 表示時は display_crop() の再標本化範囲（decode_crop の 6 要素 crop）で各プロファイルの
+#   マップCrop と同じ大きさ・位置の画像に戻す
+# - CANON_CELL_PX=32 は 1440p と同じ密度（それ以下の解像度からは劣化なし、2160p からは縮小）
+# - 形式は画像の大きさ（CANON_SIZE）で判別する。map_origin をセルの左下として扱っていた頃の
+#   グリッド（セル範囲 -2〜20・704 px）は is_canonical_grid() が False → 索引が破棄して作り直させる
+# ──────────────────────────────────────────────
+
+import os
+
+import numpy as np
+from PIL import Image
+
+CANON_CELL_PX = 32
+CANON_MIN_CELL = -2.0
+CANON_MAX_CELL = 21.0
+CANON_SIZE = int((CANON_MAX_CELL - CANON_MIN_CELL) * CANON_CELL_PX)
+
+
+def is_canonical_grid(size):
+    """(width, height) が今の形式の正規化グリッドか"""
+    return tuple(size) == (CANON_SIZE, CANON_SIZE)
+
+
+class GridGeometry:
+    """1つの解像度プロファイルのマップCrop とセル座標の対応"""
+    __slots__ = ("crop", "cell_size", "origin_x", "origin_y")
+
+    def __init__(self, crop, cell_size, origin_x, origin_y):
+        self.crop = tuple(crop)          # (left, top, right, bottom) 画面座標
+        self.cell_size = float(cell_size)
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+
+    @classmethod
+    def from_profile(cls, profile):
+        return cls(profile.map_crop.as_tuple(), profile.cell_size, profile.map_origin_x, profile.map_origin_y)
+
+    @property
+    def corner_x(self):
+        """セル (0,0) の左端（画面座標）"""
+        return self.origin_x - self.cell_size / 2
+
+    @property
+    def corner_y(self):
+        """セル (0,0) の下端（画面座標）"""
+        return self.origin_y + self.cell_size / 2
+
+    def screen_to_cell(self, x, y):
+        return (x - self.corner_x) / self.cell_size, (self.corner_y - y) / self.cell_size
+
+    def _canon(self, x, y):
+        """画面座標 → 正規化グリッド上の画素座標"""
+        u, v = self.screen_to_cell(x, y)
+        return (u - CANON_MIN_CELL) * CANON_CELL_PX, (CANON_MAX_CELL - v) * CANON_CELL_PX
+
+    def display_crop(self):
+        """
+        正規化グリッド → このプロファイルのマップCrop 画像 の再標本化範囲。
+        Returns: (x0, y0, x1, y1, width, height)  … decode_crop にそのまま渡せる
+        """
+        left, top, right, bottom = self.crop
+        x0, y0 = self._canon(left, top)
+        x1, y1 = self._canon(right, bottom)
+        clamp = lambda v: round(min(max(v, 0.0), float(CANON_SIZE)), 3)
+        return clamp(x0), clamp(y0), clamp(x1), clamp(y1), right - left, bottom - top
+
+    def normalize(self, image):
+        """このプロファイルのマップCrop 画像 → 正規化グリッド画像（範囲外は黒）"""
+        scale = self.cell_size / CANON_CELL_PX
+        left, top = self.crop[0], self.crop[1]
+        # 出力（グリッド）の画素 (cx, cy) → 入力（Crop 画像）の画素 (x, y) のアフィン係数
+        data = (scale, 0.0, self.corner_x - left + CANON_MIN_CELL * self.cell_size,
+                0.0, scale, self.corner_y - top - CANON_MAX_CELL * self.cell_size)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return image.transform((CANON_SIZE, CANON_SIZE), Image.AFFINE, data,
+                               resample=Image.BILINEAR, fillcolor=(0, 0, 0))
+
+
+# ──────────────────────────────
+# 🗺 探索済みセル・壁・扉の抽出（正規化グリッド画像 → セルごとのビット）
+#
+# - MAP_CELLS×MAP_CELLS のダンジョンを想定し、(MAP_CELLS+1)² の uint8 配列 [v, u] に保存する
+#   （東端・北端の辺のために1行1列多い。(u, v) は左下が (0, 0)）
+#     bit0 CELL_EXPLORED … セル内側の明るさが EXPLORED_LUM を超える（未踏は黒）
+#     bit1 CELL_WALL_W / bit2 CELL_WALL_S … セルの西辺・南辺の壁（東辺・北辺は隣のセルの西辺・南辺）
+#     bit3 CELL_DOOR_W / bit4 CELL_DOOR_S … 同じく扉（線の色が暖色 → 白い壁線と区別）
+# - 辺の判定: 辺に沿った幅 2*EDGE_HALF 画素の帯の最大輝度が、両側のセル内側より WALL_CONTRAST 以上明るい
+#   画素の割合（辺の中央 1/2 で数える）が WALL_COVERAGE 以上なら線あり
+# - 判定値は画面の配色に合わせた目安。合わない場合は定数を調整する
+# - 保存は map_{floor}f_cells.npy（numpy 形式・600 byte 弱）。画像をデコードせずにミニマップ等を描ける
+MAP_CELLS = 20
+CELLS_SUFFIX = "_cells.npy"
+
+CELL_EXPLORED = 0x01
+CELL_WALL_W = 0x02
+CELL_WALL_S = 0x04
+CELL_DOOR_W = 0x08
+CELL_DOOR_S = 0x10
+
+EDGE_NONE, EDGE_WALL, EDGE_DOOR = 0, 1, 2
+DIR_N, DIR_E, DIR_S, DIR_W = 0, 1, 2, 3   # menu_struct.read_dir() と同じ並び
+
+EXPLORED_LUM = 40
+WALL_CONTRAST = 48
+WALL_COVERAGE = 0.6
+DOOR_WARMTH = 48       # 線画素の R - B がこれを超えれば暖色（扉）
+EDGE_HALF = 2
+
+
+def cells_path(folder, floor):
+    return os.path.join(folder, f"map_{floor}f{CELLS_SUFFIX}")
+
+
+def _edge_lines(band, side_a, side_b, warm_band):
+    """
+    band: (辺の数, 辺に沿った画素) の最大輝度、side_a / side_b: 両側セルの内側輝度（同じ形に broadcast 可能）
+    Returns: (線あり bool 配列, 扉 bool 配列)
+    """
+    line = band > (np.maximum(side_a, side_b) + WALL_CONTRAST)[..., None]
+    coverage = line.mean(axis=-1)
+    has_line = coverage >= WALL_COVERAGE
+    warm = (line & warm_band).sum(axis=-1) > line.sum(axis=-1) // 2
+    return has_line & ~warm, has_line & warm
+
+
+def analyze_cells(grid_image, n=MAP_CELLS):
+    """正規化グリッド画像 → (n+1, n+1) uint8 のセル配列（ビットは上記）"""
+    rgb = np.asarray(grid_image.convert("RGB"), dtype=np.int32)
+    p = CANON_CELL_PX
+    c = CANON_SIZE // p
+    lum = (rgb[..., 0] * 299 + rgb[..., 1] * 587 + rgb[..., 2] * 114) // 1000
+    warm = (rgb[..., 0] - rgb[..., 2]) > DOOR_WARMTH
+    q0, q1 = p // 4, p - p // 4
+
+    # セル内側の平均輝度 [行(上から), 列]
+    interior = lum.reshape(c, p, c, p)[:, q0:q1, :, q0:q1].mean(axis=(1, 3))
+    explored = interior > EXPLORED_LUM
+
+    offsets = np.arange(-EDGE_HALF, EDGE_HALF)
+    # 縦の辺（列 e と e+1 の間・x = (e+1)*p）: [行, 辺, 行内の画素]
+    xs = (np.arange(1, c) * p)[:, None] + offsets
+    v_band = lum[:, xs].max(axis=-1).reshape(c, p, c - 1)[:, q0:q1, :].transpose(0, 2, 1)
+    v_warm = warm[:, xs].any(axis=-1).reshape(c, p, c - 1)[:, q0:q1, :].transpose(0, 2, 1)
+    v_wall, v_door = _edge_lines(v_band, interior[:, :-1], interior[:, 1:], v_warm)
+    # 横の辺（行 e と e+1 の間・y = (e+1)*p）: [辺, 列, 列内の画素]
+    ys = (np.arange(1, c) * p)[:, None] + offsets
+    h_band = lum[ys, :].max(axis=1).reshape(c - 1, c, p)[:, :, q0:q1]
+    h_warm = warm[ys, :].any(axis=1).reshape(c - 1, c, p)[:, :, q0:q1]
+    h_wall, h_door = _edge_lines(h_band, interior[:-1, :], interior[1:, :], h_warm)
+
+    # セル (v, u) → 正規化グリッドの 行 = CANON_MAX_CELL-1-v、列 = u-CANON_MIN_CELL
+    #   西辺 = 縦の辺 [行, 列-1]、南辺 = 横の辺 [行, 列]（画像からはみ出す辺は「無し」）
+    rows = (int(CANON_MAX_CELL) - 1 - np.arange(n + 1))[:, None]
+    cols = (np.arange(n + 1) - int(CANON_MIN_CELL))[None, :]
+
+    def pick(arr, r, k):
+        ok = (r >= 0) & (r < arr.shape[0]) & (k >= 0) & (k < arr.shape[1])
+        return ok & arr[np.clip(r, 0, arr.shape[0] - 1), np.clip(k, 0, arr.shape[1] - 1)]
+
+    inside = (rows <= int(CANON_MAX_CELL) - 1) & (rows > int(CANON_MAX_CELL) - 1 - n) & (cols < n - int(CANON_MIN_CELL))
+    cells = (np.where(inside & pick(explored, rows, cols), CELL_EXPLORED, 0)
+             | np.where(pick(v_wall, rows, cols - 1), CELL_WALL_W, 0)
+             | np.where(pick(v_door, rows, cols - 1), CELL_DOOR_W, 0)
+             | np.where(pick(h_wall, rows, cols), CELL_WALL_S, 0)
+             | np.where(pick(h_door, rows, cols), CELL_DOOR_S, 0))
+    return cells.astype(np.uint8)
+
+
+class CellGrid:
+    """セル配列の薄いラッパー（ImageCache に載せられるよう nbytes を持つ）"""
+    __slots__ = ("cells",)
+
+    def __init__(self, cells):
+        self.cells = cells
+
+    @property
+    def size(self):
+        return self.cells.shape[0] - 1
+
+    @property
+    def nbytes(self):
+        return int(self.cells.nbytes)
+
+    def explored(self, u, v):
+        return bool(self.cells[v, u] & CELL_EXPLORED)
+
+    def edge(self, u, v, direction):
+        """セル (u, v) の direction 側の辺 → EDGE_NONE / EDGE_WALL / EDGE_DOOR"""
+        if direction == DIR_N:
+            u, v, wall, door = u, v + 1, CELL_WALL_S, CELL_DOOR_S
+        elif direction == DIR_E:
+            u, v, wall, door = u + 1, v, CELL_WALL_W, CELL_DOOR_W
+        elif direction == DIR_S:
+            wall, door = CELL_WALL_S, CELL_DOOR_S
+        else:
+            wall, door = CELL_WALL_W, CELL_DOOR_W
+        bits = int(self.cells[v, u])
+        return EDGE_DOOR if bits & door else EDGE_WALL if bits & wall else EDGE_NONE
+
+    def explored_runs(self):
+        """探索済みセルを行ごとの連続区間にまとめる → [(v, u_start, u_end), ...]（描画アイテム数を減らす）"""
+        n = self.size
+        runs = []
+        flags = (self.cells[:n, :n] & CELL_EXPLORED) != 0
+        for v in range(n):
+            row = np.flatnonzero(np.diff(np.concatenate(([0], flags[v].view(np.int8), [0]))))
+            runs.extend((v, int(a), int(b)) for a, b in zip(row[::2], row[1::2]))
+        return runs
+
+    def edges(self, bit):
+        """bit（CELL_WALL_W 等）の立っている辺 → [(u, v), ...]"""
+        vs, us = np.nonzero(self.cells & bit)
+        return list(zip(us.tolist(), vs.tolist()))
+
+
+def save_cells(path, cells):
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            np.save(f, cells, allow_pickle=False)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def load_cells(path, n=MAP_CELLS):
+    """Returns: CellGrid / 無い・形が違えば None"""
+    try:
+        cells = np.load(path, allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+    if cells.dtype != np.uint8 or cells.shape != (n + 1, n + 1):
+        return None
+    return CellGrid(cells)
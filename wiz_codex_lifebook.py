@@ -43,7 +43,10 @@
 
 import tkinter as tk
 from tkinter import messagebox
-import pymem, ctypes, csv, os, sys
+import pymem, ctypes, csv, os, sys, multiprocessing
+
+from wiz_codex_statebus import ensure_state_publisher
+from wiz_codex_render import FrameScheduler
 
 # ──────────────────────────────
 VERBOSE = False  # ← 詳細ログ制御用
@@ -301,6 +304,12 @@ def update_party_hp_view(pm, struct_base, widgets):
         vprint(f"⚠️ read_party_hp 読み取り失敗 → {type(e).__name__}: {e}")
         return  # エラー時は表示を維持して中断
 
+    render_party_hp(ally_hp, widgets)
+
+def render_party_hp(ally_hp, widgets):
+    """
+    ally_hp: List[Tuple[cur_hp, max_hp]]（read_party_hp / StateSnapshot.party_hp）
+    """
     for (cur, maxhp), (cv, lbl) in zip(ally_hp, widgets):
         try:
             cv.delete("all")
@@ -455,39 +464,55 @@ def launch_hp_scan_gui():
     # --- HP モニタリング ---
     struct_base_holder = {}   # 一度だけ読み込み、ここに保持
 
+    # 🚌 state bus（Mapbook と共有の publisher が読み取り、共有メモリ経由で配信）
+    state_bus = ensure_state_publisher()
+
     def update_hp_ui():
         global pm_cache
         try:
-            pm = get_pm()                         # ← 直接取得
-            if "base" not in struct_base_holder:
-                struct_base_holder["base"] = load_struct_base()
+            snap = state_bus.read() if state_bus is not None else None
+            if snap is not None and snap.hp_valid:
+                # ✅ bus 経由（アタッチ・ゲームへのシステムコールなし）
+                enemy_hp = snap.enemy
+                ally_hp = snap.party_hp
+            else:
+                pm = get_pm()                     # ← 直接取得（bus 停止時のフォールバック）
+                if "base" not in struct_base_holder:
+                    struct_base_holder["base"] = load_struct_base()
 
-            base = struct_base_holder["base"]
+                base = struct_base_holder["base"]
+                enemy_hp = read_enemy_hp(pm, base)
+                ally_hp = None
 
             # 敵 HP 更新（-1 は ---- と表示）
-            enemy_hp = read_enemy_hp(pm, base)
             for g, var in enemy_labels:
                 text = "G{}: ".format(g) + " ".join(
                     f"{v:4}" if v >= 0 else "----" for v in enemy_hp[g]
                 )
                 var.set(text)
 
-            # 味方 HP 更新
-            update_party_hp_view(pm, base, party_widgets)
+            # 味方 HP 更新（grid_remove で隠している間は読み取り・描画とも省略）
+            if party_frame.winfo_ismapped():
+                if ally_hp is not None:
+                    render_party_hp(ally_hp, party_widgets)
+                else:
+                    update_party_hp_view(pm, base, party_widgets)
 
         except Exception as e:
             print(f"⚠️ update_hp_ui: エラー種別 → {type(e).__name__}, 内容 → {e!r}")
             pm_cache.pop("pm", None)
             struct_base_holder.pop("base", None)
 
-        root.after(TICK_MS, update_hp_ui)
-
 
 
-    update_hp_ui()
+    # 🎞 更新ループ（最小化中は停止し、復帰時の最初のフレームで追いつく）
+    scheduler = FrameScheduler(root, interval_ms=TICK_MS)
+    scheduler.register("hp", update_hp_ui, visible=root.winfo_viewable)
+    scheduler.start()
     root.mainloop()
 
 # ──────────────────────────────
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # EXE化時の state bus publisher 起動用
     launch_hp_scan_gui()
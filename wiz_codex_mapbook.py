@@ -6,11 +6,12 @@ import threading
 import time
 import sys
 import ctypes
-import re
+import multiprocessing
+import collections
+import queue
 
 # === 🧠 外部ライブラリ（要インストール）===
 import pymem
-import pyautogui
 from PIL import Image, ImageTk
 
 # === 🪟 Win32API 系（pywin32）===
@@ -20,9 +21,27 @@ import win32con
 
 # === 🖼️ GUI（Tkinter）===
 import tkinter as tk
-from tkinter import messagebox, ttk
+from tkinter import messagebox, ttk, filedialog
 from typing import List
 
+# === 🚌 共有ステートバス（wiz_codex_statebus.py）===
+from wiz_codex_statebus import ensure_state_publisher
+from wiz_codex_render import FrameScheduler, DirtyTracker
+from wiz_codex_mapcache import ImageCache, FloorPrefetcher, RawPixelCache, PaletteStore, MIP_LEVELS, build_pyramid, image_key, decode_crop, DEFAULT_CACHE_BYTES
+from wiz_codex_capture import get_capture_backend, StableFrameGrabber
+from wiz_codex_mapstore import (
+    list_floor_maps, record_capture, floor_source, floor_filename, parse_floor_filename, FULL_KIND, GRID_KIND,
+    get_scenario_index, phash_distance, CaptureWriter, CaptureJob, BlobStore,
+)
+from wiz_codex_grid import (
+    GridGeometry, CellGrid, analyze_cells, save_cells, load_cells, cells_path,
+    CELL_WALL_W, CELL_WALL_S, CELL_DOOR_W, CELL_DOOR_S,
+)
+from wiz_codex_atlas import AtlasLoader, export_atlas, import_atlas, ATLAS_EXT, CODECS as ATLAS_CODECS, CODEC_AUTO
+from wiz_codex_trail import VisitLog, HeatmapLayer
+from wiz_codex_thumbs import ThumbCache, ThumbPrefetcher, thumb_key, THUMB_KEY, THUMB_SIZE
+from wiz_codex_codec import StorageCodec
+
 # ================================
 # 📦 menu_state候補スキャナ機能：内包版
 # ================================
@@ -256,6 +275,7 @@ def run_menu_state_scan():
             wait: キー送信後のウェイト秒数（デフォルト0.5）
         """
         try:
+            import pyautogui   # キー送信はスキャン時だけ（起動時に重い import をしない）
             pyautogui.press(key)
             time.sleep(wait)
         except Exception as e:
@@ -494,6 +514,14 @@ class PathResolver:
     def scenario_dir(self, scenario_name: str) -> str:
         return self.data_path("map_images", scenario_name)
 
+    def blob_root(self) -> str:
+        # シナリオ一覧（map_images 直下のフォルダ）に混ざらないよう別フォルダ
+        return self.data_path("map_blobs")
+
+    def thumb_root(self) -> str:
+        # フロアのサムネイル（内容ハッシュ名）。blob と同じく map_images の外に置く
+        return self.data_path("map_thumbs")
+
     # --- assets ---
     def asset_path(self, *parts: str) -> str:
         return os.path.join(self.assets_root, *parts)
@@ -665,6 +693,46 @@ LANG_DICT = {
         "ja": "➕",
         "en": "➕"
     },
+    "btn_export_atlas": {
+        "ja": "📦",
+        "en": "📦"
+    },
+    "btn_import_atlas": {
+        "ja": "📥",
+        "en": "📥"
+    },
+    "btn_gallery": {
+        "ja": "🖼",
+        "en": "🖼"
+    },
+    "title_gallery": {
+        "ja": "フロア一覧",
+        "en": "Floor Gallery"
+    },
+    "gallery_empty": {
+        "ja": "（マップ画像なし）",
+        "en": "(no map images)"
+    },
+    "atlas_filetype": {
+        "ja": "シナリオ atlas",
+        "en": "Scenario atlas"
+    },
+    "info_title": {
+        "ja": "お知らせ",
+        "en": "Notice"
+    },
+    "info_atlas_exported": {
+        "ja": "{count} フロアを書き出しました:\n{path}",
+        "en": "Exported {count} floors:\n{path}"
+    },
+    "info_atlas_imported": {
+        "ja": "シナリオ「{name}」を読み込みました（{count} フロア）",
+        "en": "Imported scenario \"{name}\" ({count} floors)"
+    },
+    "error_atlas_failed": {
+        "ja": "atlas の処理に失敗しました:\n{error}",
+        "en": "Atlas operation failed:\n{error}"
+    },
     "btn_capture": {
         "ja": "📸 現在のマップを保存",
         "en": "📸 Capture current map"
@@ -705,6 +773,10 @@ LANG_DICT = {
         "ja": "🗺 ミニマップ表示",
         "en": "🗺 Show minimap"
     },
+    "chk_show_visits": {
+        "ja": "👣 訪問ヒートマップ表示",
+        "en": "👣 Show visit heatmap"
+    },
     "title_minimap": {
         "ja": "ミニマップ表示",
         "en": "Minimap View"
@@ -856,9 +928,10 @@ class MenuStruct:
     OFFSET_FLOOR = 0x58
     OFFSET_DUNGEON_ID = 0x64  # 旧 dir_val 基準(+0x18) → menu_struct 基準(+0x4C+0x18)
 
-    def __init__(self, handle, base_addr: int):
+    def __init__(self, handle, base_addr: int, bus=None):
         self.handle = handle
         self.base = base_addr
+        self.bus = bus  # StateBusReader（None なら常に直接読み取り）
 
         self.addr_menu_state = base_addr + self.OFFSET_MENU_STATE
         self.addr_cursor = base_addr + self.OFFSET_CURSOR
@@ -868,31 +941,62 @@ class MenuStruct:
         self.addr_floor = base_addr + self.OFFSET_FLOOR
         self.addr_dungeon_id = base_addr + self.OFFSET_DUNGEON_ID
 
+    def _bus_snapshot(self):
+        """
+        state bus が生きていて同じ構造体を読めていればスナップショットを返す。
+        publisher がまだ読めていない（menu_valid=False）・別アドレスを見ている場合は None → 直接読む
+        """
+        if self.bus is None:
+            return None
+        snap = self.bus.read()
+        if snap is None or not snap.menu_valid or snap.menu_base != self.base:
+            return None
+        return snap
+
+    def _read(self, field, addr):
+        snap = self._bus_snapshot()
+        if snap is not None:
+            # ✅ bus 経由（ゲームへのシステムコールなし）
+            return getattr(snap, field)
+        return read_int(self.handle, addr)
+
+    def read_position(self):
+        """
+        (x, y, dir, floor) を返す。bus 経由なら1つのスナップショットから取るので、
+        フィールドごとに読むより値の組が食い違わない（1フレーム1回これを呼ぶ）
+        """
+        snap = self._bus_snapshot()
+        if snap is not None:
+            return snap.x, snap.y, snap.dir, snap.floor
+        return (read_int(self.handle, self.addr_x), read_int(self.handle, self.addr_y),
+                read_int(self.handle, self.addr_dir), read_int(self.handle, self.addr_floor))
+
     def read_menu_state(self):
-        return read_int(self.handle, self.addr_menu_state)
+        return self._read("menu_state", self.addr_menu_state)
 
     def read_dir(self):
-        return read_int(self.handle, self.addr_dir)
+        return self._read("dir", self.addr_dir)
 
     def read_x(self):
-        return read_int(self.handle, self.addr_x)
+        return self._read("x", self.addr_x)
 
     def read_y(self):
-        return read_int(self.handle, self.addr_y)
+        return self._read("y", self.addr_y)
 
     def read_floor(self):
-        return read_int(self.handle, self.addr_floor)
+        return self._read("floor", self.addr_floor)
 
     def read_dungeon_id(self):
-        return read_int(self.handle, self.addr_dungeon_id)
+        return self._read("dungeon_id", self.addr_dungeon_id)
 
     @property
     def all_values(self):
+        x, y, dir, floor = self.read_position()
         return {
-            "dir": self.read_dir(),
-            "x": self.read_x(),
-            "y": self.read_y(),
-            "floor": self.read_floor(),
+            "dir": dir,
+            "x": x,
+            "y": y,
+            "floor": floor,
             "dungeon_id": self.read_dungeon_id(),
         }
 
@@ -1012,8 +1116,79 @@ def load_auto_menu_struct_address():
 
 
 # --- 説明 ---
-# 指定されたシナリオ名に対応するフォルダ内から "_full.png" 形式のファイルをスキャンし、
-# フロア番号をキーとした辞書を返す。画像が壊れていても処理を継続する。
+# menu_state を専用スレッドで高頻度に読み、MAP_MENU_STATES への「突入」だけを通知する。
+# 読み取りバッファは使い回し（read_int のように毎回確保しない）。
+MENU_EDGE_RATE_HZ = 500   # 自動保存ON時の監視レート
+MENU_EDGE_IDLE_HZ = 2     # 自動保存OFF / 未接続時の待機レート
+MENU_EDGE_MAX_HZ = 2000.0  # settings.json の menu_edge_rate_hz の上限（これ以上は空回りに近い）
+
+class MenuStateEdgeDetector:
+    """
+    Parameters:
+        get_target: () -> (handle, addr) | None  … 監視対象（再スキャンで変わるため毎回取得）
+        is_armed:   () -> bool                   … False の間は読み取りせず待機レートで眠る
+        on_enter:   (old, new, ts) -> None       … MAP_MENU_STATES に入った瞬間に監視スレッドから呼ばれる
+                                                    ts は time.perf_counter() の値
+    ※ Python 3.11+ の Windows 版 time.sleep は高分解能タイマーを使うため ms 単位の間隔が有効。
+    """
+    def __init__(self, get_target, is_armed, on_enter, stop_event,
+                 states=MAP_MENU_STATES, rate_hz=MENU_EDGE_RATE_HZ, idle_hz=MENU_EDGE_IDLE_HZ):
+        self.get_target = get_target
+        self.is_armed = is_armed
+        self.on_enter = on_enter
+        self.stop_event = stop_event
+        self.states = frozenset(states)
+        # 0・負の値・inf は使えない（ZeroDivisionError / 空回り）→ 1〜MENU_EDGE_MAX_HZ に収める
+        self.interval = 1.0 / min(MENU_EDGE_MAX_HZ, max(1.0, rate_hz))
+        self.idle_interval = 1.0 / min(MENU_EDGE_MAX_HZ, max(1.0, idle_hz))
+
+        # 🔁 使い回す読み取りバッファ
+        self._buf = ctypes.c_int32()
+        self._read = ctypes.c_size_t()
+        self._buf_ref = ctypes.byref(self._buf)
+        self._read_ref = ctypes.byref(self._read)
+        self._rpm = ctypes.windll.kernel32.ReadProcessMemory
+
+        self.last_val = None
+        self.last_event = None  # (old, new, ts)
+        self.reads = 0
+        self.events = 0
+
+    def read_state(self, handle, addr):
+        if not self._rpm(handle, ctypes.c_void_p(addr), self._buf_ref, 4, self._read_ref):
+            return None
+        return self._buf.value
+
+    def run(self):
+        while not self.stop_event.is_set():
+            target = self.get_target() if self.is_armed() else None
+            if target is None:
+                self.last_val = None
+                time.sleep(self.idle_interval)
+                continue
+
+            val = self.read_state(*target)
+            self.reads += 1
+            if val is not None:
+                if val != self.last_val and val in self.states:
+                    ts = time.perf_counter()
+                    self.last_event = (self.last_val, val, ts)
+                    self.events += 1
+                    try:
+                        self.on_enter(self.last_val, val, ts)
+                    except Exception as e:
+                        print(f"[MenuStateEdgeDetector] 通知エラー: {e}")
+                self.last_val = val
+
+            time.sleep(self.interval)
+
+
+# --- 説明 ---
+# 指定されたシナリオ名に対応するフォルダのフロア画像（map_{floor}f_full.png / map_{floor}f_{res}.png）を、
+# フロア番号をキーとした辞書で返す（実際の読み込み元は MapApp._floor_source が解像度に応じて選ぶ）。
+# 拡張子は保存形式（.png / .webp / .wzi）のどれでもよい（読み込みは Image.open が形式を判別する）。
+# 一覧はフォルダ内の map_index.json（wiz_codex_mapstore）から引き、
+# フォルダの mtime が変わった時だけディレクトリを走査し直す。
 def find_floor_maps(scenario_name):
 
     folder = get_scenario_save_path(scenario_name)
@@ -1022,28 +1197,11 @@ def find_floor_maps(scenario_name):
         return {}
 
     try:
-        os.makedirs(folder, exist_ok=True)
-    except Exception as e:
-        print(f"📛 os.makedirs() 失敗: {e}")
-        return {}
-
-    images = {}
-    try:
-        for filename in os.listdir(folder):
-            if filename.endswith("_full.png"):
-                match = re.fullmatch(r"map_(\d+)f_full\.png", filename, re.IGNORECASE)
-                if match:
-                    try:
-                        floor = int(match.group(1))
-                        images[floor] = os.path.join(folder, filename)
-                    except Exception:
-                        continue
+        return list_floor_maps(folder)
     except Exception as e:
-        print(f"📛 os.listdir() 失敗: {e}")
+        print(f"📛 フロア一覧の取得に失敗: {e}")
         return {}
 
-    return dict(sorted(images.items()))
-
 
 
 # --- クロップ領域クラス定義（解像度別の画面切り出し範囲） ---
@@ -1242,6 +1400,25 @@ CURRENT_THEME = apply_theme_codex_dark # ✅ 初期テーマをここで指定
 
 
 # ====== マップ表示クラス ======
+RENDER_INTERVAL_MS = 100  # 描画フレーム間隔（旧: 各 tick_* が個別に 100ms）
+MINIMAP_VIEW_CELLS = 5    # ミニマップの表示範囲（セル数・等倍時）
+MINIMAP_MAX_ZOOM = MIP_LEVELS  # ミニマップの縮小段数（1/2, 1/4, 1/8）
+MINI_VECTOR_TAG = "mini_vector"  # 探索セルから描いたミニマップの図形（settings.json: minimap_vector）
+MINI_VECTOR_FLOOR = "#3a4660"
+MINI_VECTOR_WALL = "#f0f0f0"
+MINI_VECTOR_DOOR = "#ff9a30"
+VISIT_TRAIL_COLOR = "#ffd24a"  # 直近の移動経路（軌跡）
+VISIT_LAYER_CACHE = 6          # 保持するヒートマップ画像の数（フロア・解像度・倍率ごと）
+GALLERY_COLUMNS = 6       # ギャラリーの1行あたりのフロア数
+GALLERY_VISIBLE_ROWS = 4  # ギャラリーの初期の高さ（行数）
+GALLERY_PAD = 8
+GALLERY_LABEL_H = 18
+GALLERY_DRAIN = 16        # 1フレームに貼るサムネイルの最大数
+PREFETCH_SCENARIO_FLOORS = 3  # シナリオ切替時に先読みするフロア数
+CAPTURE_MODE_CROP = "crop"  # settings.json: capture_mode（マップ領域だけ保存）
+CAPTURE_MODE_FULL = "full"  # 画面全体も保存（旧形式互換）
+CAPTURE_LATENCY_HISTORY = 100  # 検出→保存の遅延を覚えておく件数
+
 class MapApp:
 
 
@@ -1249,20 +1426,27 @@ class MapApp:
         self.root = root  # GUIの司令塔。一括制御用に保持
         self.handle = handle
         self.addr_menu_state_base = addr_menu_state
-        self.menu_struct = MenuStruct(self.handle, addr_menu_state) if addr_menu_state is not None else None
+        # 🚌 state bus（publisher が1つのハンドルで読み取り、共有メモリ経由で配信）
+        self.state_bus = ensure_state_publisher()
+        self.menu_struct = MenuStruct(self.handle, addr_menu_state, bus=self.state_bus) if addr_menu_state is not None else None
         self.capturing = False
         self.minimap_window = None  # 切り替え先ウィンドウ用
+        self.gallery_window = None  # サムネイル一覧ウィンドウ
+        self._mini_src = None       # ミニマップ用デコード済みフロア画像 {"key", "region", "photo"}
 
         # --- thread control ---
         self._stop_event = threading.Event()
         # Tk変数は監視スレッドから触らないためのキャッシュ
         self._auto_capture_flag = False
+        self._last_map_trigger_ts = None  # 直近の MAP 遷移検出時刻（perf_counter）
 
         # --- 解像度プロファイル読み込み（差し替え）---
         self.update_resolution_profile()
 
-        # --- ミニマップ更新（自己再帰）---
-        self.tick_mini_map()
+        # --- 描画ループ（after() は FrameScheduler の1本だけ）---
+        self.frame_scheduler = FrameScheduler(root, interval_ms=RENDER_INTERVAL_MS)
+        self.map_dirty = DirtyTracker()  # メインマップの差分描画用
+        self.frame_scheduler.register("mini_map", self.tick_mini_map, visible=self._is_minimap_visible)
 
 
         # 🔽 既存シナリオ一覧を取得
@@ -1286,17 +1470,76 @@ class MapApp:
         # --- フロア画像とキャッシュの初期化 ---
         self.map_images = find_floor_maps(self.selected_scenario)
         self.current_floor = min(self.map_images.keys()) if self.map_images else 1
-        self.image_cache = {}
+        # 🗃 PIL 画像と PhotoImage を共通のバイト上限 LRU で保持（settings.json: image_cache_mb）
+        try:
+            cache_bytes = int(float(self._app_settings.get("image_cache_mb", DEFAULT_CACHE_BYTES >> 20)) * 1024 * 1024)
+        except Exception:
+            cache_bytes = DEFAULT_CACHE_BYTES
+        self.image_cache = ImageCache(cache_bytes)
+        # 🗜 切り抜き済み画素の無圧縮キャッシュ（settings.json: raw_cache）。PNG デコードを mmap に置き換える
+        self.raw_cache = RawPixelCache() if self._app_settings.get("raw_cache", True) else None
+        self._decode_floor = self.raw_cache.load if self.raw_cache is not None else decode_crop
+        # 📦 シナリオ atlas（.atlas/*.wzatlas）があればフロアを mmap から（settings.json: atlas_store）
+        self.atlas_loader = None
+        if self._app_settings.get("atlas_store", True):
+            self.atlas_loader = AtlasLoader(self._decode_floor)
+            self._decode_floor = self.atlas_loader.load
+        self._atlas_jobs = queue.Queue()   # 書き出し・読み込みの完了通知（"atlas" で UI に反映）
+        self._atlas_busy = False
+        # 🎨 共有パレットで1画素1byteに（settings.json: palette_cache）。RGB への展開は PhotoImage 作成時だけ
+        self.palette_store = None
+        if self._app_settings.get("palette_cache", True):
+            self.palette_store = PaletteStore(self._decode_floor)
+            self._decode_floor = self.palette_store.load
+        # 🧵 上下階・新シナリオのフロアを先読み（結果は FrameScheduler の "prefetch" でキャッシュへ）
+        self.prefetcher = FloorPrefetcher(loader=self._decode_floor)
+        # 🔍 ミニマップのズーム用縮小版（フロアごとに1回だけ作る・結果は "mipmap" でキャッシュへ）
+        self.mip_prefetcher = FloorPrefetcher(max_workers=1, loader=self._build_floor_pyramid)
+        self.frame_scheduler.register("mipmap", self._drain_mipmaps)
+        # 🗺 探索済みセル・壁・扉（map_{floor}f_cells.npy）が無い・古いフロアは裏で抽出（"cells" でキャッシュへ）
+        self.cells_prefetcher = FloorPrefetcher(max_workers=1, loader=self._build_floor_cells)
+        self.frame_scheduler.register("cells", self._drain_cells)
+        self._awaiting_floor_key = None  # 先読み完了待ちで表示保留中のフロア
+        self.frame_scheduler.register("prefetch", self._drain_prefetch)
+        # 💾 キャプチャ保存はバックグラウンドで（完了分は "capture_writer" で反映）
+        # 💾 画素ハッシュで重複を省く内容アドレス方式（settings.json: content_store）
+        # 🗜 保存形式（settings.json: storage_codec = png / webp / raw、storage_level）。読み込み側は形式を問わない
+        self.storage_codec = StorageCodec.from_settings(self._app_settings)
+        print(f"🗜 保存形式: {self.storage_codec}（{self.storage_codec.ext}）")
+        blobs = BlobStore(PATHS.blob_root(), ext=self.storage_codec.ext) if self._app_settings.get("content_store", True) else None
+        # 🖼 フロアのサムネイル（settings.json: thumb_cache）。キャプチャ時に書き込みスレッドで作る
+        self.thumbs = ThumbCache(PATHS.thumb_root()) if self._app_settings.get("thumb_cache", True) else None
+        self.capture_writer = CaptureWriter(encoder=self.storage_codec, blobs=blobs, thumbs=self.thumbs)
+        # 未作成のサムネイルはギャラリー表示時に裏で作る（結果は "thumbs" でキャッシュへ → ギャラリーに貼る）
+        self.thumb_prefetcher = ThumbPrefetcher(self.thumbs) if self.thumbs is not None else None
+        if self.thumb_prefetcher is not None:
+            self.frame_scheduler.register("thumbs", self._drain_thumbs)
+        # 📷 画面取得（settings.json: capture_backend）
+        self.capture_backend = get_capture_backend(self._app_settings.get("capture_backend"))
+        print(f"📷 キャプチャバックエンド: {self.capture_backend.name}")
+        self.stable_grabber = StableFrameGrabber(self.capture_backend)
+        self.capture_latencies = collections.deque(maxlen=CAPTURE_LATENCY_HISTORY)
+        self.frame_scheduler.register("capture_writer", self._drain_capture_writer)
+        self.frame_scheduler.register("atlas", self._drain_atlas_jobs)
+        # 👣 訪問ログ（map_{floor}f_visits.npy / _trail.bin・settings.json: visit_log）
+        #    位置が変わった時だけ記録し、ヒートマップ画像は変わったセルだけ塗り直す（"visits"）
+        self.visit_log = VisitLog() if self._app_settings.get("visit_log", True) else None
+        if self.visit_log is not None:
+            self.visit_log.set_folder(get_scenario_save_path(self.selected_scenario))
+        self._visit_layers = collections.OrderedDict()   # (floor, res, scale) → {"layer", "photo", "version"}
+        self.visit_uploads = 0   # ヒートマップ画像を Tk に転送した回数
 
         # ===============================
         # 📦 キャンバス構築（マップ＋ポチ）
         # ===============================
-        first_img = self.load_map_image(self.current_floor)
-        self.tk_img = ImageTk.PhotoImage(first_img)
+        self.tk_img = self.load_map_photo(self.current_floor)
         self.canvas = tk.Canvas(root, width=self.map_crop.width(), height=self.map_crop.height(), highlightthickness=1)
         self.canvas.pack(expand=True, fill="both", pady=(5, 0))
         self.canvas_img_id = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_img)
         self.canvas.image = self.tk_img  # 参照を保持してGCを防ぐ
+        # 👣 訪問ヒートマップ・軌跡（マップ画像と赤ポチの間に重ねる）
+        self.visit_overlay_id = self.canvas.create_image(0, 0, anchor=tk.NW, state="hidden")
+        self.visit_trail_id = self.canvas.create_line(0, 0, 0, 0, fill=VISIT_TRAIL_COLOR, width=2, state="hidden")
 
         self.marker = self.canvas.create_polygon(0, 0, 0, 0, 0, 0, fill="red")
         self.dir_text = self.canvas.create_text(10, 10, anchor=tk.NW, fill="white", font=("Arial", 12))
@@ -1335,6 +1578,16 @@ class MapApp:
         self.btn_add_scenario = tk.Button(self.scenario_row, text=get_ui_lang("btn_add_scenario"), width=3, command=self.on_add_scenario)
         self.btn_add_scenario.pack(side=tk.LEFT, padx=(5, 0))
 
+        self.btn_export_atlas = tk.Button(self.scenario_row, text=get_ui_lang("btn_export_atlas"), width=3, command=self.on_export_atlas)
+        self.btn_export_atlas.pack(side=tk.LEFT, padx=(5, 0))
+
+        self.btn_import_atlas = tk.Button(self.scenario_row, text=get_ui_lang("btn_import_atlas"), width=3, command=self.on_import_atlas)
+        self.btn_import_atlas.pack(side=tk.LEFT, padx=(5, 0))
+
+        self.btn_gallery = tk.Button(self.scenario_row, text=get_ui_lang("btn_gallery"), width=3, command=self.on_open_gallery,
+                                     state="normal" if self.thumbs is not None else "disabled")
+        self.btn_gallery.pack(side=tk.LEFT, padx=(5, 0))
+
         self.combo_scenario.bind("<<ComboboxSelected>>", self.on_select_scenario)
 
         # --- 🛠 操作メニュー ---
@@ -1402,6 +1655,7 @@ class MapApp:
 
         # ミニマップ表示トグル
         self.minimap_var = tk.BooleanVar(value=False)
+        self.minimap_zoom = tk.IntVar(value=0)  # 0=等倍, k=1/2**k（マウスホイールで切替）
         # ミニマップ制御用変数
         
         self.chk_show_minimap = tk.Checkbutton(
@@ -1412,6 +1666,15 @@ class MapApp:
         )
         self.chk_show_minimap.pack(anchor="w", pady=2)
 
+        # 訪問ヒートマップ表示トグル（記録は表示に関係なく続ける）
+        self.show_visits_var = tk.BooleanVar(value=True)
+        self.chk_show_visits = tk.Checkbutton(
+            frame_ops,
+            text=get_ui_lang("chk_show_visits"),
+            variable=self.show_visits_var,
+        )
+        self.chk_show_visits.pack(anchor="w", pady=2)
+
         # --- 🌐 言語切り替えボタン ---
         self.btn_lang_toggle = tk.Button(
             frame_ops,
@@ -1438,7 +1701,10 @@ class MapApp:
         self.set_window_icon()
 
         # --- 定期更新処理を開始 ---
-        self.tick_map_overlay()
+        # ウィンドウ最小化中は停止（ラベルもマップも見えないため）
+        self.frame_scheduler.register("map_overlay", self.tick_map_overlay, visible=self.root.winfo_viewable)
+        self.frame_scheduler.register("visits", self.tick_visits)
+        self.frame_scheduler.start()
 
         # ===============================
         # 💾 UI設定の復元 & 自動保存（settings.json）
@@ -1448,6 +1714,8 @@ class MapApp:
             self.auto_capture_enabled.set(bool(self._app_settings.get("auto_capture_enabled", self.auto_capture_enabled.get())))
             self.topmost_var.set(bool(self._app_settings.get("topmost", self.topmost_var.get())))
             self.minimap_var.set(bool(self._app_settings.get("minimap", self.minimap_var.get())))
+            self.minimap_zoom.set(max(0, min(MINIMAP_MAX_ZOOM, int(self._app_settings.get("minimap_zoom", 0)))))
+            self.show_visits_var.set(bool(self._app_settings.get("show_visits", self.show_visits_var.get())))
             self.marker_offset_x_cells.set(float(self._app_settings.get("marker_offset_x_cells", self.marker_offset_x_cells.get())))
             self.marker_offset_y_cells.set(float(self._app_settings.get("marker_offset_y_cells", self.marker_offset_y_cells.get())))
         except Exception as e:
@@ -1473,6 +1741,8 @@ class MapApp:
             self.auto_capture_enabled,
             self.topmost_var,
             self.minimap_var,
+            self.minimap_zoom,
+            self.show_visits_var,
             self.marker_offset_x_cells,
             self.marker_offset_y_cells,
         ):
@@ -1505,6 +1775,8 @@ class MapApp:
                 "auto_capture_enabled": bool(self.auto_capture_enabled.get()),
                 "topmost": bool(self.topmost_var.get()),
                 "minimap": bool(self.minimap_var.get()),
+                "minimap_zoom": int(self.minimap_zoom.get()),
+                "show_visits": bool(self.show_visits_var.get()),
                 "marker_offset_x_cells": float(self.marker_offset_x_cells.get()),
                 "marker_offset_y_cells": float(self.marker_offset_y_cells.get()),
             })
@@ -1587,10 +1859,49 @@ class MapApp:
             self._stop_event.set()
         except Exception:
             pass
+        try:
+            self.frame_scheduler.stop()
+            print(f"🎞 frame stats: {self.frame_scheduler.stats()}")
+            print(f"🎞 map redraw stats: {self.map_dirty.stats()}")
+            print(f"🗃 image cache stats: {self.image_cache.stats()}")
+            print(f"🧵 prefetch stats: {self.prefetcher.stats()}")
+            if self.raw_cache is not None:
+                print(f"🗜 raw cache stats: {self.raw_cache.stats()}")
+            if self.atlas_loader is not None:
+                print(f"📦 atlas stats: {self.atlas_loader.stats()}")
+            if self.palette_store is not None:
+                for folder, st in self.palette_store.stats().items():
+                    print(f"🎨 {os.path.basename(folder) or '(root)'}: {st['indexed']}/{st['floors']} フロアをパレット化"
+                          f"（{st['colors']} 色）→ {st['saved_bytes'] / 1048576:.1f} MB 節約"
+                          f"（{st['raw_bytes'] / 1048576:.1f} → {st['bytes'] / 1048576:.1f} MB）")
+            if self.visit_log is not None:
+                self.visit_log.close()
+                print(f"👣 visit log stats: {self.visit_log.stats()} / ヒートマップ転送 {self.visit_uploads} 回")
+            self.prefetcher.shutdown()
+            self.mip_prefetcher.shutdown()
+            self.cells_prefetcher.shutdown()
+            if self.thumb_prefetcher is not None:
+                self.thumb_prefetcher.shutdown()
+                print(f"🖼 thumbnail stats: {self.thumbs.stats()} / prefetch: {self.thumb_prefetcher.stats()}")
+            self.capture_writer.close()
+            print(f"💾 capture writer stats: {self.capture_writer.stats()}")
+            print(f"📷 capture stats: {self.capture_backend.stats()} / stable: {self.stable_grabber.stats()}")
+            if self.capture_latencies:
+                lat = sorted(self.capture_latencies)
+                print(f"⏱ 自動キャプチャ 検出→保存: 平均 {sum(lat) / len(lat):.0f} ms / 最大 {lat[-1]:.0f} ms（{len(lat)} 件）")
+            self.stable_grabber.shutdown()
+            self.capture_backend.close()
+        except Exception:
+            pass
         try:
             self._close_process_handle()
         except Exception:
             pass
+        try:
+            if self.state_bus is not None:
+                self.state_bus.close()
+        except Exception:
+            pass
         try:
             self.root.destroy()
         except Exception:
@@ -1614,8 +1925,14 @@ class MapApp:
         self.chk_auto_capture.config(text=get_ui_lang("chk_auto_capture"))
         self.chk_topmost.config(text=get_ui_lang("chk_topmost"))
         self.chk_show_minimap.config(text=get_ui_lang("chk_show_minimap"))
+        self.chk_show_visits.config(text=get_ui_lang("chk_show_visits"))
         self.btn_open_folder.config(text=get_ui_lang("btn_open_folder"))
         self.btn_add_scenario.config(text=get_ui_lang("btn_add_scenario"))
+        self.btn_export_atlas.config(text=get_ui_lang("btn_export_atlas"))
+        self.btn_import_atlas.config(text=get_ui_lang("btn_import_atlas"))
+        self.btn_gallery.config(text=get_ui_lang("btn_gallery"))
+        if self.gallery_window is not None:
+            self.gallery_window.title(get_ui_lang("title_gallery"))
         self.btn_lang_toggle.config(text=f"🌐 : {CURRENT_LANG.upper()}")
 
 
@@ -1699,6 +2016,9 @@ class MapApp:
         self.selected_scenario = name
         # 選択状態は settings.json（_flush_save_settings）で保存
         self._schedule_save_settings()
+        if self.visit_log is not None:
+            self.visit_log.set_folder(get_scenario_save_path(name))
+            self._visit_layers.clear()
 
         self.reload_map_image()
         self.update_window_title()
@@ -1706,10 +2026,12 @@ class MapApp:
 
 
     def reload_map_image(self):
-        # キャッシュをクリアして現在のfloor画像を再読み込み
-        self.image_cache.clear()
+        # 現在のfloor画像を再読み込み
+        # ※ キャッシュは (path, mtime, crop, mode) キーなので消さない（別シナリオ・旧解像度の分も LRU に任せる）
         self.map_images = find_floor_maps(self.selected_scenario)
         self.current_floor = min(self.map_images.keys()) if self.map_images else 1
+        # 新シナリオの先頭フロアをまとめて先読み（switch_floor は届き次第表示）
+        self._prefetch_floors(list(self.map_images.keys())[:PREFETCH_SCENARIO_FLOORS])
         self.refresh_floor_buttons()
         self.switch_floor(self.current_floor)
         self.canvas.config(
@@ -1739,6 +2061,190 @@ class MapApp:
 
 
 
+    # --- 🖼 ギャラリー（全シナリオ・全フロアをサムネイルだけで一覧）---
+    # サムネイルは ThumbCache（内容ハッシュがキー）から ThumbPrefetcher が読み、"thumbs" で届いた順に貼る。
+    # 元の PNG をデコードするのはサムネイル未作成のフロア（古いキャプチャ）の初回だけ
+    def _gallery_sources(self, folder):
+        """フォルダ内の各フロア → [(floor, path, crop, sha1)]（読み込み元は表示と同じ）"""
+        index = get_scenario_index(folder)
+        out = []
+        for floor in index.floor_numbers():
+            path, kind = index.source(floor, self.current_res_key)
+            digest = thumb_key(index.entry(floor, kind))
+            if path and digest:
+                out.append((floor, path, self._crop_for_kind(kind), digest))
+        return out
+
+    def on_open_gallery(self):
+        if self.thumbs is None:
+            return
+        if self.gallery_window is not None and self.gallery_window.winfo_exists():
+            self.gallery_window.lift()
+            return
+        cell = THUMB_SIZE + GALLERY_PAD
+        row_h = cell + GALLERY_LABEL_H
+        width = GALLERY_COLUMNS * cell + GALLERY_PAD
+
+        win = self.gallery_window = tk.Toplevel(self.root, bg="#1a1a1a")
+        win.title(get_ui_lang("title_gallery"))
+        win.protocol("WM_DELETE_WINDOW", self._on_close_gallery)
+        canvas = self.gallery_canvas = tk.Canvas(win, width=width, height=row_h * GALLERY_VISIBLE_ROWS,
+                                                 bg="#1a1a1a", highlightthickness=0)
+        bar = tk.Scrollbar(win, orient=tk.VERTICAL, command=canvas.yview)
+        canvas.configure(yscrollcommand=bar.set)
+        bar.pack(side=tk.RIGHT, fill=tk.Y)
+        canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        for seq in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            win.bind(seq, self._on_gallery_wheel)
+
+        self._gallery_items = {}    # (THUMB_KEY, sha1) → [画像アイテム id]（同じ内容のフロアは1枚を共有）
+        self._gallery_photos = {}   # (THUMB_KEY, sha1) → PhotoImage（GC防止）
+        base = PATHS.scenario_root()
+        try:
+            names = sorted(n for n in os.listdir(base) if os.path.isdir(os.path.join(base, n)))
+        except OSError:
+            names = []
+        y = GALLERY_PAD
+        tile = 0
+        for name in names:
+            sources = self._gallery_sources(os.path.join(base, name))
+            canvas.create_text(GALLERY_PAD, y, anchor=tk.NW, text=name, fill="#dddddd", font=("Arial", 11, "bold"))
+            y += GALLERY_LABEL_H + 4
+            if not sources:
+                canvas.create_text(GALLERY_PAD, y, anchor=tk.NW, text=get_ui_lang("gallery_empty"), fill="#888888")
+                y += GALLERY_LABEL_H + GALLERY_PAD
+                continue
+            for i, (floor, path, crop, digest) in enumerate(sources):
+                row, col = divmod(i, GALLERY_COLUMNS)
+                x0, y0 = GALLERY_PAD + col * cell, y + row * row_h
+                tag = f"gallery_{tile}"
+                tile += 1
+                canvas.create_rectangle(x0, y0, x0 + THUMB_SIZE, y0 + THUMB_SIZE, outline="#444444", tags=tag)
+                item = canvas.create_image(x0 + THUMB_SIZE // 2, y0 + THUMB_SIZE // 2, anchor=tk.CENTER, tags=tag)
+                canvas.create_text(x0 + THUMB_SIZE // 2, y0 + THUMB_SIZE + 2, anchor=tk.N, text=f"{floor}F",
+                                   fill="#dddddd", tags=tag)
+                canvas.tag_bind(tag, "<Button-1>", lambda e, n=name, f=floor: self._on_gallery_click(n, f))
+                key = (THUMB_KEY, digest)
+                self._gallery_items.setdefault(key, []).append(item)
+                if key in self.image_cache:
+                    self._gallery_show(key)
+                else:
+                    self.thumb_prefetcher.request(key, path, crop)
+            y += -(-len(sources) // GALLERY_COLUMNS) * row_h + GALLERY_PAD
+        canvas.config(scrollregion=(0, 0, width, y))
+
+    def _gallery_show(self, key):
+        items = self._gallery_items.get(key) if self.gallery_window is not None else None
+        img = self.image_cache.get(key)
+        if not items or img is None:
+            return
+        photo = self._gallery_photos.get(key)
+        if photo is None:
+            photo = self._gallery_photos[key] = ImageTk.PhotoImage(img)
+        for item in items:
+            self.gallery_canvas.itemconfig(item, image=photo)
+
+    def _drain_thumbs(self):
+        for key in self.thumb_prefetcher.drain(self.image_cache, limit=GALLERY_DRAIN):
+            self._gallery_show(key)
+
+    def _on_gallery_wheel(self, event):
+        up = getattr(event, "delta", 0) > 0 or getattr(event, "num", None) == 4
+        self.gallery_canvas.yview_scroll(-1 if up else 1, "units")
+
+    def _on_gallery_click(self, name, floor):
+        """サムネイルのクリックでそのシナリオ・フロアを表示する"""
+        if name != self.selected_scenario:
+            self.combo_scenario.set(name)
+            self.on_select_scenario()
+        self.switch_floor(floor)
+
+    def _on_close_gallery(self):
+        if self.gallery_window is not None:
+            self.gallery_window.destroy()
+        self.gallery_window = None
+        self._gallery_items = {}
+        self._gallery_photos = {}
+
+    # --- シナリオ atlas の書き出し・読み込み ---
+    # どちらもファイル選択だけ UI スレッドで行い、画像の変換は別スレッドで実行する。
+    # 完了は self._atlas_jobs 経由で "atlas"（FrameScheduler）が受け取って反映する。
+    def _atlas_codec(self):
+        codec = str(self._app_settings.get("atlas_codec", CODEC_AUTO)).lower()
+        return codec if codec in ATLAS_CODECS else CODEC_AUTO
+
+    def _run_atlas_job(self, kind, func, *args):
+        if self._atlas_busy:
+            return
+        self._atlas_busy = True
+
+        def work():
+            t0 = time.perf_counter()
+            try:
+                result, error = func(*args), None
+            except Exception as e:
+                result, error = None, e
+            self._atlas_jobs.put((kind, result, error, (time.perf_counter() - t0) * 1000.0))
+
+        threading.Thread(target=work, name=f"atlas-{kind}", daemon=True).start()
+
+    def on_export_atlas(self):
+        folder = get_scenario_save_path(self.selected_scenario)
+        if folder is None or not self.map_images:
+            show_ui_warning("warning_input", "error_select_first", parent=self.root)
+            return
+        dest = filedialog.asksaveasfilename(
+            parent=self.root,
+            defaultextension=ATLAS_EXT,
+            initialfile=f"{self.selected_scenario or 'maps'}{ATLAS_EXT}",
+            filetypes=[(get_ui_lang("atlas_filetype"), f"*{ATLAS_EXT}")],
+        )
+        if not dest:
+            return
+        self._run_atlas_job("export", export_atlas, folder, self.current_res_key,
+                            self.map_crop.as_tuple(), dest, self._atlas_codec(), None,
+                            GridGeometry.from_profile(self.profile))
+
+    def on_import_atlas(self):
+        src = filedialog.askopenfilename(
+            parent=self.root,
+            filetypes=[(get_ui_lang("atlas_filetype"), f"*{ATLAS_EXT}")],
+        )
+        if not src:
+            return
+        self._run_atlas_job("import", import_atlas, src, PATHS.scenario_root(),
+                            None, MAX_SCENARIO_LENGTH, tuple(RESOLUTION_PROFILES))
+
+    def _drain_atlas_jobs(self):
+        try:
+            kind, result, error, elapsed_ms = self._atlas_jobs.get_nowait()
+        except queue.Empty:
+            return
+        self._atlas_busy = False
+        if error is not None:
+            print(f"📛 atlas {kind} 失敗: {error}")
+            show_ui_error("error_title", "error_atlas_failed", parent=self.root, error=error)
+            return
+        if kind == "export":
+            path, st = result
+            print(f"📦 atlas 書き出し: {st['floors']} フロア {st['bytes'] / 1048576:.1f} MB"
+                  f"（生画素 {st['raw_bytes'] / 1048576:.1f} MB・{st['codecs']}）{elapsed_ms:.0f} ms → {path}")
+            messagebox.showinfo(get_ui_lang("info_title"),
+                                get_ui_lang("info_atlas_exported", count=st["floors"], path=path),
+                                parent=self.root)
+        else:
+            folder, count = result
+            name = os.path.basename(folder)
+            print(f"📥 atlas 読み込み: {name}（{count} フロア）{elapsed_ms:.0f} ms")
+            values = list(self.combo_scenario["values"])
+            if name not in values:
+                self.combo_scenario["values"] = values + [name]
+            self.combo_scenario.set(name)
+            self.on_select_scenario()
+            messagebox.showinfo(get_ui_lang("info_title"),
+                                get_ui_lang("info_atlas_imported", name=name, count=count),
+                                parent=self.root)
+
     def open_scenario_folder(self):
         path = get_scenario_save_path(self.selected_scenario)
         try:
@@ -1765,41 +2271,190 @@ class MapApp:
 
     # --- 説明 ---
     # 指定されたフロアのマップ画像を読み込み、切り抜き処理を施して返す（キャッシュあり）
+    def _floor_source(self, floor):
+        """
+        フロア画像の読み込み元を返す → (path, crop)
+        - 現在の解像度プロファイルの切り抜き済みファイルがあれば crop=None（そのまま表示）
+        - 画面全体のファイルの方が新しければ crop=マップCrop（読み込み後に切り抜き済みへ移行する）
+        - 正規化グリッドの方が新しければ crop=再標本化範囲（6要素・同じく切り抜き済みへ移行する）
+          → 解像度を変えても再キャプチャ不要。各解像度の表示用ファイルは初回表示時に1回だけ作られる
+        """
+        filename = self.map_images.get(floor)
+        if not filename:
+            return None, None
+        path, kind = floor_source(os.path.dirname(filename), floor, self.current_res_key)
+        return path, self._crop_for_kind(kind)
+
+    def _crop_for_kind(self, kind):
+        """読み込み元の種類 → 表示用に切り抜く範囲（そのまま使えるなら None）"""
+        if kind == FULL_KIND:
+            return self.map_crop.as_tuple()
+        if kind == GRID_KIND:
+            return GridGeometry.from_profile(self.profile).display_crop()
+        return None
+
+    def _migrate_floor_image(self, path, crop, img):
+        """
+        画面全体 / 正規化グリッドのファイルから作った表示用画像を map_{floor}f_{res}.<保存形式> として保存する（バックグラウンド）。
+        次回からは元の PNG のデコード・再標本化をせずに済む。元ファイルは消さない。
+        """
+        if crop is None or img is None:
+            return
+        parsed = parse_floor_filename(os.path.basename(path))
+        if parsed is None or parsed[1] not in (FULL_KIND, GRID_KIND):
+            return
+        floor = parsed[0]
+        folder = os.path.dirname(path)
+        dest = os.path.join(folder, floor_filename(floor, self.current_res_key, self.storage_codec.ext))
+        # convert は常に新しい画像を返す（キャッシュ内の画像・mmap とは切り離す／画素ハッシュは RGB で揃える）
+        if self.capture_writer.submit(img.convert("RGB"), dest, floor=floor, folder=folder, kind="migrate"):
+            print(f"[🔁] 切り抜き済みファイルへ移行: {os.path.basename(path)} → {os.path.basename(dest)}")
+
     def load_map_image(self, floor):
         print(f"[🐾] load_map_image 呼び出し: floor={floor}")
 
-        if floor in self.image_cache:
+        path, crop = self._floor_source(floor)
+        key = image_key(path, crop, "RGB")
+        img = self.image_cache.get(key)
+        if img is not None:
             print(f"[📦] キャッシュヒット: {floor}")
-            return self.image_cache[floor]
+            return img
 
-        filename = self.map_images.get(floor)
-        print(f"[🔍] map_images[{floor}] = {filename}")
+        print(f"[🔍] map_images[{floor}] = {path}")
         
-        if not filename:
+        if not path or key is None:
             print(f"[⚠️] ファイル名が存在しない floor={floor}")
             return Image.new("RGB", (self.map_crop.width(), self.map_crop.height()))
 
-        full_path = filename
-        print(f"[📂] 読み込みパス: {full_path}")
+        print(f"[📂] 読み込みパス: {path}")
 
         try:
-            img = Image.open(full_path).crop(self.map_crop.as_tuple())
-            self.image_cache[floor] = img
-            return img
+            img = self._decode_floor(path, crop, "RGB")
+            self._migrate_floor_image(path, crop, img)
+            return self.image_cache.put(key, img)
         except Exception as e:
             print(f"[💥] 画像読み込み失敗: {e}")
             return Image.new("RGB", (self.map_crop.width(), self.map_crop.height()))
 
+    def load_map_photo(self, floor):
+        """
+        表示用 PhotoImage を返す（キャッシュあり）。
+        既出フロアなら PNG デコードも PIL→Tk 変換もしない。
+        """
+        path, crop = self._floor_source(floor)
+        key = image_key(path, crop, "tk")
+        photo = self.image_cache.get(key)
+        if photo is None:
+            photo = self.image_cache.put(key, ImageTk.PhotoImage(self.load_map_image(floor)))
+        return photo
+
 
 
+    # --- 説明 ---
+    # 指定フロアの上下階をバックグラウンドで先読みする
+    def _prefetch_floors(self, floors):
+        for f in floors:
+            path, crop = self._floor_source(f)
+            key = image_key(path, crop, "RGB")
+            if key is not None and key not in self.image_cache:
+                self.prefetcher.request(key, path, crop)
+
+    def _build_floor_pyramid(self, path, crop, mode="RGB"):
+        # mip_prefetcher のワーカースレッドで実行される
+        return build_pyramid(self._decode_floor(path, crop, mode))
+
+    def _request_mipmap(self, floor):
+        """フロアの縮小版をまだ作っていなければバックグラウンドで作らせる"""
+        path, crop = self._floor_source(floor)
+        key = image_key(path, crop, "mip")
+        if key is not None and key not in self.image_cache:
+            self.mip_prefetcher.request(key, path, crop)
+        return key
+
+    def _drain_mipmaps(self):
+        self.mip_prefetcher.drain(self.image_cache)
+
+    # --- 探索済みセル（CellGrid）---
+    def _cells_source(self, floor):
+        """探索セル抽出の元画像 → (path, crop)（正規化グリッドがあればそれ、無ければ表示用の読み込み元）"""
+        filename = self.map_images.get(floor)
+        if not filename:
+            return None, None
+        folder = os.path.dirname(filename)
+        e = get_scenario_index(folder).entry(floor, GRID_KIND)
+        if e is not None:
+            return os.path.join(folder, e["file"]), None
+        return self._floor_source(floor)
+
+    def _build_floor_cells(self, path, crop, mode="cells"):
+        # cells_prefetcher のワーカースレッドで実行される
+        floor, kind = parse_floor_filename(os.path.basename(path))
+        out = cells_path(os.path.dirname(path), floor)
+        try:
+            if os.path.getmtime(out) >= os.path.getmtime(path):
+                grid = load_cells(out)
+                if grid is not None:
+                    return grid
+        except OSError:
+            pass
+        if kind == GRID_KIND:
+            img = decode_crop(path, None, "RGB")
+        else:
+            img = GridGeometry.from_profile(self.profile).normalize(self._decode_floor(path, crop, "RGB"))
+        cells = analyze_cells(img)
+        try:
+            save_cells(out, cells)
+        except OSError as e:
+            print(f"[cells] 保存失敗: {os.path.basename(out)} → {e}")
+        return CellGrid(cells)
+
+    def _request_cells(self, floor):
+        """フロアの探索セルがキャッシュに無ければバックグラウンドで読み込み（または抽出）させる"""
+        path, crop = self._cells_source(floor)
+        key = image_key(path, crop, "cells")
+        if key is not None and key not in self.image_cache:
+            self.cells_prefetcher.request(key, path, crop)
+        return key
+
+    def _floor_cells(self, floor):
+        """Returns: CellGrid / まだ無ければ None（抽出を依頼する）"""
+        key = self._request_cells(floor)
+        return self.image_cache.get(key) if key is not None else None
+
+    def _drain_cells(self):
+        self.cells_prefetcher.drain(self.image_cache)
+
+    def _drain_prefetch(self):
+        """先読み完了分をキャッシュへ移し、表示待ちのフロアが届いていれば表示する"""
+        keys = self.prefetcher.drain(self.image_cache)
+        for key in keys:
+            path, _mtime, crop, _mode = key
+            if crop is not None:
+                self._migrate_floor_image(path, crop, self.image_cache.get(key))
+        awaiting = self._awaiting_floor_key
+        if awaiting is not None and (awaiting in keys or not self.prefetcher.is_pending(awaiting)):
+            self._awaiting_floor_key = None
+            # 読み込み失敗時も同期読み込み側でプレースホルダを出す（再リクエストのループを防ぐ）
+            self.switch_floor(self.current_floor, background=False)
+
     # --- 説明 ---
     # 指定されたフロアのマップ画像を読み込み、キャンバス上の画像を更新する
-    def switch_floor(self, floor):
+    # 未デコードならバックグラウンドで読み込み、届いた時点で表示する（UIスレッドで PNG をデコードしない）
+    def switch_floor(self, floor, background=True):
         self.current_floor = floor
-        img = self.load_map_image(floor)
-        if img:
+        path, crop = self._floor_source(floor)
+        key = image_key(path, crop, "RGB")
+        if background and key is not None and key not in self.image_cache and self.prefetcher.request(key, path, crop):
+            self._awaiting_floor_key = key
+            return
+        self._awaiting_floor_key = None
+
+        self._prefetch_floors((floor - 1, floor + 1))
+        self._request_mipmap(floor)
+        photo = self.load_map_photo(floor)
+        if photo:
             # マップ画像を更新
-            self.tk_img = ImageTk.PhotoImage(img)
+            self.tk_img = photo
             self.canvas.itemconfig(self.canvas_img_id, image=self.tk_img)
             self.canvas.image = self.tk_img # ガベージコレクション対策
             self.canvas.tag_lower(self.canvas_img_id) # 座標表示用のオーバーレイ要素などを前面に表示
@@ -1813,79 +2468,211 @@ class MapApp:
         - 赤ポチ（三角）の位置と向き
         - X/Y座標と方向ラベル
         - 現在のフロア表示（floor変更時のみスイッチ実行）
+        ※ FrameScheduler から毎フレーム呼ばれる（自前で after() しない）
+        ※ 各要素は入力値が前回描画時から変わった時だけ Tk を触る（map_dirty）
         """
+        dirty = self.map_dirty
         try:
             if not self.menu_struct:
-                self.floor_label.config(text=get_ui_lang("floor_label_loading"))
-                self.canvas.after(100, self.tick_map_overlay)
+                if dirty.changed("floor_label", ("loading", CURRENT_LANG)):
+                    self.floor_label.config(text=get_ui_lang("floor_label_loading"))
                 return
 
             # --- 情報取得 ---
-            x = self.menu_struct.read_x()
-            y = self.menu_struct.read_y()
-            direction = self.menu_struct.read_dir()
-            floor = self.menu_struct.read_floor()
+            x, y, direction, floor = self.menu_struct.read_position()
 
-            # --- 赤ポチ描画 ---
-            if x is not None and y is not None and direction is not None:
-                cell_width = self.profile.cell_size
-                cell_height = self.profile.cell_size
-                map_left = self.profile.map_origin_x - self.map_crop.left
-                map_bottom = self.profile.map_origin_y - self.map_crop.top
+            # ミニマップ表示中はメインキャンバスが pack_forget されている → マップ描画は止める
+            # （dirty 判定を消費しないので、再表示時に最新状態で1回だけ描き直される）
+            canvas_visible = self.canvas.winfo_ismapped()
 
+            # --- 赤ポチ描画（入力が変わった時だけ） ---
+            if x is not None and y is not None and direction is not None:
                 # ✅ 追加：セル単位オフセット（+X=右 / +Y=下）
                 ox = self.marker_offset_x_cells.get()
                 oy = self.marker_offset_y_cells.get()
 
-                cx = map_left + (x * cell_width) + (ox * cell_width)
-                cy = map_bottom - (y * cell_height) + (oy * cell_height)
+                if canvas_visible and dirty.changed("marker", (x, y, direction, ox, oy, self.current_res_key)):
+                    cell_width = self.profile.cell_size
+                    cell_height = self.profile.cell_size
+                    map_left = self.profile.map_origin_x - self.map_crop.left
+                    map_bottom = self.profile.map_origin_y - self.map_crop.top
 
-                size = self.profile.marker_size
+                    cx = map_left + (x * cell_width) + (ox * cell_width)
+                    cy = map_bottom - (y * cell_height) + (oy * cell_height)
 
-                if direction == 0:
-                    points = [cx, cy - size, cx - size, cy + size, cx + size, cy + size]
-                elif direction == 1:
-                    points = [cx + size, cy, cx - size, cy - size, cx - size, cy + size]
-                elif direction == 2:
-                    points = [cx, cy + size, cx - size, cy - size, cx + size, cy - size]
-                elif direction == 3:
-                    points = [cx - size, cy, cx + size, cy - size, cx + size, cy + size]
-                else:
-                    points = [cx - size, cy - size, cx + size, cy - size, cx, cy + size]
+                    size = self.profile.marker_size
+
+                    if direction == 0:
+                        points = [cx, cy - size, cx - size, cy + size, cx + size, cy + size]
+                    elif direction == 1:
+                        points = [cx + size, cy, cx - size, cy - size, cx - size, cy + size]
+                    elif direction == 2:
+                        points = [cx, cy + size, cx - size, cy - size, cx + size, cy - size]
+                    elif direction == 3:
+                        points = [cx - size, cy, cx + size, cy - size, cx + size, cy + size]
+                    else:
+                        points = [cx - size, cy - size, cx + size, cy - size, cx, cy + size]
 
-                self.canvas.coords(self.marker, *points)
+                    self.canvas.coords(self.marker, *points)
 
-                dir_names = get_ui_lang("dir_names")
-                dir_text = dir_names[direction] if 0 <= direction < len(dir_names) else f"? ({direction})"
-                self.label_dir_xy.config(text=get_ui_lang("label_dir_xy").format(dir=dir_text, x=x, y=y))
+                if dirty.changed("dir_label", (x, y, direction, CURRENT_LANG)):
+                    dir_names = get_ui_lang("dir_names")
+                    dir_text = dir_names[direction] if 0 <= direction < len(dir_names) else f"? ({direction})"
+                    self.label_dir_xy.config(text=get_ui_lang("label_dir_xy").format(dir=dir_text, x=x, y=y))
 
             # --- フロア変更チェック ---
-            if floor is not None and floor != getattr(self, "last_tick_floor", None):
-                self.switch_floor(floor)
-                if floor == 0:
-                    self.floor_label.config(text=get_ui_lang("floor_label_outside"))
-                else:
-                    self.floor_label.config(text=get_ui_lang("floor_label_fmt").format(floor=floor))
-                self.last_tick_floor = floor
+            if floor is not None:
+                if not canvas_visible:
+                    # 画像は作らずフロアだけ追従（ミニマップは current_floor を参照する）
+                    self.current_floor = floor
+                elif dirty.changed("floor_image", floor):
+                    self.switch_floor(floor)
+                if dirty.changed("floor_label", (floor, CURRENT_LANG)):
+                    if floor == 0:
+                        self.floor_label.config(text=get_ui_lang("floor_label_outside"))
+                    else:
+                        self.floor_label.config(text=get_ui_lang("floor_label_fmt").format(floor=floor))
 
         except Exception as e:
             print(f"[💥] tick_map_overlay エラー: {e}")
 
-        self.canvas.after(100, self.tick_map_overlay)
-
-
-
-    def capture_map_screenshot(self):
+    # --- 説明 ---
+    # パーティの位置を訪問ログに残し、ヒートマップと直近の軌跡をメインマップ・ミニマップに重ねる
+    def tick_visits(self):
         """
-        ゲームウィンドウの現在フロア画面をキャプチャし、
-        現在の選択シナリオのフォルダに "map_{floor}f_full.png" として保存する。
-        その後、画像リストとUIを更新。
+        位置（floor, x, y, dir）を VisitLog に記録し、表示中のマップにヒートマップ・軌跡を重ねる。
+        - 記録はセルが変わった時だけ（floor 0 = ダンジョン外は記録しない）
+        - ヒートマップ画像はフロア・倍率ごとに1回だけ描き、以降は回数が変わったセルだけ塗り直す
+        ※ FrameScheduler から毎フレーム呼ばれる（最小化中も記録は続け、描画だけ止める）
+        """
+        log = self.visit_log
+        if log is None or not self.menu_struct:
+            return
+        try:
+            x, y, direction, floor = self.menu_struct.read_position()
+            if None not in (x, y, direction, floor) and floor > 0:
+                hit = log.record(floor, x, y, direction)
+                if hit is not None:
+                    for (f, _, _), ent in self._visit_layers.items():
+                        if f == floor:
+                            ent["layer"].update_cell(x, y, hit[3])
+            log.maybe_flush()
+
+            show = bool(self.show_visits_var.get())
+            self._draw_visits_main(show)
+            if self._is_minimap_visible():
+                self._draw_visits_mini(show, x, y)
+        except Exception as e:
+            print(f"[💥] tick_visits エラー: {e}")
+
+    def _visit_layer(self, floor, scale):
+        """フロアのヒートマップ（マップCrop を scale 倍した座標系）。無ければ訪問回数から1回だけ描く"""
+        key = (floor, self.current_res_key, scale)
+        ent = self._visit_layers.get(key)
+        if ent is not None:
+            self._visit_layers.move_to_end(key)
+            return ent
+        fv = self.visit_log.floor(floor)
+        if fv is None:
+            return None
+        c = self.profile.map_crop
+        geometry = GridGeometry.from_profile(self.profile)
+        size = (max(1, int(round(c.width() * scale))), max(1, int(round(c.height() * scale))))
+        layer = HeatmapLayer(fv.counts, size, self.profile.cell_size * scale,
+                             (geometry.corner_x - c.left) * scale, (geometry.corner_y - c.top) * scale)
+        ent = self._visit_layers[key] = {"layer": layer, "photo": None, "version": -1}
+        while len(self._visit_layers) > VISIT_LAYER_CACHE:
+            self._visit_layers.popitem(last=False)
+        return ent
+
+    def _visit_photo(self, ent):
+        """ヒートマップの PhotoImage。塗り直しがあった時だけ paste で転送する"""
+        layer = ent["layer"]
+        if ent["photo"] is None:
+            ent["photo"] = ImageTk.PhotoImage(layer.image())
+            self.visit_uploads += 1
+        elif ent["version"] != layer.version:
+            ent["photo"].paste(layer.image())
+            self.visit_uploads += 1
+        ent["version"] = layer.version
+        return ent["photo"]
+
+    def _visit_trail_coords(self, floor, layer, dx, dy):
+        pts = []
+        for x, y in self.visit_log.floor(floor).recent:
+            px, py = layer.cell_center(x, y)
+            pts += (px + dx, py + dy)
+        if len(pts) == 2:
+            pts *= 2
+        return pts or [0, 0, 0, 0]
+
+    def _draw_visit_items(self, canvas, dirty, items, ent, floor, x0, y0):
+        """ヒートマップ画像を (x0, y0) に置き、軌跡を同じ座標系で描く（入力が変わった時だけ）"""
+        overlay_id, trail_id = items
+        if ent is None:
+            if dirty.changed("visits_state", "hidden"):
+                for item in items:
+                    canvas.itemconfig(item, state="hidden")
+            return
+        photo = self._visit_photo(ent)
+        if dirty.changed("visits_image", photo):
+            canvas.itemconfig(overlay_id, image=photo)
+        if dirty.changed("visits_pos", (x0, y0)):
+            canvas.coords(overlay_id, x0, y0)
+        fv = self.visit_log.floor(floor)
+        if dirty.changed("visits_trail", (photo, fv.version, x0, y0)):
+            canvas.coords(trail_id, *self._visit_trail_coords(floor, ent["layer"], x0, y0))
+        if dirty.changed("visits_state", "normal"):
+            for item in items:
+                canvas.itemconfig(item, state="normal")
+
+    def _draw_visits_main(self, show):
+        floor = self.current_floor
+        ent = None
+        if show and floor and floor > 0 and self.root.winfo_viewable() and self.canvas.winfo_ismapped():
+            ent = self._visit_layer(floor, 1.0)
+        # 赤ポチと同じセル単位オフセットで重ねる
+        cs = self.profile.cell_size
+        x0, y0 = self.marker_offset_x_cells.get() * cs, self.marker_offset_y_cells.get() * cs
+        self._draw_visit_items(self.canvas, self.map_dirty, (self.visit_overlay_id, self.visit_trail_id),
+                               ent, floor, x0, y0)
+
+    def _draw_visits_mini(self, show, x, y):
+        floor = self.current_floor
+        src = self._mini_src
+        ent = None
+        x0 = y0 = 0
+        if show and floor and floor > 0 and src is not None and x is not None and y is not None:
+            scale = float(src.get("scale", 1))
+            ent = self._visit_layer(floor, scale)
+            # マップCrop の左上がミニマップ上のどこに来るか（update_mini_map の画像配置と同じ式）
+            left, top = self._minimap_view_origin(x, y)
+            half = (int(self.profile.cell_size) * MINIMAP_VIEW_CELLS) // 2
+            c = self.profile.map_crop
+            x0, y0 = half - (left + half - c.left) * scale, half - (top + half - c.top) * scale
+        self._draw_visit_items(self.canvas_mini, self.mini_dirty, (self.mini_visit_overlay_id, self.mini_visit_trail_id),
+                               ent, floor, x0, y0)
+
+
+
+    def capture_map_screenshot(self, auto=False):
+        """
+        ゲームウィンドウの現在フロアのマップ領域をキャプチャし、
+        現在の選択シナリオのフォルダに "map_{floor}f_{res}.png"（res = 解像度プロファイル）として保存する
+        （拡張子・エンコードは settings.json の storage_codec に従う）。
+        settings.json の capture_mode が "full" の場合は従来どおり画面全体（map_{floor}f_full.png）も保存する。
+        ここでは画面の取得だけを行い、保存は CaptureWriter（別スレッド）で実施。
+        保存完了後に _on_capture_saved で画像リストとUIを更新。
+
+        auto=True（MAP 遷移検出からの自動キャプチャ）で stable_capture が有効なら、
+        StableFrameGrabber が描画の落ち着いた最初のフレームを別スレッドで確定する。
         """
         if self.capturing:
             print("⚠️ キャプチャ中のためスキップ")
             return
 
         self.capturing = True
+        handed_off = False  # 安定フレーム待ちに渡した場合は完了時に capturing を戻す
         try:
             if not self.menu_struct:
                 print("📛 DIRアドレス未設定：floorが読めないため、キャプチャ中止")
@@ -1904,13 +2691,13 @@ class MapApp:
             # --- クライアント領域のサイズと座標取得
             width, height = win32gui.GetClientRect(hwnd)[2:4]
             left, top = win32gui.ClientToScreen(hwnd, (0, 0))
-            region = (left, top, width, height)
-
-            try:
-                screenshot = pyautogui.screenshot(region=region)
-            except Exception as e:
-                print(f"📛 スクリーンショット取得に失敗しました: {e}")
-                return
+            c = self.map_crop
+            capture_full = self._capture_mode() == CAPTURE_MODE_FULL
+            if capture_full:
+                region = (left, top, width, height)
+            else:
+                # ✂️ マップ領域だけを取得（転送・エンコード・保存量が画面全体の数分の一で済む）
+                region = (left + c.left, top + c.top, c.width(), c.height())
 
             # --- 保存先パス構築（修正済）
             folder = get_scenario_save_path(self.selected_scenario)
@@ -1918,30 +2705,130 @@ class MapApp:
                 print("📛 保存先の取得に失敗しました。保存中止。")
                 return
 
-            filename = f"map_{floor}f_full.png"
-            save_path = os.path.join(folder, filename)
+            ext = self.storage_codec.ext
+            crop_path = os.path.join(folder, floor_filename(floor, self.current_res_key, ext))
+            full_path = os.path.join(folder, floor_filename(floor, FULL_KIND, ext)) if capture_full else None
+            crop = c.as_tuple()
+            # 🧭 解像度に依存しないセルグリッド版も保存（settings.json: normalized_store）
+            grid = None
+            if self._app_settings.get("normalized_store", True):
+                grid = (os.path.join(folder, floor_filename(floor, GRID_KIND, ext)), GridGeometry.from_profile(self.profile),
+                        cells_path(folder, floor) if self._app_settings.get("cell_analysis", True) else None)
+
+            if auto and self._stable_capture_enabled():
+                trigger_ts = self._last_map_trigger_ts
+
+                def on_stable(image, info):
+                    # ⚠️ 安定フレーム取得スレッドから呼ばれる（Tk には触らない）
+                    try:
+                        if image is None:
+                            return
+                        print(f"🖼 安定フレーム確定: {info['frames']} 枚 / {info['wait_ms']:.0f} ms"
+                              + ("" if info["stable"] else "（タイムアウト → 最終フレームを採用）"))
+                        self._submit_capture(image, floor, folder, crop_path, full_path, crop, trigger_ts, grid)
+                    finally:
+                        self.capturing = False
+
+                handed_off = self.stable_grabber.submit(region, on_stable)
+                if handed_off:
+                    return
 
             try:
-                screenshot.save(save_path, format="PNG")
-                print(f"📸 {filename} を保存しました")
-                print(f"📂 保存先: {folder}")
+                screenshot = self.capture_backend.grab(region)
             except Exception as e:
-                print(f"📛 スクリーンショット保存失敗: {e}")
+                print(f"📛 スクリーンショット取得に失敗しました: {e}")
                 return
 
-            # --- 🧠 キャッシュとUI更新
-            self.image_cache.clear()
-            self.map_images = find_floor_maps(self.selected_scenario)
-            self.refresh_floor_buttons()
-            self.switch_floor(floor)
+            self._submit_capture(screenshot, floor, folder, crop_path, full_path, crop, grid=grid)
 
         except Exception as e:
             print(f"📛 キャプチャ中に例外: {e}")
 
         finally:
-            self.capturing = False
-
+            if not handed_off:
+                self.capturing = False
 
+    def _submit_capture(self, screenshot, floor, folder, crop_path, full_path, crop, trigger_ts=None, grid=None):
+        """
+        💾 エンコード・書き込みは CaptureWriter に任せてすぐ戻る（どのスレッドから呼んでもよい）
+        （完了後の索引・キャッシュ・UI更新は _on_capture_saved）
+        full_path があれば screenshot は画面全体 → 両方保存、無ければ screenshot はマップ領域
+        grid = (path, GridGeometry, cells_path) なら正規化グリッド版も保存する（変換は書き込みスレッドで）
+        cells_path があればグリッド保存後に探索セルも抽出して保存する
+        """
+        jobs = []
+        if full_path:
+            # 画面全体 → グリッド → 切り抜き の順で書く（切り抜きの方が新しい mtime になり表示に使われる）
+            jobs.append(CaptureJob(screenshot, full_path, floor=floor, folder=folder, trigger_ts=trigger_ts))
+            screenshot = screenshot.crop(crop)
+        if grid is not None:
+            grid_path, geometry, cells_file = grid
+
+            def write_cells(job):
+                # ⚠️ 書き込みスレッドで実行（job.image は正規化済みグリッド）
+                if job.skipped and os.path.exists(cells_file):
+                    return
+                save_cells(cells_file, analyze_cells(job.image))
+
+            jobs.append(CaptureJob(screenshot, grid_path, floor=floor, folder=folder, kind="normalize",
+                                   prepare=geometry.normalize, after=write_cells if cells_file else None))
+        jobs.append(CaptureJob(screenshot, crop_path, floor=floor, folder=folder, trigger_ts=trigger_ts))
+        # 1回のキャプチャ分はまとめて予約（保存待ちの上限はキャプチャ単位・切り抜きだけ落ちることはない）
+        self.capture_writer.submit_group(jobs)
+
+    def _stable_capture_enabled(self):
+        return bool(self._app_settings.get("stable_capture", True))
+
+
+    def _capture_mode(self):
+        """settings.json の capture_mode（"crop" / "full"）。不明な値は "crop" 扱い"""
+        mode = str(self._app_settings.get("capture_mode", CAPTURE_MODE_CROP)).strip().lower()
+        return mode if mode in (CAPTURE_MODE_CROP, CAPTURE_MODE_FULL) else CAPTURE_MODE_CROP
+
+    def _drain_capture_writer(self):
+        for job in self.capture_writer.drain():
+            self._on_capture_saved(job)
+
+    def _on_capture_saved(self, job):
+        """CaptureWriter の保存完了時（UIスレッド）"""
+        if not job.ok:
+            return
+        filename = os.path.basename(job.path)
+        if job.kind in ("migrate", "normalize"):
+            # 移行・正規化グリッドは索引だけ更新（表示中の画像は同じ内容なので差し替えない）
+            if not job.skipped or job.entry is not None:
+                record_capture(job.folder, job.floor, job.path, job.entry)
+            if job.kind == "migrate" and not job.skipped:
+                print(f"🔁 {filename} へ移行しました（{job.elapsed_ms:.0f} ms）")
+            return
+        if job.skipped:
+            # 前回と同じ画素 → 書き込み・索引更新・キャッシュ破棄・再読み込みはすべて不要
+            print(f"📸 {filename} は前回と同じ内容のため保存を省略しました")
+            return
+        latency = job.latency_ms
+        if latency is not None:
+            # ⏱ MAP 遷移検出 → 保存完了 まで
+            self.capture_latencies.append(latency)
+            print(f"📸 {filename} を保存しました（保存 {job.elapsed_ms:.0f} ms / 検出から {latency:.0f} ms）")
+        else:
+            print(f"📸 {filename} を保存しました（{job.elapsed_ms:.0f} ms）")
+        print(f"📂 保存先: {job.folder}")
+
+        # --- 🗂 索引（map_index.json）を更新
+        parsed = parse_floor_filename(filename)
+        prev = get_scenario_index(job.folder).entry(job.floor, parsed[1]) if parsed else None
+        dist = phash_distance(prev.get("phash") if prev else None, job.phash)
+        if dist is not None:
+            print(f"🔍 前回との知覚ハッシュ距離: {dist}/64")
+        record_capture(job.folder, job.floor, job.path, job.entry)
+
+        # --- 🧠 キャッシュとUI更新（再キャプチャしたフロアの分だけ捨てる）
+        self.image_cache.invalidate_path(job.path)
+        if job.folder != get_scenario_save_path(self.selected_scenario):
+            return  # 保存中にシナリオが切り替わった
+        self.map_images = find_floor_maps(self.selected_scenario)
+        self.refresh_floor_buttons()
+        self.switch_floor(job.floor)
 
     # --- 説明 ---
     # DIRスキャン処理を非同期スレッドで実行する（GUIブロック回避のため）
@@ -1990,7 +2877,7 @@ class MapApp:
                 return
 
             # --- menu_state候補オブジェクト再構築（handle更新後の再注入）---
-            self.menu_struct = MenuStruct(self.handle, addr_menu_state)
+            self.menu_struct = MenuStruct(self.handle, addr_menu_state, bus=self.state_bus)
             print(f"[✅] menu_state_addr 更新 → {hex(addr_menu_state)}")
 
         except Exception as e:
@@ -2001,38 +2888,46 @@ class MapApp:
             show_ui_error("error_title", "error_rescan_failed", parent=self.root)
 
     def monitor_menu_state(self):
-        last_val = None
-        while not self._stop_event.is_set():
-            try:
-                # --- menu_structが未設定またはアドレス不正ならスキップ ---
-                if not self.menu_struct or self.menu_struct.addr_menu_state is None:
-                    time.sleep(0.6)
-                    continue
-
-                # ✅ Tk変数は監視スレッドから触らない（キャッシュ参照）
-                if not getattr(self, "_auto_capture_flag", False):
-                    time.sleep(0.6)
-                    continue
-
-                val = read_int(self.handle, self.menu_struct.addr_menu_state)
-
-                if val is None:
-                    # 読めない状態が一時的に起きるのは許容
-                    time.sleep(0.6)
-                    continue
-
-                # 🔁 menu_state 変化検出条件（MAP表示に関して）
-                if val in MAP_MENU_STATES and val != last_val:
-                    # ✅ UI処理は必ずメインスレッドへ投げる
-                    self.root.after(0, self.capture_map_screenshot)
+        """
+        自動キャプチャ用の menu_state 監視（別スレッドで実行）。
+        MenuStateEdgeDetector が MAP_MENU_STATES への遷移を検出したらキャプチャを予約する。
+        """
+        def get_target():
+            # --- menu_structが未設定またはアドレス不正ならスキップ ---
+            ms = self.menu_struct
+            if not ms or ms.addr_menu_state is None or not self.handle:
+                return None
+            return self.handle, ms.addr_menu_state
 
-                # ⛳ 状態追跡
-                last_val = val
+        def on_enter(old, new, ts):
+            print(f"🗺 menu_state {'-' if old is None else f'0x{old:X}'} → 0x{new:X}")
+            self._last_map_trigger_ts = ts
+            # ✅ UI処理は必ずメインスレッドへ投げる
+            self.root.after(0, lambda: self.capture_map_screenshot(auto=True))
 
+        rate_hz = MENU_EDGE_RATE_HZ
+        try:
+            rate_hz = float(self._app_settings.get("menu_edge_rate_hz", rate_hz))
+        except Exception:
+            pass
+        if not 1.0 <= rate_hz <= MENU_EDGE_MAX_HZ:   # NaN もここで弾く
+            print(f"⚠️ menu_edge_rate_hz={rate_hz} は範囲外（1〜{MENU_EDGE_MAX_HZ:.0f}）→ {MENU_EDGE_RATE_HZ}")
+            rate_hz = MENU_EDGE_RATE_HZ
+
+        self.menu_edge_detector = MenuStateEdgeDetector(
+            get_target=get_target,
+            # ✅ Tk変数は監視スレッドから触らない（キャッシュ参照）
+            is_armed=lambda: self._auto_capture_flag,
+            on_enter=on_enter,
+            stop_event=self._stop_event,
+            rate_hz=rate_hz,
+        )
+        while not self._stop_event.is_set():
+            try:
+                self.menu_edge_detector.run()
             except Exception as e:
                 print(f"[monitor_menu_state エラー] {e}")
-
-            time.sleep(0.6)
+                time.sleep(1.0 / MENU_EDGE_IDLE_HZ)
 
     def toggle_topmost_window(self):
         self.root.attributes("-topmost", self.topmost_var.get())
@@ -2042,9 +2937,7 @@ class MapApp:
         if self.minimap_var.get():
             self.canvas.pack_forget()
             self.create_minimap_window()
-
-            # 🔁 再スケジュール必須！！
-            self.tick_mini_map()  # ←★絶対に必要！
+            # 🔁 更新は FrameScheduler 登録済みの tick_mini_map が担当（ここで再起動しない）
 
         else:
             if self.minimap_window:
@@ -2062,8 +2955,7 @@ class MapApp:
 
     def create_minimap_window(self):
         cell_px = int(self.profile.cell_size)
-        view_mas = 5
-        view_px = cell_px * view_mas
+        view_px = cell_px * MINIMAP_VIEW_CELLS
 
         self.minimap_window = tk.Toplevel(self.root, bg="#1a1a1a")
         self.minimap_window.title(get_ui_lang("title_minimap"))
@@ -2101,136 +2993,263 @@ class MapApp:
         self.minimap_window.bind("<ButtonPress-1>", start_move)
         self.minimap_window.bind("<B1-Motion>", do_move)
 
+        # --- 画像・赤ポチは1つずつ作って使い回す（以降は coords / itemconfig のみ）---
+        self.canvas_img_mini_id = self.canvas_mini.create_image(0, 0, anchor=tk.NW, state="hidden")
+        self.mini_visit_overlay_id = self.canvas_mini.create_image(0, 0, anchor=tk.NW, state="hidden")
+        self.mini_visit_trail_id = self.canvas_mini.create_line(0, 0, 0, 0, fill=VISIT_TRAIL_COLOR, width=2, state="hidden")
+        self.mini_marker_id = self.canvas_mini.create_polygon(0, 0, 0, 0, 0, 0, fill="red")
+        self.mini_zoom_id = self.canvas_mini.create_text(4, 2, anchor=tk.NW, fill="#dddddd", text="")
+
+        # 🔍 ホイールでズーム（Windows/mac: MouseWheel, X11: Button-4/5）
+        for seq in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.minimap_window.bind(seq, self._on_minimap_wheel)
+        self.mini_dirty = DirtyTracker()
+        if self._mini_src is not None and self._mini_src.get("vector"):
+            self._mini_src = None   # 描画アイテムは新しいキャンバスに作り直す
+        if self._mini_src is not None:
+            self.canvas_mini.itemconfig(self.canvas_img_mini_id, image=self._mini_src["photo"])
+
         self.update_mini_map()
 
 
 
-    def crop_mini_map_image(self, floor):
+    def _on_minimap_wheel(self, event):
+        zoom_in = getattr(event, "delta", 0) > 0 or getattr(event, "num", None) == 4
+        z = self.minimap_zoom.get() + (-1 if zoom_in else 1)
+        self.minimap_zoom.set(max(0, min(MINIMAP_MAX_ZOOM, z)))
+
+    def _minimap_view_origin(self, x, y):
         """
-        通常マップと同じ基準中心（10,10）にプレイヤーを固定し、
-        プレイヤーが動いたらCrop範囲をずらす方式で、正確な追従を行う。
+        通常マップと同じ基準中心（10,10）にプレイヤーを固定したときの、
+        ミニマップ表示範囲の左上（フル画像座標）を返す。
         """
-        try:
-            full_path = self.map_images[floor]
-            img_full = Image.open(full_path).convert("RGBA")
-        except Exception as e:
-            print(f"[ミニマップ] 元画像読み込み失敗: {e}")
-            return None
-
-        # === プレイヤー座標取得 ===
-        x = self.menu_struct.read_x()
-        y = self.menu_struct.read_y()
-        if x is None or y is None:
-            return None
-
-        # === 中央基準をマップCropから取得 ===
         map_crop = self.profile.map_crop
         crop_cx = map_crop.left + (map_crop.width() // 2)
         crop_cy = map_crop.top + (map_crop.height() // 2)
 
         cell_px = int(self.profile.cell_size)
-        view_mas = 5
-        view_px = cell_px * view_mas
+        view_px = cell_px * MINIMAP_VIEW_CELLS
 
         # === プレイヤーの差分で中心を補正（10,10を基準とする） ===
-        dx = x - 9
-        dy = y - 9
-        px = crop_cx + dx * cell_px
-        py = crop_cy - dy * cell_px  # Y軸反転
-
-        # === Crop範囲 ===
-        left = px - (view_px // 2)
-        top = py - (view_px // 2)
-        right = left + view_px
-        bottom = top + view_px
-
-        bg = Image.new("RGBA", (view_px, view_px), (0, 0, 0, 0))
-
-        src_box = (
-            max(0, left),
-            max(0, top),
-            min(right, img_full.width),
-            min(bottom, img_full.height)
-        )
+        px = crop_cx + (x - 9) * cell_px
+        py = crop_cy - (y - 9) * cell_px  # Y軸反転
+        return px - (view_px // 2), py - (view_px // 2)
 
-        dst_box = (
-            max(0, -left),
-            max(0, -top)
-        )
+    def _load_minimap_mip(self, floor, zoom):
+        """
+        縮小版（MipPyramid）の該当段をそのまま載せる（リサイズはしない）。
+        まだ作られていなければ作成を依頼して False（その間は等倍で表示）
+        """
+        key = self._request_mipmap(floor)
+        pyramid = self.image_cache.get(key)
+        if pyramid is None or not pyramid.levels:
+            return False
+        level = min(zoom, len(pyramid.levels))
+        src_key = (key, level)
+        src = self._mini_src
+        if src is not None and src["key"] == src_key:
+            return True
+
+        photo_key = key[:3] + (f"mip{level}",)
+        photo = self.image_cache.get(photo_key)
+        if photo is None:
+            photo = self.image_cache.put(photo_key, ImageTk.PhotoImage(pyramid.level(level)))
+        c = self.profile.map_crop
+        self._clear_minimap_vector()
+        self._mini_src = {"key": src_key, "region": (c.left, c.top), "photo": photo, "scale": 0.5 ** level}
+        self.canvas_mini.itemconfig(self.canvas_img_mini_id, image=photo)
+        self.canvas_mini.image = photo  # GC防止
+        self.mini_dirty.invalidate("mini_pos")
+        return True
+
+    def _clear_minimap_vector(self):
+        if self._mini_src is not None and self._mini_src.get("vector"):
+            self.canvas_mini.delete(MINI_VECTOR_TAG)
+
+    def _load_minimap_vector(self, floor, zoom):
+        """
+        探索セル（CellGrid・数百 byte）からミニマップを図形で描く（settings.json: minimap_vector）。
+        画像はデコードしない。図形は MINI_VECTOR_TAG でまとめ、位置の更新は move 1回で済ませる。
+        まだ抽出されていなければ False（その間は画像で表示）
+        """
+        key = self._request_cells(floor)
+        grid = self.image_cache.get(key) if key is not None else None
+        if grid is None:
+            return False
+        src_key = (key, zoom, self.current_res_key)
+        src = self._mini_src
+        if src is not None and src["key"] == src_key:
+            return True
 
+        self._clear_minimap_vector()
+        canvas = self.canvas_mini
+        canvas.itemconfig(self.canvas_img_mini_id, image="")
+        p, c = self.profile, self.profile.map_crop
+        geometry = GridGeometry.from_profile(p)
+        s = 0.5 ** zoom
+        cs = p.cell_size * s
+        ox, oy = (geometry.corner_x - c.left) * s, (geometry.corner_y - c.top) * s   # セル (0,0) の左下
+        for v, a, b in grid.explored_runs():
+            canvas.create_rectangle(ox + a * cs, oy - (v + 1) * cs, ox + b * cs, oy - v * cs,
+                                    fill=MINI_VECTOR_FLOOR, outline="", tags=MINI_VECTOR_TAG)
+        width = max(1, int(round(2 * s)))
+        for bit, color in ((CELL_WALL_W, MINI_VECTOR_WALL), (CELL_DOOR_W, MINI_VECTOR_DOOR)):
+            for u, v in grid.edges(bit):
+                canvas.create_line(ox + u * cs, oy - v * cs, ox + u * cs, oy - (v + 1) * cs,
+                                   fill=color, width=width, tags=MINI_VECTOR_TAG)
+        for bit, color in ((CELL_WALL_S, MINI_VECTOR_WALL), (CELL_DOOR_S, MINI_VECTOR_DOOR)):
+            for u, v in grid.edges(bit):
+                canvas.create_line(ox + u * cs, oy - v * cs, ox + (u + 1) * cs, oy - v * cs,
+                                   fill=color, width=width, tags=MINI_VECTOR_TAG)
+        canvas.tag_raise(self.mini_visit_overlay_id)
+        canvas.tag_raise(self.mini_visit_trail_id)
+        canvas.tag_raise(self.mini_marker_id)
+        canvas.tag_raise(self.mini_zoom_id)
+        self._mini_src = {"key": src_key, "region": (c.left, c.top), "photo": "", "scale": s,
+                          "vector": True, "placed": (0, 0)}
+        self.mini_dirty.invalidate("mini_pos")
+        return True
+
+    def _load_minimap_source(self, floor):
+        """
+        ミニマップ用のフロア画像を1回だけデコードし、PhotoImage としてキャンバスに載せる。
+        - 範囲はマップCrop＋表示半径ぶんの余白（プレイヤーがどこにいても表示範囲を覆える）
+        - 切り抜き済みファイルは余白なしでそのまま載せる（範囲外はキャンバス背景）
+        - 同じファイル（mtime）・同じ解像度プロファイルなら何もしない
+        Returns: 画像を表示できる状態なら True
+        """
+        zoom = self.minimap_zoom.get()
+        if self._app_settings.get("minimap_vector", False) and self._load_minimap_vector(floor, zoom):
+            return True
+        if zoom > 0 and self._load_minimap_mip(floor, zoom):
+            return True
+        path, crop = self._floor_source(floor)
         try:
-            crop_part = img_full.crop(src_box)
-            bg.paste(crop_part, dst_box, crop_part)
-            return bg
-        except Exception as e:
-            print(f"[ミニマップ] 合成失敗: {e}")
-            return None
+            mtime = os.path.getmtime(path) if path else None
+        except OSError:
+            mtime = None
+        key = (path, mtime, self.current_res_key)
+
+        src = self._mini_src
+        if src is not None and src["key"] == key:
+            return True
+        if mtime is None:
+            return False
+
+        view_px = int(self.profile.cell_size) * MINIMAP_VIEW_CELLS
+        c = self.profile.map_crop
+        if crop is None or len(crop) == 6:
+            # 切り抜き済み（グリッドからの再標本化も同じ）: 画像全体がマップCrop の範囲
+            region, src_region = c.as_tuple(), crop
+        else:
+            margin = view_px // 2 + 1
+            # 範囲は画像サイズで切り詰めない（はみ出し部分は透明 → キャンバス背景）
+            region = src_region = (c.left - margin, c.top - margin, c.right + margin, c.bottom + margin)
+        cache_key = (path, mtime, src_region, "tk")
+        photo = self.image_cache.get(cache_key)
+        if photo is None:
+            try:
+                if src_region is not None and len(src_region) == 6:
+                    photo = ImageTk.PhotoImage(self._decode_floor(path, src_region, "RGBA"))
+                else:
+                    with Image.open(path) as img_src:
+                        img = img_src.convert("RGBA")
+                        photo = ImageTk.PhotoImage(img.crop(src_region) if src_region else img)
+            except Exception as e:
+                print(f"[ミニマップ] 元画像読み込み失敗: {e}")
+                return False
+            self.image_cache.put(cache_key, photo)
+            print(f"[ミニマップ] フロア画像をデコード: {floor}F {region}")
 
+        self._clear_minimap_vector()
+        self._mini_src = {"key": key, "region": region, "photo": photo}
+        self.canvas_mini.itemconfig(self.canvas_img_mini_id, image=photo)
+        self.canvas_mini.image = photo  # GC防止
+        self.mini_dirty.invalidate("mini_pos")
+        return True
 
     def update_mini_map(self):
+        """
+        ミニマップ更新。画像は作り直さず、プレイヤー位置に合わせて
+        キャンバス上の画像アイテムを coords で動かすだけ（定常時は画像確保ゼロ）。
+        """
         if not self.menu_struct or not hasattr(self, "canvas_mini"):
-            print("❌ menu_struct または canvas_mini が未定義")
             return
 
         if not self.canvas_mini.winfo_exists():
             print("[tick_mini_map] キャンバス破棄済み → 更新停止")
             return
 
-        x = self.menu_struct.read_x()
-        y = self.menu_struct.read_y()
-        dir = self.menu_struct.read_dir()
-        floor = self.current_floor
+        # フロアも同じスナップショットから読む（メインウィンドウ最小化中は tick_map_overlay が止まり current_floor が進まないため）
+        x, y, dir, floor = self.menu_struct.read_position()
+        if floor is None:
+            floor = self.current_floor
+        elif floor != self.current_floor and not self.root.winfo_viewable():
+            self.current_floor = floor   # 復元時は tick_map_overlay が floor_image の差分でメイン画像を切り替える
 
         if x is None or y is None or dir is None:
             return
 
-        img = self.crop_mini_map_image(floor)
-        if img is None:
+        dirty = self.mini_dirty
+        if dirty.changed("mini_floor", floor):
+            self._request_mipmap(floor)  # ズームしたときに即表示できるよう先に作っておく
+        if not self._load_minimap_source(floor):
+            if dirty.changed("mini_img_state", "hidden"):
+                self.canvas_mini.itemconfig(self.canvas_img_mini_id, state="hidden")
             return
+        if dirty.changed("mini_img_state", "normal"):
+            self.canvas_mini.itemconfig(self.canvas_img_mini_id, state="normal")
+
+        # ✅ 画像をスクロール（表示範囲の左上が (0,0) に来るよう逆方向に動かす）
+        #    縮小版ではプレイヤー位置も同じ倍率で縮めてから中央に合わせる
+        if dirty.changed("mini_pos", (x, y, self._mini_src["key"])):
+            left, top = self._minimap_view_origin(x, y)
+            half = (int(self.profile.cell_size) * MINIMAP_VIEW_CELLS) // 2
+            scale = self._mini_src.get("scale", 1)
+            rl, rt = self._mini_src["region"][:2]
+            x0, y0 = half - (left + half - rl) * scale, half - (top + half - rt) * scale
+            if self._mini_src.get("vector"):
+                px, py = self._mini_src["placed"]
+                self.canvas_mini.move(MINI_VECTOR_TAG, x0 - px, y0 - py)
+                self._mini_src["placed"] = (x0, y0)
+            else:
+                self.canvas_mini.coords(self.canvas_img_mini_id, x0, y0)
+
+        zoom = self.minimap_zoom.get()
+        if dirty.changed("mini_zoom", zoom):
+            self.canvas_mini.itemconfig(self.mini_zoom_id, text=f"×1/{2 ** zoom}" if zoom else "")
+            self.canvas_mini.tag_raise(self.mini_zoom_id)
+
+        # ✅ 赤ポチ描画（中央固定・向きが変わった時だけ）
+        if dirty.changed("mini_marker", (dir, self.current_res_key)):
+            cx = cy = (int(self.profile.cell_size) * MINIMAP_VIEW_CELLS) // 2
+            m = self.profile.marker_size
+            if dir == 0:
+                points = [cx, cy - m, cx - m, cy + m, cx + m, cy + m]
+            elif dir == 1:
+                points = [cx + m, cy, cx - m, cy - m, cx - m, cy + m]
+            elif dir == 2:
+                points = [cx, cy + m, cx - m, cy - m, cx + m, cy - m]
+            elif dir == 3:
+                points = [cx - m, cy, cx + m, cy - m, cx + m, cy + m]
+            else:
+                points = [cx - m, cy - m, cx + m, cy - m, cx, cy + m]
+            self.canvas_mini.coords(self.mini_marker_id, *points)
+            self.canvas_mini.tag_raise(self.mini_marker_id)
 
-        self.tk_img_mini = ImageTk.PhotoImage(img)
-
-        # ✅ 画像の再描画（itemconfig or 新規生成）
-        if hasattr(self, "canvas_img_mini_id") and self.canvas_mini.find_withtag(self.canvas_img_mini_id):
-            try:
-                self.canvas_mini.itemconfig(self.canvas_img_mini_id, image=self.tk_img_mini)
-            except Exception as e:
-                print(f"[update_mini_map] 再描画失敗: {e} → 新規作成に切り替え")
-                self.canvas_img_mini_id = self.canvas_mini.create_image(0, 0, image=self.tk_img_mini, anchor=tk.NW)
-        else:
-            self.canvas_img_mini_id = self.canvas_mini.create_image(0, 0, image=self.tk_img_mini, anchor=tk.NW)
-
-        self.canvas_mini.image = self.tk_img_mini  # GC防止
-
-        # ✅ 赤ポチ描画（中央固定）
-        cx = cy = img.width // 2
-        m = self.profile.marker_size
-        if dir == 0:
-            points = [cx, cy - m, cx - m, cy + m, cx + m, cy + m]
-        elif dir == 1:
-            points = [cx + m, cy, cx - m, cy - m, cx - m, cy + m]
-        elif dir == 2:
-            points = [cx, cy + m, cx - m, cy - m, cx + m, cy - m]
-        elif dir == 3:
-            points = [cx - m, cy, cx + m, cy - m, cx + m, cy + m]
-        else:
-            points = [cx - m, cy - m, cx + m, cy - m, cx, cy + m]
-
-        self.canvas_mini.delete("marker")
-        self.canvas_mini.create_polygon(*points, fill="red", tag="marker")
 
+    def _is_minimap_visible(self):
+        """ミニマップが開いていて最小化されていないか（FrameScheduler の visible 判定）"""
+        return (self.minimap_window is not None and hasattr(self, "canvas_mini")
+                and bool(self.canvas_mini.winfo_exists()) and bool(self.canvas_mini.winfo_viewable()))
 
     def tick_mini_map(self):
+        # ※ FrameScheduler から、ミニマップが見えている間だけ毎フレーム呼ばれる
         try:
-            if hasattr(self, "canvas_mini") and self.canvas_mini.winfo_exists():
-                self.update_mini_map()
+            self.update_mini_map()
         except Exception as e:
             print(f"[tick_mini_map] 例外: {e}")
 
-        # 🔁 ループ維持（必ず再スケジュール）
-        target = self.canvas_mini if hasattr(self, "canvas_mini") and self.canvas_mini.winfo_exists() else self.root
-        target.after(100, self.tick_mini_map)
-
 
 
 
@@ -2238,6 +3257,7 @@ class MapApp:
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # EXE化時の state bus publisher 起動用
     try:
         # ゲームのプロセスハンドルを取得
         handle = get_process_handle(WINDOW_TITLE)
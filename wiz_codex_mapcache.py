@@ -0,0 +1,475 @@
+# ──────────────────────────────────────────────
+# 🗃 Wiz Codex: Map image cache
+#
+# Mapbook のフロア画像（PIL 画像・Tk PhotoImage）をメモリ上に保持するキャッシュ。
+#
+# ✅ ImageCache:
+# - 上限はバイト数（budget_bytes）。超えたら最も古く使われたものから捨てる（LRU）
+# - キーは (path, mtime, crop, mode)。ファイルが書き換わると mtime が変わり自然に別キーになる
+# - invalidate_path() で再キャプチャしたファイルの分だけ捨てられる（他フロアは残る）
+# - mode="tk" で PhotoImage も同じ枠で管理 → 既出フロアはデコードも PIL→Tk 変換も不要
+#
+# ✅ FloorPrefetcher:
+# - 上下階・新シナリオの先頭フロアをスレッドプールでデコード＆切り抜き
+# - 結果はキューに積み、UIスレッドが drain() でキャッシュへ移す（Tk/キャッシュはUIスレッド専有）
+#
+# ✅ RawPixelCache:
+# - 切り抜き後の画素を無圧縮のまま <scenario>/.rawcache/ に保存し、次回からは
+#   mmap → Image.frombuffer（RGBA はコピーなし）で読む。PNG のデコードが要らない
+# - ファイル名に元 PNG の mtime を含める → PNG が書き換わると別名になり、初回読み込み時に作り直す
+#   （古いファイルは mmap されていなければ消す。Windows では使用中のファイルは消せないため）
+# - 正は常に PNG。.rawcache は消しても次回作り直されるだけ
+#
+# ✅ PaletteStore:
+# - マップ画面は色数が少ないので、シナリオごとの共有パレット（最大256色）で "P" 画像にして保持する
+#   （1画素 1byte。RGB の 1/3）。番号は色の完全一致で引く（可逆）。RGB への展開は表示時（PhotoImage 作成時）だけ
+# - 対象は mode="RGB" の読み込みだけ。RGBA などはそのまま返す
+#   （下位の RawPixelCache / AtlasLoader は RGB 要求にも RGBA を返すので、RGB にしてから変換する）
+# - パレットに収まらないフロアは元の画像のまま（劣化させない）
+# - シナリオごとの節約量を stats() で確認できる
+#
+# ✅ MipPyramid:
+# - フロア画像の 1/2・1/4・1/8 縮小版（ミニマップのズーム用）。FloorPrefetcher の loader として
+#   バックグラウンドで1回だけ作り、ImageCache に mode="mip" で入れる
+# ──────────────────────────────────────────────
+
+import os
+import mmap
+import queue
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import wiz_codex_codec  # .wzi（生画素形式）を Image.open で開けるようにする（Pillow プラグイン登録）
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+# PIL の mode → 1ピクセルあたりのバイト数（概算）
+_MODE_BYTES = {"1": 1, "L": 1, "P": 1, "LA": 2, "RGB": 3, "RGBA": 4, "I": 4, "F": 4}
+
+
+def image_key(path, crop, mode):
+    """
+    キャッシュキーを作る。ファイルが無ければ None。
+    crop: (left, top, right, bottom) などハッシュ可能な切り出し指定（無しなら None）
+    """
+    if not path:
+        return None
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    return (path, mtime, crop, mode)
+
+
+def estimate_nbytes(obj):
+    """PIL 画像 / PhotoImage のメモリ使用量の概算"""
+    try:
+        if isinstance(getattr(obj, "nbytes", None), int):         # MipPyramid / numpy 配列
+            return obj.nbytes
+        if hasattr(obj, "mode") and hasattr(obj, "size"):      # PIL.Image
+            w, h = obj.size
+            n = w * h * _MODE_BYTES.get(obj.mode, 4)
+            if obj.mode == "P":
+                n += 768                                      # パレット
+            return n
+        if hasattr(obj, "width") and hasattr(obj, "height"):  # ImageTk.PhotoImage
+            return obj.width() * obj.height() * 4
+    except Exception:
+        pass
+    return 0
+
+
+class ImageCache:
+    def __init__(self, budget_bytes=DEFAULT_CACHE_BYTES):
+        self.budget = budget_bytes
+        self._items = OrderedDict()   # key -> (value, nbytes)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key is not None and key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, nbytes=None):
+        if key is None:
+            return value
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._items[key] = (value, nbytes)
+            self.bytes += nbytes
+            self._evict()
+        return value
+
+    def _evict(self):
+        # 直前に入れた1件は上限超えでも残す（表示中の画像を即捨てない）
+        while self.bytes > self.budget and len(self._items) > 1:
+            _, (_, n) = self._items.popitem(last=False)
+            self.bytes -= n
+            self.evictions += 1
+
+    def invalidate_path(self, path):
+        """path に由来するエントリ（全 crop / mode / 旧 mtime）だけを捨てる"""
+        with self._lock:
+            drop = [k for k in self._items if k[0] == path]
+            for k in drop:
+                self.bytes -= self._items.pop(k)[1]
+        return len(drop)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._items),
+            "bytes": self.bytes,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def decode_crop(path, crop, mode="RGB"):
+    """
+    マップ画像（PNG / WebP / .wzi）を開いて crop → mode 変換した画像を返す（どのスレッドから呼んでもよい）
+    crop が6要素 (x0, y0, x1, y1, width, height) なら範囲を width×height に再標本化する
+    （正規化グリッドから各解像度の表示用画像を作るとき）
+    """
+    with Image.open(path) as src:
+        if crop is None:
+            img = src
+        elif len(crop) == 6:
+            img = src.resize((int(crop[4]), int(crop[5])), Image.BILINEAR, box=tuple(crop[:4]))
+        else:
+            img = src.crop(crop)
+        img = img.convert(mode)
+        img.load()
+        return img
+
+
+RAW_DIRNAME = ".rawcache"
+RAW_MAGIC = b"WZR1"
+_RAW_HEADER = struct.Struct("<4s8sIIQ4x")   # magic, mode, width, height, 元PNGの mtime_ns（32byte）
+
+
+class RawPixelCache:
+    """
+    decode_crop と同じ呼び出し方（loader）で使える、mmap による無圧縮画素キャッシュ。
+    RGB を要求されても RGBA で返す（frombuffer が共有できるのは 4byte/画素の形式のため）。
+    """
+    MODES = ("RGB", "RGBA")
+
+    def __init__(self):
+        self.hits = 0
+        self.builds = 0
+        self.fallbacks = 0
+        self.swept = 0
+
+    @staticmethod
+    def raw_path(path, crop, mtime_ns):
+        folder, name = os.path.split(path)
+        sig = "full" if crop is None else "_".join(f"{v:g}" for v in crop)
+        return os.path.join(folder, RAW_DIRNAME, f"{name}.{sig}.{mtime_ns}.raw")
+
+    def load(self, path, crop, mode="RGB"):
+        if mode not in self.MODES:
+            self.fallbacks += 1
+            return decode_crop(path, crop, mode)
+        mtime_ns = os.stat(path).st_mtime_ns
+        raw = self.raw_path(path, crop, mtime_ns)
+        img = self._map(raw)
+        if img is not None:
+            self.hits += 1
+            return img
+
+        img = decode_crop(path, crop, "RGBA")
+        try:
+            self._write(raw, img, mtime_ns)
+            self.builds += 1
+            self._sweep(raw)
+        except OSError as e:
+            print(f"[rawcache] 保存失敗: {os.path.basename(raw)} → {e}")
+        return img
+
+    def _map(self, raw):
+        try:
+            with open(raw, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None   # 無い / 空ファイル
+        try:
+            magic, mode, width, height, _ = _RAW_HEADER.unpack_from(mm, 0)
+            mode = mode.rstrip(b"\0").decode("ascii")
+            if magic != RAW_MAGIC or mode != "RGBA" or len(mm) != _RAW_HEADER.size + width * height * 4:
+                raise ValueError("header mismatch")
+            # mmap の参照は画像が持つ → キャッシュから捨てられた時点で解放される
+            return Image.frombuffer("RGBA", (width, height), memoryview(mm)[_RAW_HEADER.size:], "raw", "RGBA", 0, 1)
+        except Exception as e:
+            print(f"[rawcache] 破損のため無視: {os.path.basename(raw)} → {e}")
+            mm.close()
+            return None
+
+    @staticmethod
+    def _write(raw, img, mtime_ns):
+        os.makedirs(os.path.dirname(raw), exist_ok=True)
+        tmp = f"{raw}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(_RAW_HEADER.pack(RAW_MAGIC, img.mode.encode("ascii"), img.size[0], img.size[1], mtime_ns))
+                f.write(img.tobytes())
+            os.replace(tmp, raw)
+        finally:
+            if os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def _sweep(self, keep):
+        """同じ PNG・同じ crop の古い世代を消す（使用中で消せなければ次回）"""
+        folder, name = os.path.split(keep)
+        prefix = name.rsplit(".", 2)[0] + "."
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return
+        for n in names:
+            if n != name and n.startswith(prefix) and n.endswith(".raw"):
+                try:
+                    os.remove(os.path.join(folder, n))
+                    self.swept += 1
+                except OSError:
+                    pass
+
+    def stats(self):
+        return {"hits": self.hits, "builds": self.builds, "fallbacks": self.fallbacks, "swept": self.swept}
+
+
+PALETTE_COLORS = 256
+
+
+def _pack_rgb(a):
+    """uint8 [..., 3] → uint32 の 0xRRGGBB"""
+    return (a[..., 0].astype(np.uint32) << 16) | (a[..., 1].astype(np.uint32) << 8) | a[..., 2]
+
+
+class SharedPalette:
+    """1シナリオ内のフロアで共有するパレット（色は追加のみ・番号は変わらない）"""
+    def __init__(self):
+        self.colors = {}          # (r, g, b) -> index
+        self._flat = None         # putpalette 用（768 要素）
+        self._keys = None         # 0xRRGGBB の昇順
+        self._index = None        # _keys と同じ並びのパレット番号（uint8）
+        self._lock = threading.Lock()
+
+    def to_indexed(self, img):
+        """
+        img（RGB）を共有パレットの "P" 画像にする。収まらない・RGB 以外なら None。
+        番号は色の完全一致で引く（quantize の最近傍は近い色を潰すことがあるので使わない）
+        """
+        if img.mode != "RGB":
+            return None
+        found = img.getcolors(PALETTE_COLORS)
+        if found is None:
+            return None
+        with self._lock:
+            new = [c for _, c in found if c not in self.colors]
+            if len(self.colors) + len(new) > PALETTE_COLORS:
+                return None
+            if new or self._keys is None:
+                for c in new:
+                    self.colors[c] = len(self.colors)
+                ordered = sorted(self.colors, key=self.colors.get)
+                flat = [v for c in ordered for v in c]
+                keys = _pack_rgb(np.array(ordered, dtype=np.uint8).reshape(-1, 3))
+                order = np.argsort(keys)
+                self._flat = flat + [0] * (PALETTE_COLORS * 3 - len(flat))
+                self._keys = keys[order]
+                self._index = order.astype(np.uint8)
+            flat, keys, index = self._flat, self._keys, self._index
+        packed = _pack_rgb(np.asarray(img))
+        pos = np.minimum(np.searchsorted(keys, packed), len(keys) - 1)
+        if not np.array_equal(keys[pos], packed):
+            return None   # パレットに無い色（起こらないはず）→ 元の画像のまま
+        out = Image.frombytes("P", img.size, np.ascontiguousarray(index[pos]).tobytes())
+        out.putpalette(flat)
+        return out
+
+
+class PaletteStore:
+    """
+    loader（decode_crop / RawPixelCache.load）の結果を共有パレットの "P" 画像に変えて返す。
+    同じ呼び出し方で FloorPrefetcher の loader に使える。
+    """
+    def __init__(self, loader=decode_crop):
+        self.loader = loader
+        self._palettes = {}       # scenario folder -> SharedPalette
+        self._stats = {}          # scenario folder -> {(path, crop): (元のバイト数, 変換後のバイト数)}
+        self._lock = threading.Lock()
+
+    def palette(self, folder):
+        with self._lock:
+            pal = self._palettes.get(folder)
+            if pal is None:
+                pal = self._palettes[folder] = SharedPalette()
+            return pal
+
+    def load(self, path, crop, mode="RGB"):
+        img = self.loader(path, crop, mode)
+        if mode != "RGB":
+            return img    # RGBA などはそのまま（パレット化すると透明度が落ちる）
+        # RawPixelCache・atlas は RGB を要求されても RGBA（mmap 共有のため）で返す → 色だけ見る
+        rgb = img if img.mode == "RGB" else img.convert("RGB")
+        folder = os.path.dirname(path)
+        indexed = self.palette(folder).to_indexed(rgb)
+        out = indexed if indexed is not None else img
+        with self._lock:
+            self._stats.setdefault(folder, {})[(path, crop)] = (estimate_nbytes(img), estimate_nbytes(out))
+        return out
+
+    def stats(self):
+        """{scenario folder: {"floors", "indexed", "colors", "raw_bytes", "bytes", "saved_bytes"}}"""
+        with self._lock:
+            items = {folder: list(d.values()) for folder, d in self._stats.items()}
+            palettes = dict(self._palettes)
+        out = {}
+        for folder, vals in items.items():
+            raw = sum(v[0] for v in vals)
+            now = sum(v[1] for v in vals)
+            out[folder] = {
+                "floors": len(vals),
+                "indexed": sum(1 for v in vals if v[1] < v[0]),
+                "colors": len(palettes[folder].colors) if folder in palettes else 0,
+                "raw_bytes": raw,
+                "bytes": now,
+                "saved_bytes": raw - now,
+            }
+        return out
+
+
+MIP_LEVELS = 3   # 1/2, 1/4, 1/8
+
+
+class MipPyramid:
+    """levels[k-1] = 1/2**k に縮小した画像（等倍は持たない）"""
+    __slots__ = ("levels", "nbytes")
+
+    def __init__(self, levels):
+        self.levels = levels
+        self.nbytes = sum(estimate_nbytes(img) for img in levels)
+
+    def level(self, k):
+        """k 段目（1〜）。用意した段数を超えたら最も小さいもの"""
+        if not self.levels:
+            return None
+        return self.levels[max(1, min(k, len(self.levels))) - 1]
+
+
+def build_pyramid(img, levels=MIP_LEVELS):
+    """2×2 平均（Image.reduce）を繰り返して縮小版を作る。毎フレームのリサイズは不要になる"""
+    cur = img if img.mode in ("RGB", "RGBA") else img.convert("RGB")
+    out = []
+    for _ in range(levels):
+        if min(cur.size) < 2:
+            break
+        cur = cur.reduce(2)
+        out.append(cur)
+    return MipPyramid(out)
+
+
+class FloorPrefetcher:
+    def __init__(self, max_workers=2, loader=decode_crop):
+        self.loader = loader
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="wiz_prefetch")
+        self._done = queue.Queue()
+        self._pending = set()   # UIスレッドからのみ触る
+        self.requested = 0
+        self.delivered = 0
+        self.failed = 0
+
+    def is_pending(self, key):
+        return key in self._pending
+
+    def request(self, key, path, crop, mode="RGB"):
+        """
+        key の画像をバックグラウンドで読み込む（読み込み中なら何もしない）。
+        Returns: 読み込み中 / 受付済みなら True
+        """
+        if key is None:
+            return False
+        if key in self._pending:
+            return True
+        try:
+            self._pool.submit(self._work, key, path, crop, mode)
+        except RuntimeError:
+            return False  # shutdown 済み
+        self._pending.add(key)
+        self.requested += 1
+        return True
+
+    def _work(self, key, path, crop, mode):
+        try:
+            img = self.loader(path, crop, mode)
+        except Exception as e:
+            print(f"[prefetch] 読み込み失敗: {path} → {e}")
+            img = None
+        self._done.put((key, img))
+
+    def drain(self, cache, limit=4):
+        """
+        完了分を最大 limit 件キャッシュへ移す（UIスレッドから呼ぶ）。
+        Returns: 移したキーのリスト（失敗分は含めない）
+        """
+        keys = []
+        for _ in range(limit):
+            try:
+                key, img = self._done.get_nowait()
+            except queue.Empty:
+                break
+            self._pending.discard(key)
+            if img is None:
+                self.failed += 1
+                continue
+            cache.put(key, img)
+            self.delivered += 1
+            keys.append(key)
+        return keys
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "requested": self.requested,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "pending": len(self._pending),
+        }
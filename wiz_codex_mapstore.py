@@ -0,0 +1,797 @@
+# ──────────────────────────────────────────────
+# 💾 Wiz Codex: Map store
+#
+# シナリオフォルダ（map_images/<scenario>/）上のマップ画像の管理。
+#
+# ✅ ScenarioIndex（map_index.json）:
+# - フロア → ファイル名 / mtime / サイズ / 画像寸法 / 内容ハッシュ の一覧
+#   map_{floor}f_full.png   … ゲーム画面全体（旧形式）
+#   map_{floor}f_{res}.png  … 解像度プロファイル res（例: 1080p）のマップ領域だけ切り抜いたもの
+#   map_{floor}f_grid.png   … 解像度に依存しないセルグリッドへ正規化したもの（wiz_codex_grid）
+#                             res のファイルが無い・古ければここから再標本化して res のファイルを作る
+#   拡張子は保存形式（wiz_codex_codec: .png / .webp / .wzi）。同じフロア・種類が複数あれば新しい方を使う
+# - フォルダの mtime を記録しておき、一致する間はディレクトリを走査しない
+#   （メモリ上にも保持するので、2回目以降はフォルダの stat 1回だけ）
+# - キャプチャ時は record_capture() でそのフロアの項目だけ更新する
+#
+# - 参照・更新はインスタンスごとのロックで直列化する（UI スレッドの record_capture と
+#   atlas 書き出しスレッドの list_floor_maps / floor_source が同じ索引を触るため）
+#
+# ⚠️ map_index.json は「既存ファイルへの上書き」で保存する。
+#    新規作成・リネームはフォルダの mtime を変えてしまうため、
+#    ファイルが無い場合だけ先に空ファイルを作ってから mtime を記録する。
+#
+# ✅ CaptureWriter:
+# - キャプチャ画像の PNG エンコード → 一時ファイル書き込み → os.replace（原子的差し替え）を
+#   専用スレッドで行う。Tk スレッドは画面の取得だけで戻れる
+# - 同じファイルへの保存待ちが残っていれば最新の画像で置き換える（待ち行列は max_pending 件まで）
+# - 完了分は drain() で UI スレッドが受け取り、キャッシュ・索引を更新する
+#
+# ✅ BlobStore（内容アドレス方式）:
+# - 画像は画素のハッシュ（pixel_digest）を名前にした blob として1回だけ保存する
+#     <data>/map_blobs/ab/abcdef....png
+# - シナリオフォルダの map_{floor}f_{res}.png は blob へのハードリンク
+#   （作れないファイルシステムではコピー）。フォルダを開けば従来どおり画像が見える
+# - 前回と同じ画素なら書き込まない（job.skipped）。別シナリオの同じフロアは blob を共有する
+# - blob の拡張子は保存形式に合わせる（形式を変えると同じ画素でも別 blob として1回書き直す）
+# - 索引の項目には "blob"（画素ハッシュ）と "phash"（知覚ハッシュ・dHash 64bit）を記録する
+# - リンクしても mtime は触らない（inode を共有する他シナリオのキャッシュキーが変わってしまうため）。
+#   「いつこのフォルダに置いたか」は索引の "saved_ns" に持つ（source() の新旧判定に使う）
+# - どのシナリオからも参照されなくなった blob（リンク数 1）は書き込みスレッドの起動時に消す（collect）
+#   ハードリンクを作れずコピーした事がある（FAT・別ドライブ等・root に COPY_MARKER が残る）ストアでは
+#   リンク数で参照を判定できないので消さない
+# - コピーの場合は samefile で判定できないので、索引の項目（blob・mtime・サイズ）が一致すれば変化なしとする
+#
+# ✅ サムネイル（wiz_codex_thumbs）:
+# - thumbs=ThumbCache なら切り抜き済みフロアの保存直後に縮小版も作る（キーは索引項目の sha1）
+# ──────────────────────────────────────────────
+
+import os
+import re
+import json
+import time
+import queue
+import shutil
+import hashlib
+import threading
+
+from PIL import Image
+
+from wiz_codex_codec import FLOOR_EXTS
+from wiz_codex_thumbs import thumb_key
+from wiz_codex_grid import is_canonical_grid, cells_path
+
+INDEX_FILENAME = "map_index.json"
+INDEX_VERSION = 3   # 3: 旧形式の正規化グリッドを検出するため作り直す
+FLOOR_FILE_RE = re.compile(r"map_(\d+)f_(full|grid|\d+p)\.(png|webp|wzi)", re.IGNORECASE)
+RES_KEY_RE = re.compile(r"\d+p")
+FULL_KIND = "full"
+GRID_KIND = "grid"
+SCENARIO_NAME_FORBIDDEN = r'<>:"/\|?*'
+
+
+def is_res_key(kind):
+    """解像度キー（"1080p" 等・FLOOR_FILE_RE の res 部分と同じ形）か"""
+    return isinstance(kind, str) and RES_KEY_RE.fullmatch(kind) is not None
+
+
+def is_valid_scenario_name(name, max_length):
+    """シナリオ名（= map_images 直下のフォルダ名）として使えるか（シナリオ追加と同じ条件＋パス要素として安全か）"""
+    if not isinstance(name, str):
+        return False
+    name = name.strip()
+    return (0 < len(name) <= max_length
+            and not any(c in name for c in SCENARIO_NAME_FORBIDDEN)
+            and not any(ord(c) < 32 for c in name)
+            and name not in (".", "..")
+            and not name.endswith("."))   # Windows は末尾の "." を落とすため
+
+
+def floor_filename(floor, kind=FULL_KIND, ext=".png"):
+    """
+    kind: "full"（画面全体）/ "grid"（正規化グリッド）/ 解像度キー（"1080p" 等・切り抜き済み）
+    ext: 保存形式の拡張子（StorageCodec.ext）
+    """
+    return f"map_{floor}f_{kind}{ext}"
+
+
+def format_siblings(path):
+    """同じフロア・種類で拡張子（保存形式）だけ違うファイルのパス（存在するものだけ）"""
+    base, ext = os.path.splitext(path)
+    return [base + e for e in FLOOR_EXTS if e != ext.lower() and os.path.exists(base + e)]
+
+
+def parse_floor_filename(filename):
+    """Returns: (floor, kind) / 対象外なら None"""
+    match = FLOOR_FILE_RE.fullmatch(filename)
+    if not match:
+        return None
+    return int(match.group(1)), match.group(2).lower()
+
+_INDEX_MEMO = {}   # folder -> ScenarioIndex
+_INDEX_MEMO_LOCK = threading.Lock()
+
+
+def _memo_index(folder):
+    with _INDEX_MEMO_LOCK:
+        idx = _INDEX_MEMO.get(folder)
+        if idx is None:
+            idx = _INDEX_MEMO[folder] = ScenarioIndex(folder)
+        return idx
+
+
+def file_sha1(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _dir_mtime_ns(folder):
+    try:
+        return os.stat(folder).st_mtime_ns
+    except OSError:
+        return None
+
+
+def describe_file(path, prev=None):
+    """
+    1ファイル分の索引項目を作る。
+    prev（前回の項目）と mtime・サイズが同じならハッシュと寸法は再計算しない。
+    mtime だけ変わってファイル内容が同じなら blob / phash / saved_ns は引き継ぐ。
+    saved_ns = このフォルダに置いた時刻。blob へのリンクは mtime が blob 作成時のままなので、
+    書き込み側が saved_ns を入れる（無ければ mtime）
+    """
+    st = os.stat(path)
+    if prev and prev.get("mtime_ns") == st.st_mtime_ns and prev.get("size") == st.st_size:
+        return dict(prev, file=os.path.basename(path))
+    try:
+        with Image.open(path) as img:   # ヘッダだけ読む（デコードしない）
+            width, height = img.size
+    except Exception:
+        width = height = None
+    entry = {
+        "file": os.path.basename(path),
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "width": width,
+        "height": height,
+        "sha1": file_sha1(path),
+    }
+    if prev and prev.get("sha1") == entry["sha1"]:
+        for k in ("blob", "phash"):
+            if k in prev:
+                entry[k] = prev[k]
+        if "saved_ns" in prev:
+            entry["saved_ns"] = max(prev["saved_ns"], st.st_mtime_ns)
+    return entry
+
+
+def saved_ns(entry):
+    """索引項目の保存時刻（新旧判定用）"""
+    return entry.get("saved_ns", entry["mtime_ns"])
+
+
+class ScenarioIndex:
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, INDEX_FILENAME)
+        self.dir_mtime_ns = None
+        self.floors = {}   # floor(int) -> {kind("full" / "1080p" ...): 項目 dict}
+        self.rescans = 0
+        self._lock = threading.RLock()
+
+    # --- 参照 ---
+    def floor_paths(self):
+        """{floor: フルパス}（フロア昇順・画面全体があればそれを優先）"""
+        paths = {}
+        with self._lock:
+            for f, kinds in sorted(self.floors.items()):
+                e = kinds.get(FULL_KIND) or next(iter(kinds.values()), None)
+                if e is not None:
+                    paths[f] = os.path.join(self.folder, e["file"])
+        return paths
+
+    def floor_numbers(self):
+        with self._lock:
+            return sorted(self.floors)
+
+    def entry(self, floor, kind=FULL_KIND):
+        with self._lock:
+            return self.floors.get(floor, {}).get(kind)
+
+    def source(self, floor, res_key):
+        """
+        表示用の読み込み元を決める。
+        Returns: (path, kind) / 画像が無ければ (None, None)
+          kind == res_key   … そのまま表示
+          kind == FULL_KIND … 画面全体 → 切り抜いて使う
+          kind == GRID_KIND … 正規化グリッド → res_key の大きさに再標本化して使う
+          （どちらも呼び出し側で res_key の切り抜き済みファイルへ移行してよい）
+          それ以外          … 別解像度の切り抜きしか無い → そのまま表示（位置は合わない可能性あり）
+        - res_key の切り抜き済みファイルが画面全体・グリッドより新しければ（または両方無ければ）それを使う
+        - それ以外は画面全体とグリッドの新しい方（同時に保存した場合はグリッドの方が新しい）
+        """
+        with self._lock:
+            kinds = dict(self.floors.get(floor) or {})
+        crop_e = kinds.get(res_key)
+        masters = [e for e in (kinds.get(FULL_KIND), kinds.get(GRID_KIND)) if e is not None]
+        newest = max(masters, key=saved_ns) if masters else None
+        if crop_e is not None and (newest is None or saved_ns(crop_e) >= saved_ns(newest)):
+            return os.path.join(self.folder, crop_e["file"]), res_key
+        if newest is not None:
+            return os.path.join(self.folder, newest["file"]), parse_floor_filename(newest["file"])[1]
+        if kinds:
+            kind, e = next(iter(kinds.items()))
+            return os.path.join(self.folder, e["file"]), kind
+        return None, None
+
+    # --- 読み込み / 検証 ---
+    def refresh(self):
+        """フォルダの mtime が記録と違えば（または未読込なら）索引を作り直す"""
+        with self._lock:
+            current = _dir_mtime_ns(self.folder)
+            if current is not None and current == self.dir_mtime_ns:
+                return self
+            if self.dir_mtime_ns is None and self._load() and self.dir_mtime_ns == current:
+                return self
+            self.rescan()
+            return self
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                d = json.load(f)
+            if not isinstance(d, dict) or d.get("version") != INDEX_VERSION:
+                return False
+            self.dir_mtime_ns = d.get("dir_mtime_ns")
+            self.floors = {int(k): dict(v) for k, v in d.get("floors", {}).items()}
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"📛 {INDEX_FILENAME} 読み込み失敗（再構築します）: {e}")
+            return False
+
+    def rescan(self):
+        """ディレクトリを走査して索引を作り直し、保存する"""
+        with self._lock:
+            prev = self.floors
+            floors = {}
+            try:
+                names = os.listdir(self.folder)
+            except Exception as e:
+                print(f"📛 os.listdir() 失敗: {e}")
+                return self
+            for filename in names:
+                parsed = parse_floor_filename(filename)
+                if parsed is None:
+                    continue
+                floor, kind = parsed
+                try:
+                    entry = describe_file(os.path.join(self.folder, filename), prev.get(floor, {}).get(kind))
+                    if kind == GRID_KIND and not is_canonical_grid((entry["width"], entry["height"])):
+                        self._drop_stale_grid(floor, filename)
+                        continue
+                    other = floors.setdefault(floor, {}).get(kind)
+                    if other is None or saved_ns(entry) > saved_ns(other):
+                        floors[floor][kind] = entry   # 保存形式違いが残っていれば新しい方
+                except Exception as e:
+                    print(f"📛 索引作成失敗: {filename} → {e}")
+            self.floors = floors
+            self.rescans += 1
+            self.save()
+            return self
+
+    def _drop_stale_grid(self, floor, filename):
+        """
+        旧形式（セル原点の解釈を直す前）の正規化グリッドと、そこから作った探索セルを消す。
+        読み込むと半セルずれるので使わない。グリッドは次のキャプチャで、探索セルは次の表示時に
+        （切り抜き済み画像から）作り直される
+        """
+        for path in (os.path.join(self.folder, filename), cells_path(self.folder, floor)):
+            try:
+                os.remove(path)
+                print(f"🗑 旧形式の正規化グリッドを破棄: {os.path.basename(path)}")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"⚠️ 旧形式の正規化グリッドを削除できません（使わずに続行）: {os.path.basename(path)} → {e}")
+
+    # --- 更新 ---
+    def record(self, floor, path, entry=None):
+        """キャプチャ直後に呼ぶ。そのファイルの項目だけ作り直して保存する"""
+        with self._lock:
+            parsed = parse_floor_filename(os.path.basename(path))
+            kind = parsed[1] if parsed else FULL_KIND
+            kinds = self.floors.setdefault(floor, {})
+            try:
+                kinds[kind] = entry if entry is not None else describe_file(path)
+            except Exception as e:
+                print(f"📛 索引更新失敗: {path} → {e}")
+                kinds.pop(kind, None)
+                if not kinds:
+                    self.floors.pop(floor, None)
+            self.save()
+
+    def save(self):
+        with self._lock:
+            try:
+                if not os.path.exists(self.path):
+                    open(self.path, "a").close()   # 作成はここで済ませ、フォルダ mtime を確定させる
+                self.dir_mtime_ns = _dir_mtime_ns(self.folder)
+                data = {
+                    "version": INDEX_VERSION,
+                    "dir_mtime_ns": self.dir_mtime_ns,
+                    "floors": {str(k): v for k, v in sorted(self.floors.items())},
+                }
+                with open(self.path, "r+", encoding="utf-8") as f:   # 上書き（フォルダ mtime は変わらない）
+                    json.dump(data, f, ensure_ascii=False, indent=1)
+                    f.truncate()
+            except Exception as e:
+                print(f"📛 {INDEX_FILENAME} 保存失敗: {e}")
+
+
+def get_scenario_index(folder):
+    """フォルダごとの ScenarioIndex（メモリ上で使い回す）を検証済みで返す"""
+    return _memo_index(folder).refresh()
+
+
+def list_floor_maps(folder):
+    """{floor: フルパス}（フロア昇順）"""
+    return get_scenario_index(folder).floor_paths()
+
+
+def floor_source(folder, floor, res_key):
+    """ScenarioIndex.source() のショートカット → (path, kind)"""
+    return get_scenario_index(folder).source(floor, res_key)
+
+
+def record_capture(folder, floor, path, entry=None):
+    """
+    キャプチャしたファイルを索引へ反映する。
+    entry: describe_file() の結果（書き込みスレッドで計算済みなら渡す）
+    """
+    idx = _memo_index(folder).refresh()
+    idx.record(floor, path, entry)
+    return idx
+
+
+# ──────────────────────────────
+# 内容アドレス（blob）
+def pixel_digest(image):
+    """画素そのもののハッシュ（PNG の圧縮結果やメタデータに左右されない）"""
+    h = hashlib.sha1()
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("ascii"))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def perceptual_hash(image, size=8):
+    """dHash（横方向の明暗差 size×size ビット）を16進文字列で返す"""
+    gray = image.convert("L").resize((size + 1, size), Image.BILINEAR)
+    px = gray.tobytes()
+    bits = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            bits = (bits << 1) | (px[base + col] > px[base + col + 1])
+    return f"{bits:0{size * size // 4}x}"
+
+
+def phash_distance(a, b):
+    """知覚ハッシュのハミング距離（どちらかが無ければ None）"""
+    if not a or not b:
+        return None
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+BLOB_COPY_MARKER = ".copies"   # ハードリンクの代わりにコピーした事がある印（collect を止める）
+
+
+class BlobStore:
+    def __init__(self, root, ext=".png"):
+        self.root = root
+        self.ext = ext
+        self._hardlinks = None   # collect 前に1回だけ調べる
+        self.links = 0
+        self.copies = 0
+        self.encoded = 0
+        self.collected = 0
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest + self.ext)
+
+    def has(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def is_linked(self, digest, dest, entry=None):
+        """
+        dest が既に digest の blob を指しているか（= 書き込み不要）。
+        entry（dest の索引項目）を渡すと、コピーでも blob・mtime・サイズが一致すれば True
+        """
+        try:
+            if os.path.samefile(dest, self.path_for(digest)):
+                return True
+            if entry is None or entry.get("blob") != digest:
+                return False
+            st = os.stat(dest)
+            return entry.get("mtime_ns") == st.st_mtime_ns and entry.get("size") == st.st_size
+        except OSError:
+            return False
+
+    def hardlinks_ok(self):
+        """このストアの blob が全てハードリンクで参照されているか（リンク数で GC してよいか）"""
+        if self._hardlinks is None:
+            self._hardlinks = self._probe_hardlinks()
+        return self._hardlinks
+
+    def _probe_hardlinks(self):
+        if os.path.exists(os.path.join(self.root, BLOB_COPY_MARKER)):
+            return False
+        a = os.path.join(self.root, f".probe.{os.getpid()}")
+        b = a + ".link"
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            open(a, "wb").close()
+            os.link(a, b)
+            return os.stat(a).st_nlink == 2
+        except OSError:
+            return False
+        finally:
+            for p in (b, a):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+    def put(self, image, digest, encoder):
+        """blob が無ければエンコードして保存する。Returns: 新規に書いたら True"""
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as fp:
+                encoder(image, fp)
+            os.replace(tmp, path)
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        self.encoded += 1
+        return True
+
+    def link(self, digest, dest):
+        """
+        dest を blob へのハードリンクに差し替える（原子的）。
+        mtime は blob のまま（inode を共有する他のリンクも変わるので触らない。保存時刻は索引の saved_ns）
+        """
+        src = self.path_for(digest)
+        tmp = dest + ".tmp"
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        try:
+            os.link(src, tmp)
+            self.links += 1
+        except OSError:
+            shutil.copyfile(src, tmp)   # FAT・別ドライブなど
+            self.copies += 1
+            self._mark_copies()
+        os.replace(tmp, dest)
+
+    def _mark_copies(self):
+        """以後 collect() しない（コピー先はリンク数に現れないため、blob が参照されていないように見える）"""
+        if self._hardlinks is False:
+            return
+        self._hardlinks = False
+        try:
+            open(os.path.join(self.root, BLOB_COPY_MARKER), "a").close()
+        except OSError as e:
+            print(f"⚠️ blob ストアの印を書けません: {e}")
+
+    def collect(self):
+        """
+        どこからもリンクされていない blob（リンク数 1）と書きかけの .tmp を消す。
+        put() → link() の途中の blob も消えるので、書き込みと同じスレッドから呼ぶこと。
+        Returns: 消したファイル数
+        """
+        if not self.hardlinks_ok():
+            return 0
+        removed = 0
+        try:
+            subdirs = os.listdir(self.root)
+        except OSError:
+            return 0
+        for sub in subdirs:
+            folder = os.path.join(self.root, sub)
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    if name.endswith(".tmp") or (name.endswith(FLOOR_EXTS) and os.stat(path).st_nlink <= 1):
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        self.collected += removed
+        if removed:
+            print(f"🧹 参照されていない blob を削除: {removed} 件")
+        return removed
+
+    def stats(self):
+        return {"encoded": self.encoded, "links": self.links, "copies": self.copies, "collected": self.collected}
+
+
+# ──────────────────────────────
+# 非同期キャプチャ書き込み
+def encode_png(image, fp):
+    image.save(fp, format="PNG")
+
+
+class CaptureJob:
+    __slots__ = ("image", "prepare", "after", "path", "floor", "folder", "kind", "group", "ok", "error", "entry",
+                 "digest", "phash", "skipped", "t_trigger", "t_submit", "t_done")
+
+    def __init__(self, image, path, floor=None, folder=None, kind="capture", trigger_ts=None, prepare=None, after=None):
+        self.image = image
+        self.prepare = prepare    # 書き込みスレッドで image に適用する変換（正規化など・None なら無し）
+        self.after = after        # 保存成功後に書き込みスレッドで呼ぶ after(job)（job.image はまだ参照できる）
+        self.path = path
+        self.floor = floor
+        self.folder = folder
+        # "capture"（新規キャプチャ）/ "migrate"（切り抜き済みファイルへの移行）/ "normalize"（正規化グリッド）
+        self.kind = kind
+        self.group = path         # 保存待ち上限の数え方の単位（submit_group で受けたジョブは1件として数える）
+        self.ok = False
+        self.error = None
+        self.entry = None
+        self.digest = None
+        self.phash = None
+        self.skipped = False          # 前回と同じ画素だったので書き込まなかった
+        self.t_trigger = trigger_ts   # 自動キャプチャのきっかけ（MAP 遷移検出）の perf_counter
+        self.t_submit = time.perf_counter()
+        self.t_done = None
+
+    @property
+    def elapsed_ms(self):
+        return ((self.t_done or time.perf_counter()) - self.t_submit) * 1000.0
+
+    @property
+    def latency_ms(self):
+        """きっかけ → 保存完了 の時間（きっかけが無ければ None）"""
+        if self.t_trigger is None:
+            return None
+        return ((self.t_done or time.perf_counter()) - self.t_trigger) * 1000.0
+
+
+class CaptureWriter:
+    """
+    blobs: BlobStore を渡すと内容アドレス方式で保存する（None なら path へ直接書く）
+    phash: 知覚ハッシュも計算して索引項目に入れる
+    encoder: encoder(image, fp)。StorageCodec を渡せば保存形式を選べる（拡張子は path 側で合わせる）
+    thumbs: ThumbCache を渡すと切り抜き済みフロアのサムネイルも作る
+    max_pending: 未着手で待てるキャプチャ数（submit_group の1回分を1件と数える・ファイル数ではない）
+    """
+    def __init__(self, max_pending=4, encoder=encode_png, blobs=None, phash=True, thumbs=None):
+        self.encoder = encoder
+        self.blobs = blobs
+        self.phash = phash
+        self.thumbs = thumbs
+        self.skipped = 0
+        self.thumbs_written = 0
+        self.max_pending = max_pending
+        self._pending = {}            # path -> CaptureJob（未着手分）
+        self._order = queue.Queue()   # 着手順の path
+        self._done = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="wiz_capture_writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, image, path, floor=None, folder=None, kind="capture", trigger_ts=None, prepare=None, after=None):
+        """
+        保存を予約する（すぐ戻る）。
+        prepare: 書き込み前に書き込みスレッドで image に適用する変換
+        after: 保存成功後に書き込みスレッドで呼ぶ after(job)（派生データの作成など）
+        Returns: 受け付けたら True / 待ち行列が一杯なら False
+        """
+        return self.submit_group([CaptureJob(image, path, floor, folder, kind, trigger_ts, prepare, after)])
+
+    def submit_group(self, jobs):
+        """
+        1回のキャプチャで書くファイル一式（画面全体・グリッド・切り抜き）をまとめて予約する。
+        - 全部受け付けるか全部破棄するか（切り抜きだけ落ちることはない）
+        - 上限はまとめて1件と数える
+        - 上限に達していても、新しいキャプチャなら未着手の移行（migrate）を押し出して受け付ける
+          （移行は次にそのフロアを表示したときにやり直されるが、キャプチャは撮り直せない）
+        Returns: 受け付けたら True / 待ち行列が一杯なら False
+        """
+        if not jobs:
+            return True
+        group = jobs[-1].path
+        with self._lock:
+            if self._closed:
+                return False
+            fresh = []
+            for job in jobs:
+                pending = self._pending.get(job.path)
+                if pending is not None:
+                    pending.image = job.image     # 未着手なら最新の画像に差し替え
+                    pending.prepare = job.prepare
+                    pending.after = job.after
+                else:
+                    fresh.append(job)
+            if not fresh:
+                return True
+            if not self._make_room(any(job.kind != "migrate" for job in fresh)):
+                print(f"⚠️ 保存待ちが一杯のため破棄: {', '.join(os.path.basename(job.path) for job in fresh)}")
+                return False
+            for job in fresh:
+                job.group = group
+                self._pending[job.path] = job
+                self._order.put(job.path)         # ロック内で積む → 同じキャプチャのファイルは続けて書かれる
+        return True
+
+    def _make_room(self, is_capture):
+        """（ロック内）新しいグループ1件分の空きを作る。空けられなければ False"""
+        groups = {}
+        for job in self._pending.values():
+            groups.setdefault(job.group, []).append(job)
+        if len(groups) < self.max_pending:
+            return True
+        if not is_capture:
+            return False
+        for members in groups.values():
+            if all(job.kind == "migrate" for job in members):
+                for job in members:
+                    del self._pending[job.path]   # _order に残った path は _run で読み飛ばされる
+                print(f"⚠️ 保存待ちが一杯のため移行を見送り: {', '.join(os.path.basename(job.path) for job in members)}")
+                return True
+        return False
+
+    def _run(self):
+        if self.blobs is not None:
+            try:
+                self.blobs.collect()   # 書き込みと同じスレッドなので put → link の途中を消すことはない
+            except Exception as e:
+                print(f"⚠️ blob の掃除に失敗: {e}")
+        while True:
+            path = self._order.get()
+            if path is None:
+                break
+            with self._lock:
+                job = self._pending.pop(path, None)
+            if job is None:
+                continue
+            if job.prepare is not None:
+                try:
+                    job.image = job.prepare(job.image)
+                except Exception as e:
+                    job.error = e
+                    print(f"📛 保存前の変換に失敗: {os.path.basename(job.path)} → {e}")
+                    job.image = None
+                    job.t_done = time.perf_counter()
+                    self._done.put(job)
+                    continue
+            self._write(job)
+            if job.ok:
+                self._drop_other_formats(job)
+            if job.ok and self.thumbs is not None:
+                self._write_thumb(job)
+            if job.ok and job.after is not None:
+                try:
+                    job.after(job)
+                except Exception as e:
+                    print(f"📛 保存後の処理に失敗: {os.path.basename(job.path)} → {e}")
+            job.image = None
+            job.t_done = time.perf_counter()
+            self._done.put(job)
+
+    def _write(self, job):
+        if self.blobs is not None:
+            self._write_blob(job)
+            return
+        tmp = job.path + ".tmp"
+        try:
+            with open(tmp, "wb") as fp:
+                self.encoder(job.image, fp)
+            os.replace(tmp, job.path)      # 読み手が書きかけのファイルを見ることはない
+            job.entry = describe_file(job.path)
+            job.ok = True
+        except Exception as e:
+            job.error = e
+            print(f"📛 スクリーンショット保存失敗: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _write_blob(self, job):
+        try:
+            job.digest = pixel_digest(job.image)
+            linked = self.blobs.is_linked(job.digest, job.path)
+            if not linked and not self.blobs.hardlinks_ok():
+                linked = self.blobs.is_linked(job.digest, job.path, self._indexed_entry(job))   # コピー運用
+            if linked:
+                job.skipped = job.ok = True       # 内容変化なし → エンコードも書き込みもしない
+                self.skipped += 1
+                if job.kind == "migrate":
+                    # 移行元（グリッド等）より古く見えると毎回作り直すことになるので保存時刻だけ進める
+                    job.entry = describe_file(job.path)
+                    job.entry["blob"] = job.digest
+                    job.entry["saved_ns"] = time.time_ns()
+                return
+            self.blobs.put(job.image, job.digest, self.encoder)
+            self.blobs.link(job.digest, job.path)
+            job.entry = describe_file(job.path)
+            job.entry["blob"] = job.digest
+            job.entry["saved_ns"] = time.time_ns()
+            if self.phash:
+                job.phash = job.entry["phash"] = perceptual_hash(job.image)
+            job.ok = True
+        except Exception as e:
+            job.error = e
+            print(f"📛 スクリーンショット保存失敗: {e}")
+
+    @staticmethod
+    def _indexed_entry(job):
+        """job.path の現在の索引項目（無ければ None）"""
+        parsed = parse_floor_filename(os.path.basename(job.path))
+        if parsed is None or job.folder is None:
+            return None
+        return _memo_index(job.folder).refresh().entry(parsed[0], parsed[1])
+
+    def _drop_other_formats(self, job):
+        """保存形式を変えた後の最初の保存で、旧形式の同じファイルを消す（索引・表示が迷わないように）"""
+        for path in format_siblings(job.path):
+            try:
+                os.remove(path)
+                print(f"🗑 旧形式のファイルを削除: {os.path.basename(path)}")
+            except OSError as e:
+                print(f"⚠️ 旧形式のファイルを削除できません（新しい方を使います）: {os.path.basename(path)} → {e}")
+
+    def _write_thumb(self, job):
+        parsed = parse_floor_filename(os.path.basename(job.path))
+        digest = thumb_key(job.entry)
+        if parsed is None or parsed[1] in (FULL_KIND, GRID_KIND) or digest is None:
+            return  # 画面全体・正規化グリッドは作らない（ギャラリーは表示と同じ切り抜き済みから）
+        if self.thumbs.has(digest):
+            return
+        try:
+            self.thumbs.make(job.image, digest)
+            self.thumbs_written += 1
+        except Exception as e:
+            print(f"📛 サムネイル保存失敗: {e}")
+
+    def drain(self, limit=4):
+        """完了したジョブを最大 limit 件返す（UIスレッドから呼ぶ）"""
+        jobs = []
+        for _ in range(limit):
+            try:
+                jobs.append(self._done.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def stats(self):
+        d = {"skipped": self.skipped, "thumbs_written": self.thumbs_written}
+        if self.blobs is not None:
+            d.update(self.blobs.stats())
+        return d
+
+    def close(self, timeout=2.0):
+        """受付を止め、保存待ちを書き終えるまで最大 timeout 秒待つ"""
+        with self._lock:
+            self._closed = True
+        self._order.put(None)
+        self._thread.join(timeout)
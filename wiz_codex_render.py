@@ -0,0 +1,196 @@
+# ──────────────────────────────────────────────
+# 🎞 Wiz Codex: Render helpers
+#
+# Tk の after() ループを1本にまとめるフレームスケジューラ。
+# 各ビューは自前で after() を張らず、名前付きの描画コールバックとして登録する。
+#
+# ✅ FrameScheduler:
+# - タイマーは常に1本（start() を何度呼んでも多重起動しない）
+# - 同じ名前の登録は上書き（ループが積み重ならない）
+# - 1フレームの処理時間が budget_ms を超えたら残りは次フレームへ回す
+# - 遅延・スキップしたフレーム数を stats() で確認できる
+# - visible 判定付きで登録したビューは非表示（pack_forget / grid_remove / 最小化）の間は
+#   呼ばれず、再表示された最初のフレームで1回だけ追いつき描画される
+#
+# ✅ DirtyTracker:
+# - 描画入力が前回と同じなら Tk への描画呼び出しを省略し、省略回数を数える
+# ──────────────────────────────────────────────
+
+import time
+
+
+class FrameScheduler:
+    def __init__(self, root, interval_ms=100, budget_ms=None):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.budget = (budget_ms if budget_ms is not None else interval_ms * 0.5) / 1000.0
+        self._callbacks = {}   # name -> (callback, visible)（登録順を保持）
+        self._hidden = set()   # 非表示で停止中のビュー名
+        self._job = None
+        self._next_due = None
+        self._start_idx = 0    # 予算超過時に後回しにした分から次フレームを始める
+
+        # --- 統計 ---
+        self.frames = 0
+        self.late_frames = 0
+        self.skipped_frames = 0
+        self.deferred_calls = 0
+        self.paused_calls = 0
+        self.catchups = 0
+        self.busy_sec = 0.0
+
+    # --- 登録 ---
+    def register(self, name, callback, visible=None):
+        """
+        name が既に登録済みなら置き換える（重複ループ防止）。
+        visible: () -> bool。False の間はコールバックを呼ばない（None なら常に表示扱い）
+        """
+        self._callbacks[name] = (callback, visible)
+        self._hidden.discard(name)
+
+    def unregister(self, name):
+        self._callbacks.pop(name, None)
+        self._hidden.discard(name)
+
+    def is_registered(self, name):
+        return name in self._callbacks
+
+    # --- タイマー制御 ---
+    def start(self):
+        if self._job is not None:
+            return
+        self._next_due = time.perf_counter()
+        self._job = self.root.after(0, self._frame)
+
+    def stop(self):
+        if self._job is not None:
+            try:
+                self.root.after_cancel(self._job)
+            except Exception:
+                pass
+            self._job = None
+
+    def _frame(self):
+        self._job = None
+        interval = self.interval_ms / 1000.0
+        t0 = time.perf_counter()
+
+        # ⏱ 遅延検出（予定時刻からの遅れ ＞ 1フレーム → その分をスキップ扱い）
+        lag = t0 - self._next_due
+        if lag > interval * 0.5:
+            self.late_frames += 1
+            self.skipped_frames += int(lag // interval)
+            self._next_due = t0
+
+        names = list(self._callbacks.keys())
+        n = len(names)
+        start = self._start_idx % n if n else 0
+        next_start = 0
+        for k in range(n):
+            name = names[(start + k) % n]
+            entry = self._callbacks.get(name)
+            if entry is None:
+                continue
+            cb, visible = entry
+            if visible is not None and not self._is_visible(name, visible):
+                continue
+            try:
+                cb()
+            except Exception as e:
+                print(f"[FrameScheduler] {name} 例外: {e}")
+            if k + 1 < n and time.perf_counter() - t0 > self.budget:
+                # 次フレームはまだ回っていない位置から始める（非表示で飛ばした分も位置は進める）
+                rest = [names[(start + j) % n] for j in range(k + 1, n)]
+                self.deferred_calls += sum(1 for r in rest if self._is_due(r))
+                next_start = (start + k + 1) % n
+                break
+        self._start_idx = next_start
+
+        elapsed = time.perf_counter() - t0
+        self.frames += 1
+        self.busy_sec += elapsed
+
+        self._next_due += interval
+        delay_ms = max(1, int((self._next_due - time.perf_counter()) * 1000))
+        try:
+            self._job = self.root.after(delay_ms, self._frame)
+        except Exception:
+            self._job = None  # ルート破棄済み
+
+    def _is_due(self, name):
+        """後回しにした name が本来このフレームで呼ばれるはずだったか（登録済みかつ表示中）"""
+        entry = self._callbacks.get(name)
+        if entry is None:
+            return False
+        visible = entry[1]
+        if visible is None:
+            return True
+        try:
+            return bool(visible())
+        except Exception:
+            return False
+
+    def _is_visible(self, name, visible):
+        try:
+            shown = bool(visible())
+        except Exception:
+            shown = False  # ウィジェット破棄済みなど
+        if not shown:
+            self._hidden.add(name)
+            self.paused_calls += 1
+            return False
+        if name in self._hidden:
+            # 👀 再表示 → このフレームの呼び出しが追いつき描画になる
+            self._hidden.discard(name)
+            self.catchups += 1
+        return True
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "late_frames": self.late_frames,
+            "skipped_frames": self.skipped_frames,
+            "deferred_calls": self.deferred_calls,
+            "paused_calls": self.paused_calls,
+            "catchups": self.catchups,
+            "hidden": sorted(self._hidden),
+            "avg_frame_ms": (self.busy_sec / self.frames * 1000.0) if self.frames else 0.0,
+            "callbacks": list(self._callbacks.keys()),
+        }
+
+
+class DirtyTracker:
+    """
+    描画対象ごとに「前回描画した入力値」を覚えておき、変化した時だけ描画させる。
+
+        if tracker.changed("marker", (x, y, direction)):
+            canvas.coords(...)
+
+    skipped には変化なしで描画を省略した回数が対象ごとに溜まる。
+    """
+    def __init__(self):
+        self._last = {}
+        self.rendered = {}
+        self.skipped = {}
+
+    def changed(self, key, value):
+        if key in self._last and self._last[key] == value:
+            self.skipped[key] = self.skipped.get(key, 0) + 1
+            return False
+        self._last[key] = value
+        self.rendered[key] = self.rendered.get(key, 0) + 1
+        return True
+
+    def invalidate(self, key=None):
+        """次回の changed() を必ず True にする（key 省略時は全対象）"""
+        if key is None:
+            self._last.clear()
+        else:
+            self._last.pop(key, None)
+
+    def stats(self):
+        return {
+            "rendered": dict(self.rendered),
+            "skipped": dict(self.skipped),
+            "skipped_total": sum(self.skipped.values()),
+        }
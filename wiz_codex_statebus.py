@@ -0,0 +1,577 @@
+# ──────────────────────────────────────────────
+# 🚌 Wiz Codex: State Bus
+#
+# Mapbook / Lifebook がそれぞれゲームにアタッチしてポーリングする代わりに、
+# 1つの publisher プロセスだけがプロセスハンドルを保持し、
+# MenuStruct（位置・向き・フロア）と HP 構造体（味方6体＋敵 6×9）を
+# 一定レートで読み取って multiprocessing.shared_memory のリングに書き込む。
+# GUI 側はリングを読むだけなので、ゲームへのシステムコールは発生しない。
+#
+# ✅ 構成:
+# - StateBusWriter  … 共有メモリリングへの書き込み（seqlock）
+# - StateBusReader  … 共有メモリリングからの読み取り（GUI 側）
+# - GameStateSource … ゲームからの一括読み取り（publisher 専用）
+# - run_state_publisher() … publisher プロセス本体
+#   （settings.json で有効化すると wiz_codex_statepush の配信サーバも同居させる）
+# - PublisherLock   … publisher を1プロセスに限る排他ロック（OS のファイルロック）
+#   Mapbook と Lifebook が同時に起動して両方が publisher を立てても、ロックを取れた方だけが書き込む。
+#   取れなかった方は何も書かずに終了し、GUI は読み手として勝者のリングを読む
+#   （プロセスが落ちれば OS がロックを外すので、残骸で詰まることはない）
+#
+# 📐 リング形式:
+# - ヘッダ 64 byte: magic / version / slot 数 / slot サイズ / write_index / publisher pid
+# - slot: u64 seq（書き込み中は奇数）＋ payload
+#   書き込み番号 n の slot は seq = 2n+1 → payload → seq = 2n+2 の順で更新する。
+#   読み手は seq を payload の前後で読み、一致かつ 2n+2 の場合のみ採用する。
+#
+# 単体起動: python wiz_codex_statebus.py
+# ──────────────────────────────────────────────
+
+import os
+import sys
+import csv
+import json
+import time
+import struct
+import tempfile
+import multiprocessing
+from multiprocessing import shared_memory
+
+# ──────────────────────────────
+VERBOSE = False
+def vprint(*args, **kwargs):
+    if VERBOSE:
+        print(*args, **kwargs)
+
+# 基本定数（Mapbook / Lifebook と同じ値）
+PROCESS_NAME = "WizardryFoV2.exe"
+BUS_NAME     = "wiz_codex_state_bus"
+BUS_MAGIC    = b"WZSB"
+BUS_VERSION  = 1
+SLOT_COUNT   = 8
+
+DEFAULT_RATE_HZ = 20.0   # 50ms ごとに読み取り（旧: 各GUIが 100ms ごと）
+STALE_SEC       = 2.0    # これ以上更新が無ければ publisher 停止とみなす
+ATTACH_RETRY_SEC = 1.0   # 再アタッチ / 再接続の最短間隔
+RESPAWN_SEC      = 5.0   # publisher 再起動の最短間隔（起動直後の初回書き込み待ちを含む）
+
+# MenuStruct オフセット（wiz_codex_mapbook.MenuStruct と同じ）
+MENU_OFFSETS = (0x00, 0x04, 0x4C, 0x50, 0x54, 0x58, 0x64)  # state, cursor, dir, x, y, floor, dungeon_id
+MENU_READ_SIZE = 0x68
+
+# HP 構造体オフセット（wiz_codex_lifebook と同じ）
+OFFSET_CUR       = 0x000
+OFFSET_MAX       = 0x1D20
+ENEMY_BASE_OFF   = 0x30
+ENEMY_GROUP_STEP = 0x30
+ENEMY_SLOT_STEP  = 4
+HP_READ_SIZE     = ENEMY_BASE_OFF + 5 * ENEMY_GROUP_STEP + 9 * ENEMY_SLOT_STEP
+
+FLAG_MENU_VALID = 0x01
+FLAG_HP_VALID   = 0x02
+
+# ヘッダ: magic, version, slot_count, slot_size, write_index, publisher_pid
+_HEADER = struct.Struct("<4sIIIQQ")
+HEADER_SIZE = 64
+_SEQ = struct.Struct("<Q")
+# payload: timestamp, flags, menu_base, hp_base, menu 7値, 味方cur 6, 味方max 6, 敵 54
+_PAYLOAD = struct.Struct("<dIQQ7i6i6i54i")
+SLOT_SIZE = _SEQ.size + _PAYLOAD.size
+BUS_SIZE = HEADER_SIZE + SLOT_COUNT * SLOT_SIZE
+_WRITE_INDEX_OFF = 16   # ヘッダ内 write_index の位置
+
+
+def _base_dir():
+    return os.path.dirname(sys.executable) if getattr(sys, "frozen", False) \
+         else os.path.dirname(os.path.abspath(__file__))
+
+SETTINGS_PATH   = os.path.join(_base_dir(), "settings.json")
+CSV_LOCKED_PATH = os.path.join(_base_dir(), "locked_hp_struct.csv")
+LOCK_PATH       = os.path.join(tempfile.gettempdir(), f"{BUS_NAME}.lock")
+
+
+def load_state_bus_config():
+    """
+    settings.json から state bus 設定を読む（無ければ既定値）。
+    Returns: (enabled: bool, rate_hz: float)
+    """
+    enabled, rate = True, DEFAULT_RATE_HZ
+    try:
+        if os.path.exists(SETTINGS_PATH):
+            with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+                d = json.load(f)
+            if isinstance(d, dict):
+                enabled = bool(d.get("state_bus_enabled", enabled))
+                rate = float(d.get("state_bus_rate_hz", rate))
+    except Exception as e:
+        print(f"📛 state bus 設定読み込み失敗: {e}")
+    return enabled, max(1.0, rate)
+
+
+def _attach_shm(name):
+    """既存の共有メモリに接続する（POSIX の resource_tracker による勝手な unlink を防ぐ）"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+        return shm
+
+
+# ──────────────────────────────
+# スナップショット
+class StateSnapshot:
+    """リング1スロット分のデコード結果（読み取り専用として扱う）"""
+    __slots__ = ("seq", "timestamp", "flags", "menu_base", "hp_base",
+                 "menu_state", "cursor", "dir", "x", "y", "floor", "dungeon_id",
+                 "party_cur", "party_max", "enemy")
+
+    def __init__(self, seq, values):
+        self.seq = seq
+        self.timestamp, self.flags, self.menu_base, self.hp_base = values[0:4]
+        (self.menu_state, self.cursor, self.dir, self.x, self.y,
+         self.floor, self.dungeon_id) = values[4:11]
+        self.party_cur = values[11:17]
+        self.party_max = values[17:23]
+        enemy = values[23:77]
+        self.enemy = [list(enemy[g * 9:(g + 1) * 9]) for g in range(6)]
+
+    @property
+    def menu_valid(self):
+        return bool(self.flags & FLAG_MENU_VALID)
+
+    @property
+    def hp_valid(self):
+        return bool(self.flags & FLAG_HP_VALID)
+
+    @property
+    def party_hp(self):
+        """read_party_hp() と同じ形式: List[Tuple[cur_hp, max_hp]]"""
+        return list(zip(self.party_cur, self.party_max))
+
+    def age(self, now=None):
+        return (time.time() if now is None else now) - self.timestamp
+
+
+# ──────────────────────────────
+# publisher の排他
+class PublisherLock:
+    """
+    publisher は1プロセスだけ。acquire() できたプロセスだけが StateBusWriter を作る。
+    ロックは開いたファイルに付くので、プロセスが終了（異常終了を含む）すれば自動で外れる。
+    """
+    def __init__(self, path=None):
+        self.path = path or LOCK_PATH
+        self.fp = None
+
+    def acquire(self):
+        """Returns: ロックを取れたら True（他のプロセスが保持中なら False・待たない）"""
+        if self.fp is not None:
+            return True
+        try:
+            fp = open(self.path, "a+b")
+        except OSError as e:
+            print(f"📛 publisher ロックファイルを開けません: {e}")
+            return False
+        try:
+            if os.name == "nt":
+                import msvcrt
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fp.close()
+            return False
+        self.fp = fp
+        return True
+
+    def release(self):
+        fp, self.fp = self.fp, None
+        if fp is None:
+            return
+        try:
+            if os.name == "nt":
+                import msvcrt
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        except OSError:
+            pass
+        fp.close()
+
+    def held_elsewhere(self):
+        """他のプロセスが publisher として動いているか（ロックを取れるか試すだけ）"""
+        if self.fp is not None:
+            return False
+        if not self.acquire():
+            return True
+        self.release()
+        return False
+
+
+# ──────────────────────────────
+# 書き込み側
+class StateBusWriter:
+    def __init__(self, name=BUS_NAME):
+        self.name = name
+        self.owner = False
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=BUS_SIZE)
+            self.owner = True
+        except FileExistsError:
+            # 前回 publisher の残骸（または読み手が保持中）→ 引き継いで再利用
+            self.shm = _attach_shm(name)
+            if self.shm.size < BUS_SIZE:
+                self.shm.close()
+                raise RuntimeError(f"state bus のサイズ不一致: {self.shm.size} < {BUS_SIZE}")
+            print("♻️ 既存の state bus を引き継ぎます")
+
+        self.buf = self.shm.buf
+        last = _SEQ.unpack_from(self.buf, _WRITE_INDEX_OFF)[0] if not self.owner else 0
+        self.write_index = last
+        _HEADER.pack_into(self.buf, 0, BUS_MAGIC, BUS_VERSION, SLOT_COUNT, SLOT_SIZE,
+                          self.write_index, os.getpid())
+
+    def publish(self, timestamp, flags, menu_base, hp_base, menu_vals, party_cur, party_max, enemy_flat):
+        n = self.write_index + 1
+        off = HEADER_SIZE + (n % SLOT_COUNT) * SLOT_SIZE
+        _SEQ.pack_into(self.buf, off, 2 * n + 1)          # 書き込み開始（奇数）
+        _PAYLOAD.pack_into(self.buf, off + _SEQ.size, timestamp, flags, menu_base, hp_base,
+                           *menu_vals, *party_cur, *party_max, *enemy_flat)
+        _SEQ.pack_into(self.buf, off, 2 * n + 2)          # 書き込み完了（偶数）
+        _SEQ.pack_into(self.buf, _WRITE_INDEX_OFF, n)     # 最後に公開
+        self.write_index = n
+
+    def close(self):
+        try:
+            self.buf = None
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+        except Exception as e:
+            vprint(f"⚠️ state bus 解放失敗: {e}")
+
+
+# ──────────────────────────────
+# 読み取り側（GUI）
+class StateBusReader:
+    """
+    共有メモリリングから最新スナップショットを読む。
+    - 未接続なら ATTACH_RETRY_SEC 間隔で再接続を試みる
+    - write_index が変わっていなければ前回のスナップショットを返す（デコード省略）
+    - publisher が STALE_SEC 以上止まっていれば None（呼び出し側は直接読み取りへフォールバック）
+    - respawn を渡すと、リングが無い / 止まっている間は RESPAWN_SEC 間隔で publisher を起動し直す
+      （publisher を起動した GUI が先に閉じられても、残った GUI が引き継ぐ）
+    """
+    def __init__(self, name=BUS_NAME, respawn=None):
+        self.name = name
+        self.shm = None
+        self.respawn = respawn
+        self._next_attach = 0.0
+        self._next_respawn = 0.0
+        self._last = None
+
+    def hold_respawn(self):
+        """publisher を起動した直後に呼ぶ（初回書き込みまで二重起動しない）"""
+        self._next_respawn = time.monotonic() + RESPAWN_SEC
+
+    def _maybe_respawn(self):
+        if self.respawn is None:
+            return
+        now = time.monotonic()
+        if now < self._next_respawn:
+            return
+        self._next_respawn = now + RESPAWN_SEC
+        if PublisherLock().held_elsewhere():
+            return  # 誰かが publisher として動作中（起動直後 / もう一方の GUI が再起動済み）
+        print("♻️ state bus が止まっているため publisher を再起動します")
+        try:
+            self.respawn()
+        except Exception as e:
+            print(f"📛 state bus publisher 再起動失敗: {e}")
+
+    def _attach(self):
+        now = time.monotonic()
+        if now < self._next_attach:
+            return False
+        self._next_attach = now + ATTACH_RETRY_SEC
+        try:
+            shm = _attach_shm(self.name)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            vprint(f"⚠️ state bus 接続失敗: {e}")
+            return False
+
+        magic, version, slots, slot_size, _, _ = _HEADER.unpack_from(shm.buf, 0)
+        if magic != BUS_MAGIC or version != BUS_VERSION or slots != SLOT_COUNT or slot_size != SLOT_SIZE:
+            print(f"📛 state bus 形式不一致: magic={magic!r} version={version}")
+            shm.close()
+            return False
+        self.shm = shm
+        print("🚌 state bus に接続しました")
+        return True
+
+    def read(self):
+        if self.shm is None and not self._attach():
+            self._maybe_respawn()
+            return None
+
+        buf = self.shm.buf
+        for _ in range(4):
+            n = _SEQ.unpack_from(buf, _WRITE_INDEX_OFF)[0]
+            if n == 0:
+                return None
+            if self._last is not None and self._last.seq == n:
+                snap = self._last
+                break
+            off = HEADER_SIZE + (n % SLOT_COUNT) * SLOT_SIZE
+            s1 = _SEQ.unpack_from(buf, off)[0]
+            values = _PAYLOAD.unpack_from(buf, off + _SEQ.size)
+            s2 = _SEQ.unpack_from(buf, off)[0]
+            if s1 == s2 == 2 * n + 2:
+                snap = self._last = StateSnapshot(n, values)
+                break
+        else:
+            return self._last  # 連続して書き込み競合 → 直前の値で代用
+
+        if snap.age() > STALE_SEC:
+            # publisher 停止 → 次の publisher が作り直すリングへ繋ぎ直せるよう手放す
+            self.close()
+            self._last = None
+            self._maybe_respawn()
+            return None
+        return snap
+
+    def close(self):
+        if self.shm is not None:
+            try:
+                self.shm.close()
+            except Exception:
+                pass
+            self.shm = None
+
+
+# ──────────────────────────────
+# ゲーム読み取り（publisher 専用）
+class GameStateSource:
+    """
+    1つの pymem ハンドルで MenuStruct と HP 構造体をまとめて読む。
+    - アドレスは settings.json（menu_state_addr）と locked_hp_struct.csv（struct_base）から取得
+    - どちらのファイルも mtime が変わったら読み直す（再スキャン後に自動追従）
+    """
+    def __init__(self):
+        self.pm = None
+        self._next_attach = 0.0
+        self.menu_base = 0
+        self.hp_base = 0
+        self._mtimes = {}
+
+    def _attach(self):
+        if self.pm is not None:
+            return True
+        now = time.monotonic()
+        if now < self._next_attach:
+            return False
+        self._next_attach = now + ATTACH_RETRY_SEC
+        try:
+            import pymem
+            self.pm = pymem.Pymem(PROCESS_NAME)
+            print(f"✅ {PROCESS_NAME} に接続しました（state bus publisher）")
+            return True
+        except Exception as e:
+            vprint(f"⚠️ {PROCESS_NAME} に接続できません: {e}")
+            self.pm = None
+            return False
+
+    def _changed(self, path):
+        try:
+            m = os.path.getmtime(path)
+        except OSError:
+            m = None
+        if self._mtimes.get(path, -1) == m:
+            return False
+        self._mtimes[path] = m
+        return True
+
+    def refresh_addresses(self):
+        if self._changed(SETTINGS_PATH):
+            self.menu_base = 0
+            try:
+                with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+                    d = json.load(f)
+                v = d.get("menu_state_addr", d.get("menu_struct_addr")) if isinstance(d, dict) else None
+                if v is not None:
+                    self.menu_base = v if isinstance(v, int) else int(str(v).strip().lower().replace("0x", ""), 16)
+                    print(f"📡 menu_state_addr → 0x{self.menu_base:X}")
+            except Exception as e:
+                print(f"📛 menu_state_addr 読み込み失敗: {e}")
+
+        if self._changed(CSV_LOCKED_PATH):
+            self.hp_base = 0
+            try:
+                with open(CSV_LOCKED_PATH, newline='') as f:
+                    reader = csv.reader(f)
+                    next(reader)                 # ヘッダ
+                    self.hp_base = int(next(reader)[2], 16)
+                print(f"📡 HP構造体アドレス → 0x{self.hp_base:X}")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"📛 HP構造体アドレス読み込み失敗: {e}")
+
+    def poll(self):
+        """
+        Returns: (flags, menu_vals[7], party_cur[6], party_max[6], enemy_flat[54])
+        読めなかった部分は 0 埋めし、flags で有効性を示す。
+        """
+        self.refresh_addresses()
+        flags = 0
+        menu_vals = (0,) * 7
+        party_cur = party_max = (0,) * 6
+        enemy_flat = (0,) * 54
+
+        if not self._attach():
+            return flags, menu_vals, party_cur, party_max, enemy_flat
+
+        try:
+            if self.menu_base:
+                raw = self.pm.read_bytes(self.menu_base, MENU_READ_SIZE)
+                menu_vals = tuple(struct.unpack_from("<i", raw, off)[0] for off in MENU_OFFSETS)
+                flags |= FLAG_MENU_VALID
+
+            if self.hp_base:
+                raw = self.pm.read_bytes(self.hp_base, HP_READ_SIZE)
+                raw_max = self.pm.read_bytes(self.hp_base + OFFSET_MAX, 6 * 4)
+                party_cur = struct.unpack_from("<6i", raw, OFFSET_CUR)
+                party_max = struct.unpack_from("<6i", raw_max, 0)
+                enemy_flat = tuple(
+                    struct.unpack_from("<i", raw, ENEMY_BASE_OFF + g * ENEMY_GROUP_STEP + s * ENEMY_SLOT_STEP)[0]
+                    for g in range(6) for s in range(9)
+                )
+                flags |= FLAG_HP_VALID
+        except Exception as e:
+            # ゲーム終了・再起動でハンドルが死んだ可能性 → 次回再アタッチ
+            vprint(f"⚠️ state bus 読み取り失敗 → {type(e).__name__}: {e}")
+            self.pm = None
+
+        return flags, menu_vals, party_cur, party_max, enemy_flat
+
+
+# ──────────────────────────────
+# publisher 本体
+def run_state_publisher(rate_hz=None, stop_event=None, source=None):
+    """
+    ゲーム状態を rate_hz で読み取り、state bus に書き込み続ける。
+    stop_event（multiprocessing.Event 等）がセットされるまで戻らない。
+    """
+    lock = PublisherLock()
+    if not lock.acquire():
+        # 🔒 既に別プロセスが publisher → 同じリングに別の write_index で書かないよう何もせず終了
+        print(f"ℹ️ state bus publisher は別プロセスで動作中のため起動しません（pid={os.getpid()}）")
+        return
+    if rate_hz is None:
+        _, rate_hz = load_state_bus_config()
+    interval = 1.0 / rate_hz
+    source = source or GameStateSource()
+    try:
+        writer = StateBusWriter()
+    except Exception:
+        lock.release()
+        raise
+    print(f"🚌 state bus publisher 開始: {rate_hz:.0f} Hz（pid={os.getpid()}）")
+
+    # 📡 任意: 同じ読み取り系統から localhost へプッシュ配信（wiz_codex_statepush.py）
+    push_server = None
+    try:
+        from wiz_codex_statepush import StatePushServer, load_push_server_config
+        push_enabled, push_port = load_push_server_config()
+        if push_enabled:
+            push_server = StatePushServer(port=push_port, rate_hz=rate_hz).start()
+    except Exception as e:
+        print(f"📛 push server 起動失敗: {e}")
+
+    try:
+        next_t = time.perf_counter()
+        while stop_event is None or not stop_event.is_set():
+            flags, menu_vals, party_cur, party_max, enemy_flat = source.poll()
+            writer.publish(time.time(), flags, source.menu_base, source.hp_base,
+                           menu_vals, party_cur, party_max, enemy_flat)
+
+            next_t += interval
+            delay = next_t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_t = time.perf_counter()  # 遅延時は追いつこうとせず仕切り直す
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if push_server is not None:
+            push_server.stop()
+        writer.close()
+        lock.release()
+        print("🛑 state bus publisher 停止")
+
+
+def _spawn_publisher(rate_hz):
+    """
+    publisher を子プロセスとして起動する。
+    親の GUI が閉じれば一緒に止まるが、残った GUI の StateBusReader が止まったリングを検知して起動し直す
+    """
+    proc = multiprocessing.Process(target=run_state_publisher, args=(rate_hz,),
+                                   name="wiz_codex_state_bus", daemon=True)
+    proc.start()
+    return proc
+
+
+def ensure_state_publisher(timeout=1.5):
+    """
+    GUI 起動時に呼ぶ。state bus が生きていればそのまま、無ければ publisher を起動する。
+    Returns: StateBusReader | None（無効化されている / 起動できなかった場合）
+    """
+    enabled, rate_hz = load_state_bus_config()
+    if not enabled:
+        print("ℹ️ state bus 無効（settings.json: state_bus_enabled=false）")
+        return None
+
+    reader = StateBusReader(respawn=lambda: _spawn_publisher(rate_hz))
+    reader.hold_respawn()  # 起動時の判定はここで行う（read() 内では再起動しない）
+    if reader.read() is not None:
+        return reader
+
+    if PublisherLock().held_elsewhere():
+        # もう一方の GUI が起動した publisher がまだ最初の書き込み前 → 読み手として待つだけ
+        print("ℹ️ state bus publisher は起動中です（読み取り側として接続します）")
+        return reader
+
+    try:
+        _spawn_publisher(rate_hz)
+        reader.hold_respawn()
+    except Exception as e:
+        print(f"📛 state bus publisher 起動失敗: {e}")
+        return None
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        reader._next_attach = 0.0
+        if reader.read() is not None:
+            return reader
+        time.sleep(0.05)
+
+    print("⚠️ state bus の応答がありません（直接読み取りで継続）")
+    return reader  # 後から publisher が上がれば自動で接続される
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    run_state_publisher()
@@ -0,0 +1,331 @@
+# ──────────────────────────────────────────────
+# 📡 Wiz Codex: State Push Server
+#
+# state bus（wiz_codex_statebus.py）の最新スナップショットを、
+# localhost の TCP クライアント（配信オーバーレイ・外部ツール等）へ
+# JSON Lines 形式でプッシュ配信する。メモリ読み取りは state bus の1系統のみ。
+#
+# ✅ 仕様:
+# - 接続直後に1回 "full"（全フィールド）を送信
+# - 以降は値が変わったフィールドだけを "delta" で送信（変化なしなら何も送らない）
+# - 送信待ちはフレーム（1行）単位のキューと、先頭フレームの送信済みバイト数で持つ
+# - 遅いクライアントは送信待ちが max_pending バイトを超えた時点で、まだ1バイトも送っていない
+#   フレームだけを破棄し、その場で "full" を積み直して再同期する
+#   （送りかけのフレームは最後まで送る → 行が途中で切れない。キューも無制限に伸びない）
+#
+# 📨 フレーム例（1行 = 1メッセージ）:
+#   {"type":"full","seq":1,"t":1700000000.0,"state":{"x":3,"y":5,...}}
+#   {"type":"delta","seq":2,"t":1700000000.1,"changes":{"x":4}}
+#
+# 🔧 settings.json:
+#   "push_server_enabled": false, "push_server_port": 47810
+#
+# 単体起動: python wiz_codex_statepush.py（state bus publisher が別途必要）
+# ──────────────────────────────────────────────
+
+import os
+import json
+import time
+import socket
+import selectors
+import threading
+import collections
+
+from wiz_codex_statebus import StateBusReader, SETTINGS_PATH, DEFAULT_RATE_HZ
+
+# ──────────────────────────────
+VERBOSE = False
+def vprint(*args, **kwargs):
+    if VERBOSE:
+        print(*args, **kwargs)
+
+DEFAULT_HOST = "127.0.0.1"   # 外部公開はしない
+DEFAULT_PORT = 47810
+MAX_PENDING_BYTES = 64 * 1024
+MAX_CLIENTS = 16
+
+
+def load_push_server_config():
+    """
+    settings.json から push server 設定を読む（既定は無効）。
+    Returns: (enabled: bool, port: int)
+    """
+    enabled, port = False, DEFAULT_PORT
+    try:
+        if os.path.exists(SETTINGS_PATH):
+            with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+                d = json.load(f)
+            if isinstance(d, dict):
+                enabled = bool(d.get("push_server_enabled", enabled))
+                port = int(d.get("push_server_port", port))
+    except Exception as e:
+        print(f"📛 push server 設定読み込み失敗: {e}")
+    return enabled, port
+
+
+def snapshot_to_state(snap):
+    """
+    StateSnapshot → 配信用のフラットな dict。
+    敵HPはグループ単位のキー（enemy0〜enemy5）にして、差分を小さく保つ。
+    """
+    state = {
+        "menu_valid": snap.menu_valid,
+        "hp_valid": snap.hp_valid,
+    }
+    if snap.menu_valid:
+        state.update({
+            "menu_state": snap.menu_state,
+            "dir": snap.dir,
+            "x": snap.x,
+            "y": snap.y,
+            "floor": snap.floor,
+            "dungeon_id": snap.dungeon_id,
+        })
+    if snap.hp_valid:
+        state["party_hp"] = [list(p) for p in snap.party_hp]
+        for g, slots in enumerate(snap.enemy):
+            state[f"enemy{g}"] = list(slots)
+    return state
+
+
+def diff_state(prev, cur):
+    """cur のうち prev から変化したキーだけを返す（消えたキーは None）"""
+    changes = {k: v for k, v in cur.items() if prev.get(k) != v}
+    for k in prev.keys() - cur.keys():
+        changes[k] = None
+    return changes
+
+
+def _encode(msg):
+    return (json.dumps(msg, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class _Client:
+    __slots__ = ("sock", "addr", "out", "sent", "pending", "dropped")
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.out = collections.deque()   # 送信待ちのフレーム（bytes・1行ずつ）
+        self.sent = 0                    # out[0] のうち送信済みのバイト数
+        self.pending = 0                 # 未送信のバイト数（out 全体 - sent）
+        self.dropped = 0
+
+    def push(self, frame):
+        self.out.append(frame)
+        self.pending += len(frame)
+
+    def drop_unsent(self):
+        """まだ送り始めていないフレームを捨てる（送りかけの先頭フレームは残す）"""
+        keep = self.out[0] if self.out and self.sent else None
+        self.out.clear()
+        self.pending = 0
+        if keep is not None:
+            self.out.append(keep)
+            self.pending = len(keep) - self.sent
+
+
+class StatePushServer:
+    """
+    source: 引数なしで StateSnapshot（または None）を返す callable
+            既定は StateBusReader().read
+    port=0 を渡すと空きポートを自動選択（self.address で確認可能）
+    """
+    def __init__(self, source=None, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 rate_hz=DEFAULT_RATE_HZ, max_pending=MAX_PENDING_BYTES):
+        self._reader = None
+        if source is None:
+            self._reader = StateBusReader()
+            source = self._reader.read
+        self.source = source
+        self.host = host
+        self.port = port
+        self.interval = 1.0 / max(1.0, rate_hz)
+        self.max_pending = max_pending
+
+        self.sel = None
+        self.listener = None
+        self.address = None
+        self.clients = {}
+        self.seq = 0
+        self.last_state = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- 起動 / 停止 ---
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(MAX_CLIENTS)
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.listener, selectors.EVENT_READ, None)
+
+        self._thread = threading.Thread(target=self._run, name="wiz_codex_push", daemon=True)
+        self._thread.start()
+        print(f"📡 push server 開始: {self.address[0]}:{self.address[1]}")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        for c in list(self.clients.values()):
+            self._drop(c)
+        try:
+            if self.sel is not None:
+                self.sel.close()
+            if self.listener is not None:
+                self.listener.close()
+        except Exception:
+            pass
+        if self._reader is not None:
+            self._reader.close()
+        print("🛑 push server 停止")
+
+    # --- メインループ ---
+    def _run(self):
+        next_t = time.monotonic()
+        while not self._stop.is_set():
+            timeout = max(0.0, next_t - time.monotonic())
+            try:
+                for key, mask in self.sel.select(timeout):
+                    if key.data is None:
+                        self._accept()
+                    else:
+                        self._service(key.data, mask)
+            except Exception as e:
+                print(f"[push server] select エラー: {e}")
+
+            if time.monotonic() >= next_t:
+                next_t = time.monotonic() + self.interval
+                try:
+                    self.publish_once()
+                except Exception as e:
+                    print(f"[push server] 配信エラー: {e}")
+
+    def _accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(self.clients) >= MAX_CLIENTS:
+            sock.close()
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        c = _Client(sock, addr)
+        self.clients[sock] = c
+        self.sel.register(sock, selectors.EVENT_READ, c)
+        print(f"🔌 push client 接続: {addr[0]}:{addr[1]}")
+        if self.last_state is not None:
+            self._queue_full(c, time.time())
+            self._update_interest(c)
+
+    def _service(self, c, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = c.sock.recv(4096)   # クライアントからの入力は読み捨て
+            except (BlockingIOError, InterruptedError):
+                data = b"-"
+            except OSError:
+                data = b""
+            if not data:
+                self._drop(c)
+                return
+        if mask & selectors.EVENT_WRITE:
+            self._flush(c)
+
+    def _drop(self, c):
+        self.clients.pop(c.sock, None)
+        try:
+            self.sel.unregister(c.sock)
+        except Exception:
+            pass
+        try:
+            c.sock.close()
+        except Exception:
+            pass
+        vprint(f"🔌 push client 切断: {c.addr}（破棄 {c.dropped} 件）")
+
+    def _flush(self, c):
+        while c.out:
+            head = c.out[0]
+            try:
+                n = c.sock.send(memoryview(head)[c.sent:])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self._drop(c)
+                return
+            c.sent += n
+            c.pending -= n
+            if c.sent < len(head):
+                break      # 送信バッファが一杯 → 残りは EVENT_WRITE で
+            c.out.popleft()
+            c.sent = 0
+        self._update_interest(c)
+
+    def _update_interest(self, c):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if c.out else 0)
+        try:
+            self.sel.modify(c.sock, events, c)
+        except Exception:
+            pass
+
+    # --- 配信 ---
+    def _queue_full(self, c, t):
+        c.push(_encode({"type": "full", "seq": self.seq, "t": t, "state": self.last_state}))
+
+    def publish_once(self):
+        """
+        source から最新状態を取得し、変化があれば全クライアントへ送る。
+        Returns: 送信した差分のフィールド数（変化なしなら 0）
+        """
+        snap = self.source()
+        if snap is None:
+            return 0
+        state = snapshot_to_state(snap)
+        first = self.last_state is None
+        changes = state if first else diff_state(self.last_state, state)
+        if not changes:
+            return 0
+
+        self.seq += 1
+        self.last_state = state
+        t = snap.timestamp
+        delta = _encode({"type": "delta", "seq": self.seq, "t": t, "changes": changes})
+
+        for c in list(self.clients.values()):
+            if first:
+                self._queue_full(c, t)   # 状態が届く前に接続していたクライアントも full から始める
+            elif c.pending > self.max_pending:
+                # 🐢 バックプレッシャ: 未送信の差分を捨て、すぐに full（今回の状態）を積んで再同期
+                c.drop_unsent()
+                c.dropped += 1
+                self._queue_full(c, t)
+            else:
+                c.push(delta)
+            self._flush(c)
+        return len(changes)
+
+
+def run_push_server(port=None, rate_hz=None):
+    """state bus に接続して push server を前景で動かす（Ctrl+C で停止）"""
+    if port is None:
+        _, port = load_push_server_config()
+    server = StatePushServer(port=port, rate_hz=rate_hz or DEFAULT_RATE_HZ).start()
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    run_push_server()
@@ -0,0 +1,113 @@
+# ──────────────────────────────────────────────
+# 🖼 Wiz Codex: Floor thumbnails
+#
+# フロア画像の縮小版（長辺 THUMB_SIZE px）をファイルの内容ハッシュ（索引項目の sha1）で保存する。
+#     <data>/map_thumbs/ab/abcdef..._128.webp   （WebP が使えなければ .png）
+#
+# ✅ 作成:
+# - キャプチャ時: CaptureWriter（thumbs=ThumbCache）が書き込みスレッドで、保存直後の画像から作る
+#   → 表示用に PNG をもう一度デコードしない
+# - 古いキャプチャなど未作成の分: ThumbPrefetcher がギャラリー表示時に1回だけ元画像から作る
+# - 内容ハッシュがキーなので、同じ画像（別シナリオの同じフロア・再キャプチャで変化なし）は共有される。
+#   画像が変わればハッシュも変わり、自然に別ファイルになる（古いサムネイルは残るが数 KB）
+#
+# ✅ ThumbPrefetcher:
+# - FloorPrefetcher と同じ使い方（request → drain(image_cache)）。key = ("thumb", sha1)
+# - 縮小版があれば読むだけ（数 KB のデコード）。無ければ path（crop）から作って保存する
+# ──────────────────────────────────────────────
+
+import os
+
+from PIL import Image, features
+
+from wiz_codex_mapcache import FloorPrefetcher, decode_crop
+
+THUMB_SIZE = 128
+THUMB_KEY = "thumb"
+WEBP_QUALITY = 80
+
+
+def thumb_key(entry):
+    """索引項目 → サムネイルのキー（ファイルの内容ハッシュ）/ 無ければ None"""
+    return entry.get("sha1") if entry else None
+
+
+def thumb_size(size, limit=THUMB_SIZE):
+    """縦横比を保ったまま長辺を limit に収めた大きさ"""
+    w, h = size
+    scale = min(1.0, limit / max(w, h, 1))
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+class ThumbCache:
+    def __init__(self, root, size=THUMB_SIZE, fmt=None):
+        self.root = root
+        self.size = size
+        self.fmt = fmt or ("webp" if features.check("webp") else "png")
+        self.made = 0
+        self.loaded = 0
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], f"{digest}_{self.size}.{self.fmt}")
+
+    def has(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def make(self, image, digest):
+        """image を縮小して保存する（どのスレッドから呼んでもよい）。Returns: 縮小版"""
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        thumb = image.resize(thumb_size(image.size, self.size), Image.BILINEAR, reducing_gap=2.0)
+        path = self.path_for(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as fp:
+                if self.fmt == "webp":
+                    thumb.save(fp, format="WEBP", quality=WEBP_QUALITY)
+                else:
+                    thumb.save(fp, format="PNG")
+            os.replace(tmp, path)
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        self.made += 1
+        return thumb
+
+    def load(self, digest):
+        """Returns: 縮小版（RGB/RGBA）/ 無ければ None"""
+        try:
+            with Image.open(self.path_for(digest)) as img:
+                img.load()
+                self.loaded += 1
+                return img if img.mode in ("RGB", "RGBA") else img.convert("RGB")
+        except (OSError, ValueError):
+            return None
+
+    def get_or_make(self, digest, path, crop, loader=decode_crop):
+        img = self.load(digest)
+        if img is None:
+            img = self.make(loader(path, crop, "RGB"), digest)
+        return img
+
+    def stats(self):
+        return {"format": self.fmt, "made": self.made, "loaded": self.loaded}
+
+
+class ThumbPrefetcher(FloorPrefetcher):
+    """key = (THUMB_KEY, sha1)。縮小版を読む（無ければ path・crop から作る）"""
+
+    def __init__(self, thumbs, max_workers=1, loader=decode_crop):
+        super().__init__(max_workers=max_workers, loader=loader)
+        self.thumbs = thumbs
+
+    def _work(self, key, path, crop, mode):
+        try:
+            img = self.thumbs.get_or_make(key[1], path, crop, self.loader)
+        except Exception as e:
+            print(f"[thumbs] 作成失敗: {path} → {e}")
+            img = None
+        self._done.put((key, img))
@@ -0,0 +1,237 @@
+# ──────────────────────────────────────────────
+# 👣 Wiz Codex: Visit log / heatmap
+#
+# パーティの位置（floor, x, y, dir）を毎フレーム捨てずに、フロアごとの配列として残す。
+#
+# ✅ 保存形式（シナリオフォルダ内・フロアごと）:
+#   map_{floor}f_visits.npy … uint16 [y, x] の訪問回数（np.lib.format.open_memmap で開いたまま更新。
+#                            65535 で頭打ち）。更新はページキャッシュへの書き込みだけで、flush() で確定
+#   map_{floor}f_trail.bin  … 位置が変わるたびの記録（TRAIL_DTYPE・12 byte/件）を末尾に追記するだけのファイル
+# - 書き込みは FLUSH_INTERVAL_SEC ごと（maybe_flush）と close() 時にまとめて行う
+#
+# ✅ HeatmapLayer:
+# - 訪問回数 → 色（heat_lut）を、表示先（マップCrop と倍率）の画素配列 RGBA に一括で描く（numpy）
+# - 以降は訪問回数が変わったセルの範囲だけ書き換える（update_cell）。Tk への転送は呼び出し側が
+#   version を見て必要な時だけ行う
+# ──────────────────────────────────────────────
+
+import os
+import time
+import collections
+
+import numpy as np
+from PIL import Image
+
+from wiz_codex_grid import MAP_CELLS
+
+VISITS_SUFFIX = "_visits.npy"
+TRAIL_SUFFIX = "_trail.bin"
+TRAIL_DTYPE = np.dtype([("t", "<f8"), ("x", "u1"), ("y", "u1"), ("dir", "u1"), ("flags", "u1")])   # flags は予約（0）
+TRAIL_LENGTH = 64          # 軌跡として描く直近の件数
+FLUSH_INTERVAL_SEC = 2.0
+COUNT_MAX = np.iinfo(np.uint16).max
+
+
+def visits_path(folder, floor):
+    return os.path.join(folder, f"map_{floor}f{VISITS_SUFFIX}")
+
+
+def trail_path(folder, floor):
+    return os.path.join(folder, f"map_{floor}f{TRAIL_SUFFIX}")
+
+
+class FloorVisits:
+    """1フロア分の訪問回数（memmap）と軌跡（追記ファイル）"""
+
+    def __init__(self, folder, floor, n=MAP_CELLS):
+        self.floor = floor
+        self.n = n
+        self.trail_file = trail_path(folder, floor)
+        self.counts = self._open_counts(visits_path(folder, floor), n)
+        self.recent = collections.deque(self._read_trail_tail(TRAIL_LENGTH), maxlen=TRAIL_LENGTH)
+        self._pending = []      # まだファイルに追記していない記録
+        self.version = 0        # 記録のたびに増える（表示側の再描画判定用）
+
+    @staticmethod
+    def _open_counts(path, n):
+        if os.path.exists(path):
+            try:
+                counts = np.lib.format.open_memmap(path, mode="r+")
+                if counts.dtype == np.uint16 and counts.shape == (n, n):
+                    return counts
+                del counts
+            except (OSError, ValueError) as e:
+                print(f"[visits] 読み込み失敗（作り直します）: {os.path.basename(path)} → {e}")
+        return np.lib.format.open_memmap(path, mode="w+", dtype=np.uint16, shape=(n, n))
+
+    def _read_trail_tail(self, limit):
+        try:
+            size = os.path.getsize(self.trail_file)
+        except OSError:
+            return []
+        count = size // TRAIL_DTYPE.itemsize
+        skip = max(0, count - limit)
+        try:
+            rec = np.fromfile(self.trail_file, dtype=TRAIL_DTYPE, count=count - skip,
+                              offset=skip * TRAIL_DTYPE.itemsize)
+        except (OSError, ValueError):
+            return []
+        return list(zip(rec["x"].tolist(), rec["y"].tolist()))
+
+    def visit(self, x, y, direction, t):
+        """Returns: そのセルの新しい訪問回数"""
+        c = int(self.counts[y, x])
+        if c < COUNT_MAX:
+            c += 1
+            self.counts[y, x] = c
+        self._pending.append((t, x, y, direction & 0xFF, 0))
+        self.recent.append((x, y))
+        self.version += 1
+        return c
+
+    def flush(self):
+        self.counts.flush()
+        if self._pending:
+            with open(self.trail_file, "ab") as f:
+                np.array(self._pending, dtype=TRAIL_DTYPE).tofile(f)
+            self._pending.clear()
+
+    def trail_length(self):
+        """ファイル上の件数 + 未書き込み分"""
+        try:
+            size = os.path.getsize(self.trail_file)
+        except OSError:
+            size = 0
+        return size // TRAIL_DTYPE.itemsize + len(self._pending)
+
+
+class VisitLog:
+    """選択中シナリオのフロアごとの FloorVisits をまとめる（UI スレッドから使う）"""
+
+    def __init__(self, n=MAP_CELLS):
+        self.n = n
+        self.folder = None
+        self.floors = {}
+        self.last = None            # 前回記録した (floor, x, y)
+        self.records = 0
+        self.flushes = 0
+        self._last_flush = time.monotonic()
+
+    def set_folder(self, folder):
+        if folder == self.folder:
+            return
+        self.close()
+        self.folder = folder
+        self.last = None
+
+    def floor(self, floor):
+        fv = self.floors.get(floor)
+        if fv is None and self.folder is not None:
+            fv = self.floors[floor] = FloorVisits(self.folder, floor, self.n)
+        return fv
+
+    def record(self, floor, x, y, direction, t=None):
+        """
+        位置が前回と違えば記録する。
+        Returns: (floor, x, y, 新しい訪問回数) / 記録しなければ None
+        """
+        if self.folder is None or not (0 <= x < self.n and 0 <= y < self.n):
+            return None
+        pos = (floor, x, y)
+        if pos == self.last:
+            return None
+        self.last = pos
+        fv = self.floor(floor)
+        count = fv.visit(x, y, direction, time.time() if t is None else t)
+        self.records += 1
+        return floor, x, y, count
+
+    def maybe_flush(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now - self._last_flush >= FLUSH_INTERVAL_SEC:
+            self.flush()
+            self._last_flush = now
+
+    def flush(self):
+        for fv in self.floors.values():
+            try:
+                fv.flush()
+            except OSError as e:
+                print(f"[visits] 保存失敗: {fv.floor}F → {e}")
+        self.flushes += 1
+
+    def close(self):
+        self.flush()
+        self.floors.clear()   # memmap は参照が消えた時点で閉じる
+
+    def stats(self):
+        return {"records": self.records, "flushes": self.flushes, "floors": len(self.floors)}
+
+
+# ──────────────────────────────
+# ヒートマップ
+_HEAT_LUT = None
+
+
+def heat_lut():
+    """訪問回数（uint16 全域）→ RGBA。1回は薄い青、256回以上は赤。0回は透明"""
+    global _HEAT_LUT
+    if _HEAT_LUT is None:
+        c = np.arange(COUNT_MAX + 1, dtype=np.float64)
+        t = np.clip(np.log2(np.maximum(c, 1.0)) / 8.0, 0.0, 1.0)
+        lut = np.empty((COUNT_MAX + 1, 4), dtype=np.uint8)
+        lut[:, 0] = 60 + 195 * t
+        lut[:, 1] = 140 - 80 * t
+        lut[:, 2] = 255 - 215 * t
+        lut[:, 3] = np.where(c > 0, 70 + 80 * t, 0)
+        _HEAT_LUT = lut
+    return _HEAT_LUT
+
+
+class HeatmapLayer:
+    """
+    counts（[y, x]）を size=(w, h) の RGBA 画素配列に描いたもの。
+    corner = セル (0,0) の左下（画素座標）、cell_px = 1セルの画素数（どちらも表示先の倍率込み）
+    """
+
+    def __init__(self, counts, size, cell_px, corner_x, corner_y):
+        w, h = size
+        n = counts.shape[0]
+        u = np.floor((np.arange(w) + 0.5 - corner_x) / cell_px).astype(np.intp)
+        v = np.floor((corner_y - (np.arange(h) + 0.5)) / cell_px).astype(np.intp)
+        self._u = np.where((u >= 0) & (u < n), u, n)   # n = 範囲外（透明）
+        self._v = np.where((v >= 0) & (v < n), v, n)
+        self.size = (w, h)
+        self.cell_px = cell_px
+        self.corner = (corner_x, corner_y)
+        padded = np.zeros((n + 1, n + 1), dtype=np.uint16)
+        padded[:n, :n] = counts
+        self.rgba = heat_lut()[padded[self._v[:, None], self._u[None, :]]]
+        self.version = 0
+        self.updates = 0
+
+    def _span(self, index, value):
+        hit = np.flatnonzero(index == value)
+        return (int(hit[0]), int(hit[-1]) + 1) if hit.size else None
+
+    def update_cell(self, x, y, count):
+        """セル (x, y) の範囲だけ塗り直す"""
+        xs, ys = self._span(self._u, x), self._span(self._v, y)
+        if xs is None or ys is None:
+            return
+        self.rgba[ys[0]:ys[1], xs[0]:xs[1]] = heat_lut()[min(count, COUNT_MAX)]
+        self.version += 1
+        self.updates += 1
+
+    def image(self):
+        """画素配列を共有した RGBA 画像（PhotoImage への転送用）"""
+        w, h = self.size
+        return Image.frombuffer("RGBA", (w, h), self.rgba, "raw", "RGBA", 0, 1)
+
+    def cell_center(self, x, y):
+        cx, cy = self.corner
+        return cx + (x + 0.5) * self.cell_px, cy - (y + 0.5) * self.cell_px
+
+    @property
+    def nbytes(self):
+        return int(self.rgba.nbytes)